@@ -0,0 +1,228 @@
+import warnings
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+from context_printer import ContextPrinter as Ctp
+# noinspection PyProtectedMember
+from torch.utils.data import DataLoader
+
+from architectures import NormalizingModel
+from metrics import BinaryClassificationResult
+from print_util import print_autoencoder_loss_header, print_autoencoder_loss_stats, print_train_classifier_header, \
+    print_train_classifier
+from tensor_datasets import is_compact, split_batch, get_n_samples
+
+
+# The models of several clients (NormalizingModels with the same architecture) stacked into a single model, so that the forward and
+# backward passes of all the clients are computed at once: each linear layer of the clients becomes a batched matrix product over
+# (n_clients, ...) weight tensors, and each client keeps its own normalization values.
+# The parameters of the clients' models are views into the stacked weights for as long as the BatchedModels is used, so that the
+# clients' own optimizers (and schedulers) update the stacked weights in place. unstack then gives each model its own copy of its weights.
+class BatchedModels:
+    def __init__(self, models: List[NormalizingModel]) -> None:
+        self.models = models
+        self.sub = torch.stack([model.sub.data for model in models]).unsqueeze(1)
+        self.div = torch.stack([model.div.data for model in models]).unsqueeze(1)
+
+        self.names = [name for name, param in models[0].model.named_parameters() if param.requires_grad]
+        self.clients_params = [dict(model.model.named_parameters()) for model in models]
+        self.stacked_params = {}
+        for name in self.names:
+            stacked_param = torch.stack([client_params[name].data for client_params in self.clients_params]).requires_grad_()
+            for client_id, client_params in enumerate(self.clients_params):
+                client_params[name].data = stacked_param.detach()[client_id]
+            self.stacked_params[name] = stacked_param
+
+        # The layers of the template model: the linear layers are replaced by their stacked weights, the other layers (the activation
+        # functions) have no parameters and are applied as is on the (n_clients, batch_size, n_features) tensors
+        self.layers = []
+        for name, module in models[0].model.seq.named_children():
+            if isinstance(module, nn.Linear):
+                self.layers.append((self.stacked_params['seq.' + name + '.weight'], self.stacked_params['seq.' + name + '.bias']))
+            elif len(list(module.parameters())) == 0:
+                self.layers.append(module)
+            else:
+                raise NotImplementedError('Only the linear layers can have parameters in a batched model')
+
+    # The rows of weight 0 (the padding of stack_batches) are set to 0 after the normalization, so that they cannot produce non-finite
+    # values (which would spread to the gradients of the weights even though the losses of these rows are not counted)
+    def normalize(self, x: torch.Tensor, weights: torch.Tensor) -> torch.Tensor:
+        return ((x - self.sub) / self.div).masked_fill_((weights == 0.).unsqueeze(2), 0.)
+
+    # x is a (n_clients, batch_size, n_features) tensor of normalized rows
+    def forward_normalized(self, x: torch.Tensor) -> torch.Tensor:
+        for layer in self.layers:
+            if isinstance(layer, tuple):
+                weight, bias = layer
+                x = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+            else:
+                x = layer(x)
+        return x
+
+    def zero_grad(self) -> None:
+        for stacked_param in self.stacked_params.values():
+            stacked_param.grad = None
+
+    # Gives the gradients of the stacked weights to the clients' parameters, so that their optimizers can use them
+    def set_models_grads(self) -> None:
+        for name in self.names:
+            grad = self.stacked_params[name].grad
+            for client_id, client_params in enumerate(self.clients_params):
+                client_params[name].grad = grad[client_id]
+
+    # Step of a plain SGD (without momentum) on the stacked weights, which updates the weights of all the clients like their own
+    # optimizers would, in a single operation per parameter
+    def sgd_step(self, lr: float, weight_decay: float) -> None:
+        with torch.no_grad():
+            for stacked_param in self.stacked_params.values():
+                grad = stacked_param.grad if weight_decay == 0. else stacked_param.grad.add(stacked_param, alpha=weight_decay)
+                stacked_param.add_(grad, alpha=-lr)
+
+    # Detaches the parameters of the clients' models from the stacked weights
+    def unstack(self) -> None:
+        for client_params in self.clients_params:
+            for name in self.names:
+                client_params[name].grad = None
+                client_params[name].data = client_params[name].data.clone()
+
+
+# Stacks the batches of the clients into (n_clients, batch_size, ...) tensors, where batch_size is the size of their largest batch. The
+# missing rows (the clients whose last batch is smaller, or that have no batch left in this epoch) are zeros of weight 0. The weights
+# are the multiplicities of the rows for the compact datasets, and 1 for the rows of the other datasets.
+def stack_batches(batches: List[Optional[tuple]], weighted: List[bool]) -> Tuple[Tuple[torch.Tensor, ...], torch.Tensor]:
+    split_batches = [split_batch(batch, client_weighted) if batch is not None else None for batch, client_weighted in zip(batches, weighted)]
+    first_tensors = next(tensors for tensors, _ in (split for split in split_batches if split is not None))
+    batch_size = max(len(tensors[0]) for tensors, _ in (split for split in split_batches if split is not None))
+
+    stacked_tensors = tuple(first_tensor.new_zeros((len(batches), batch_size) + first_tensor.shape[1:]) for first_tensor in first_tensors)
+    weights = first_tensors[0].new_zeros((len(batches), batch_size))
+    for client_id, split in enumerate(split_batches):
+        if split is None:
+            continue
+        tensors, weight = split
+        n_rows = len(tensors[0])
+        for stacked_tensor, tensor in zip(stacked_tensors, tensors):
+            stacked_tensor[client_id, :n_rows] = tensor
+        weights[client_id, :n_rows] = 1. if weight is None else weight
+    return stacked_tensors, weights
+
+
+# Returns the learning rate and the weight decay shared by the optimizers if they are all plain SGD optimizers (without momentum) with the
+# same hyper-parameters, so that their steps can be made on the stacked weights, None otherwise
+def get_shared_sgd_params(optimizers: List[torch.optim.Optimizer]) -> Optional[Tuple[float, float]]:
+    shared_params = set()
+    for optimizer in optimizers:
+        if type(optimizer) is not torch.optim.SGD or len(optimizer.param_groups) != 1:
+            return None
+        group = optimizer.param_groups[0]
+        if group['momentum'] != 0 or group.get('maximize', False):
+            return None
+        shared_params.add((group['lr'], group['weight_decay']))
+    return shared_params.pop() if len(shared_params) == 1 else None
+
+
+def get_optimizer_scheduler(model: nn.Module, params: SimpleNamespace, lr_factor: float) -> Tuple[torch.optim.Optimizer, object]:
+    optimizer = params.optimizer(model.parameters(), **params.optimizer_params)
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = param_group['lr'] * lr_factor
+    scheduler = params.lr_scheduler(optimizer, **params.lr_scheduler_params)
+    return optimizer, scheduler
+
+
+# Trains the models of the clients like train_autoencoder or train_classifier would train each of them (same optimizers, schedulers
+# and epochs, each client going through its own dataloader), but with a single forward and backward pass per step for all the clients.
+# The clients whose dataloader has fewer batches do not take part in the last steps of each epoch: their rows are masked and their
+# optimizers do not step. When the optimizers are plain SGD optimizers, the steps in which all the clients take part are made directly on
+# the stacked weights. The shuffling of the dataloaders is not the same as when the clients are trained one after the other, since
+# the dataloaders are iterated over together.
+def train_clients_batched(models: List[NormalizingModel], dls: List[DataLoader], params: SimpleNamespace, autoencoder: bool,
+                          lr_factor: float = 1.0) -> None:
+    batched_models = BatchedModels(models)
+    optimizers_schedulers = [get_optimizer_scheduler(model, params, lr_factor) for model in models]
+    optimizers = [optimizer for optimizer, _ in optimizers_schedulers]
+    weighted = [is_compact(dl) for dl in dls]
+    n_batches = [len(dl) for dl in dls]
+
+    for model in models:
+        model.train()
+
+    if autoencoder:
+        print_autoencoder_loss_header(first_column='Epoch', print_lr=True)
+    else:
+        print_train_classifier_header()
+
+    for epoch in range(params.epochs):
+        iterators = [iter(dl) for dl in dls]
+        epoch_losses, epoch_weights = [], []
+        counts = torch.zeros((len(models), 4), dtype=torch.long)  # tp, tn, fp, fn of each client
+        for step in range(max(n_batches)):
+            active = [step < client_n_batches for client_n_batches in n_batches]
+            batches = [next(iterator) if client_active else None for iterator, client_active in zip(iterators, active)]
+            tensors, weights = stack_batches(batches, weighted)
+            weights = weights.float()
+
+            x = batched_models.normalize(tensors[0], weights)
+            output = batched_models.forward_normalized(x)
+            if autoencoder:
+                losses = ((output - x) ** 2).mean(dim=2)
+            else:
+                losses = nn.functional.binary_cross_entropy(output, tensors[1], reduction='none').reshape(weights.shape)
+
+            # Each client's loss is the weighted mean of the losses of its rows, and the gradient of the sum of the clients' losses
+            # with respect to the stacked weights of a client is the gradient of its own loss
+            batched_models.zero_grad()
+            ((losses * weights).sum(dim=1) / weights.sum(dim=1).clamp(min=1.)).sum().backward()
+            shared_sgd_params = get_shared_sgd_params(optimizers) if all(active) else None
+            if shared_sgd_params is not None:
+                batched_models.sgd_step(*shared_sgd_params)
+            else:
+                batched_models.set_models_grads()
+                for optimizer, client_active in zip(optimizers, active):
+                    if client_active:
+                        optimizer.step()
+
+            with torch.no_grad():
+                if autoencoder:
+                    epoch_losses.append(losses.detach())
+                    epoch_weights.append(weights)
+                else:
+                    pred = torch.gt(output, 0.5).reshape(weights.shape)
+                    label = tensors[1].reshape(weights.shape).bool()
+                    for i, outcome in enumerate((pred & label, ~pred & ~label, pred & ~label, ~pred & label)):
+                        counts[:, i] += (outcome * weights).sum(dim=1).long()
+
+        print_clients_epoch(epoch, params.epochs, optimizers_schedulers, n_batches, weighted, autoencoder, epoch_losses, epoch_weights, counts)
+        with warnings.catch_warnings():
+            # The schedulers warn that their optimizers have not stepped when all the steps were made on the stacked weights
+            warnings.simplefilter('ignore', UserWarning)
+            for _, scheduler in optimizers_schedulers:
+                scheduler.step()
+
+    batched_models.unstack()
+
+
+def print_clients_epoch(epoch: int, n_epochs: int, optimizers_schedulers: list, n_batches: List[int], weighted: List[bool],
+                        autoencoder: bool, epoch_losses: List[torch.Tensor], epoch_weights: List[torch.Tensor], counts: torch.Tensor) -> None:
+    if autoencoder:
+        losses, weights = torch.cat(epoch_losses, dim=1), torch.cat(epoch_weights, dim=1)
+    for client_id, (optimizer, _) in enumerate(optimizers_schedulers):
+        title = '[{}/{}] #{}'.format(epoch + 1, n_epochs, client_id)
+        lr = optimizer.param_groups[0]['lr']
+        if autoencoder:
+            rows = weights[client_id] > 0.
+            print_autoencoder_loss_stats(title, losses[client_id, rows], lr=lr,
+                                         weights=(weights[client_id, rows].long() if weighted[client_id] else None))
+        else:
+            result = BinaryClassificationResult(*counts[client_id].tolist())
+            print_train_classifier(epoch, n_epochs, n_batches[client_id] - 1, n_batches[client_id], result, lr, persistent=True, title=title)
+
+
+# Batched counterpart of the loops of multitrain_autoencoders and multitrain_classifiers: the clients are listed with the id (#i) under
+# which their statistics are printed at each epoch, then trained together
+def multitrain_batched(trains: List[Tuple[str, DataLoader, NormalizingModel]], params: SimpleNamespace, autoencoder: bool,
+                       lr_factor: float = 1.0) -> None:
+    for i, (title, dataloader, _) in enumerate(trains):
+        Ctp.print('#{} [{}/{}] '.format(i, i + 1, len(trains)) + title + ' ({} samples)'.format(get_n_samples(dataloader)))
+    train_clients_batched([model for _, _, model in trains], [dataloader for _, dataloader, _ in trains], params, autoencoder, lr_factor)
@@ -0,0 +1,640 @@
+import multiprocessing
+from argparse import ArgumentParser
+from copy import deepcopy
+from time import time
+from types import SimpleNamespace
+from typing import List, Tuple, Callable, Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+import torch
+from context_printer import Color
+from context_printer import ContextPrinter as Ctp
+
+from architectures import SimpleAutoencoder, BinaryClassifier, NormalizingModel
+from batched_training import train_clients_batched
+from data import all_devices, get_device_csv_paths, read_device_data, cache_device_data, get_benign_attack_samples_per_device, \
+    DeviceData, read_all_data, get_configuration_data, get_initial_splitting
+from execution import execution_mode
+from federated_util import federated_averaging, federated_median, federated_trimmed_mean_1, federated_trimmed_mean_2, federated_krum_2, \
+    federated_multi_krum_2, federated_bulyan_2, federated_geometric_median, flatten_model
+from metrics import BinaryClassificationResult
+from ml import get_sub_div
+from normalized_data import normalized_data_cache
+from print_util import Columns
+from supervised_data import get_client_supervised_initial_splitting, get_target_tensor
+from supervised_ml import train_classifier, train_classifiers_fedsgd, test_classifier
+from streaming_aggregation import get_streaming_aggregator, median_rank_error
+from synthetic_data import generate_device_data
+from tensor_datasets import ResampledDatasetBuilder, TensorDataLoader
+from test_hparams import select_experiment_function
+from thinning import thinning_functions
+from unsupervised_data import get_client_unsupervised_initial_splitting
+from unsupervised_ml import train_autoencoder, train_autoencoders_fedsgd, compute_reconstruction_losses
+
+StageMemory = Tuple[str, int, int]  # Name of the stage, peak bytes during the stage, bytes still used after the stage
+
+
+def read_status_bytes(field: str) -> int:
+    with open('/proc/self/status', 'r') as infile:
+        for line in infile:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise ValueError('Field ' + field + ' not found in /proc/self/status')
+
+
+# Measures the peak resident memory of each stage of a pipeline (Linux only). The peak (VmHWM) is reset before each stage by writing
+# to /proc/self/clear_refs, so that the peak of a stage is not hidden by the peak of a previous one.
+class StageMemoryTracker:
+    def __init__(self) -> None:
+        self.stages = []
+
+    def run(self, name: str, function: Callable, *args) -> Any:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        rss_before = read_status_bytes('VmRSS')
+        result = function(*args)
+        self.stages.append((name, read_status_bytes('VmHWM') - rss_before, read_status_bytes('VmRSS') - rss_before))
+        return result
+
+
+def get_samples_per_key(device_data: DeviceData, samples_per_device: int, benign_prop: float) -> Dict[str, int]:
+    benign_samples, attack_samples = get_benign_attack_samples_per_device(p_split=1., benign_prop=benign_prop, samples_per_device=samples_per_device)
+    n_samples_attack = attack_samples // 10
+    if len(device_data.keys()) - 1 == 5:
+        n_samples_attack *= 2
+    return {key: (benign_samples if key == 'benign' else n_samples_attack) for key in device_data.keys()}
+
+
+# Resampling as it was done before the virtual resampling: the rows are materialized (in float64) and the global seed is reset
+def legacy_resample_array(arr: np.ndarray, n_samples: int) -> np.ndarray:
+    repeated_arr = arr.repeat(int(n_samples / len(arr)), axis=0)
+    np.random.seed(0)
+    random_arr = arr[np.random.choice(np.arange(len(arr)), n_samples - len(repeated_arr), replace=False)]
+    np.random.seed(None)
+    return np.append(repeated_arr, random_arr, axis=0)
+
+
+# Data path before the float32 zero-copy path: float64 parsing, materialized resampling, tensor creation + float cast, and concatenation
+def legacy_data_path(device_id: int, samples_per_device: int, benign_prop: float, output: multiprocessing.Queue) -> None:
+    tracker = StageMemoryTracker()
+    csv_paths = get_device_csv_paths(all_devices[device_id])
+    device_data = tracker.run('Read CSVs (float64)', lambda: {key: pd.read_csv(path).to_numpy() for key, path in csv_paths.items()})
+    samples_per_key = get_samples_per_key(device_data, samples_per_device, benign_prop)
+    arrays = tracker.run('Resample', lambda: [legacy_resample_array(arr, samples_per_key[key]) for key, arr in device_data.items()])
+    tensors = tracker.run('Tensors + float cast', lambda: [torch.tensor(arr).float() for arr in arrays])
+    tracker.run('Concatenate', lambda: torch.cat(tensors, dim=0))
+    output.put(tracker.stages)
+
+
+# Current data path: memory-mapped float32 cache, virtual resampling and a single copy into a preallocated tensor
+def current_data_path(device_id: int, samples_per_device: int, benign_prop: float, output: multiprocessing.Queue) -> None:
+    tracker = StageMemoryTracker()
+    device_data = tracker.run('Map binary cache', read_device_data, device_id)
+    samples_per_key = get_samples_per_key(device_data, samples_per_device, benign_prop)
+    builder = ResampledDatasetBuilder()
+    tracker.run('Resample (indexes)', lambda: [builder.add(arr, samples_per_key[key]) for key, arr in device_data.items()])
+    tracker.run('Build tensor', builder.build)
+    output.put(tracker.stages)
+
+
+# Each path is run in its own process so that the memory used by one does not affect the measures of the other
+def run_in_process(function: Callable, *args) -> Any:
+    context = multiprocessing.get_context('fork')
+    output = context.Queue()
+    process = context.Process(target=function, args=args + (output,))
+    process.start()
+    stages = output.get()
+    process.join()
+    return stages
+
+
+def print_stages(title: str, stages: List[StageMemory]) -> None:
+    Ctp.enter_section(title, Color.NONE)
+    Ctp.print('Stage'.ljust(Columns.LARGE) + '| Peak MB'.ljust(Columns.MEDIUM) + '| Retained MB'.ljust(Columns.MEDIUM), bold=True)
+    for name, peak, retained in stages:
+        Ctp.print(name.ljust(Columns.LARGE) + '| {:.1f}'.format(peak / 2 ** 20).ljust(Columns.MEDIUM)
+                  + '| {:.1f}'.format(retained / 2 ** 20).ljust(Columns.MEDIUM))
+    Ctp.print('Highest stage peak: {:.1f} MB - Total retained: {:.1f} MB'.format(max(peak for _, peak, _ in stages) / 2 ** 20,
+                                                                              sum(retained for _, _, retained in stages) / 2 ** 20))
+    Ctp.exit_section()
+
+
+# Memory report of the data path of a device, from the files on disk to the tensor of its dataset, before and after the float32
+# zero-copy data path
+def memory_report(device_id: int, samples_per_device: int, benign_prop: float) -> None:
+    Ctp.enter_section('Memory report for ' + all_devices[device_id], Color.YELLOW)
+    cache_device_data(device_id)  # The one-time conversion is not part of the measures
+    print_stages('Before (legacy path)', run_in_process(legacy_data_path, device_id, samples_per_device, benign_prop))
+    print_stages('After (float32 zero-copy path)', run_in_process(current_data_path, device_id, samples_per_device, benign_prop))
+    Ctp.exit_section()
+
+
+# Parameters of the local experiments of the thinning benchmark (the same as the ones of main.py for the first configuration)
+def get_thinning_params(experiment: str, epochs: Optional[int], samples_per_device: int, ratio: float) -> dict:
+    params = {'n_features': 115, 'normalization': 'min-max', 'test_bs': 4096, 'p_test': 0.2, 'p_unused': 0.01, 'n_splits': 5,
+              'val_part': 0.2, 'p_train_val': 0.79, 'cuda': False, 'benign_prop': 0.0787, 'samples_per_device': samples_per_device,
+              'compact_datasets': False, 'thinning': None, 'thinning_ratio': ratio, 'batched_clients': False, 'streaming_chunk_size': None,
+              'early_stopping': None, 'federated_early_stopping': None, 'activation_fn': torch.nn.ELU, 'train_bs': 64,
+              'optimizer': torch.optim.SGD, 'lr_scheduler': torch.optim.lr_scheduler.StepLR, 'aggregation_function': federated_averaging,
+              'resampling': None, 'streaming_aggregation': False, 'n_malicious': 0, 'data_poisoning': None, 'p_poison': None,
+              'model_update_factor': 1.0, 'model_poisoning': None, 'devices': all_devices,
+              'verbose': False}  # The detailed output of the experiments is not shown
+    if experiment == 'autoencoder':
+        params.update({'threshold_part': 0.5, 'quantile': 0.95, 'epochs': 120, 'lr_scheduler_params': {'step_size': 20, 'gamma': 0.5},
+                       'hidden_layers': [29], 'optimizer_params': {'lr': 1.0, 'weight_decay': 0.0}})
+    elif experiment == 'classifier':
+        params.update({'epochs': 4, 'lr_scheduler_params': {'step_size': 1, 'gamma': 0.5},
+                       'hidden_layers': [115, 58, 29], 'optimizer_params': {'lr': 0.5, 'weight_decay': 0.0}})
+    else:
+        raise ValueError('Unknown experiment: ' + experiment)
+    if epochs is not None:
+        params['epochs'] = epochs
+    return params
+
+
+def print_thinning_results(rows: List[Tuple[str, float, BinaryClassificationResult, BinaryClassificationResult]]) -> None:
+    Ctp.print('Thinning'.ljust(Columns.SMALL) + '| Time (s)'.ljust(Columns.SMALL) + '| Speedup'.ljust(Columns.SMALL)
+              + '| TPR'.ljust(Columns.SMALL) + '| FPR'.ljust(Columns.SMALL) + '| F1'.ljust(Columns.SMALL)
+              + '| New TPR'.ljust(Columns.SMALL) + '| New FPR'.ljust(Columns.SMALL) + '| New F1'.ljust(Columns.SMALL), bold=True)
+    full_time = rows[0][1]
+    for name, elapsed, local_result, new_devices_result in rows:
+        Ctp.print(name.ljust(Columns.SMALL) + '| {:.1f}'.format(elapsed).ljust(Columns.SMALL)
+                  + '| {:.2f}x'.format(full_time / elapsed).ljust(Columns.SMALL)
+                  + '| {:.5f}'.format(local_result.tpr()).ljust(Columns.SMALL) + '| {:.5f}'.format(local_result.fpr()).ljust(Columns.SMALL)
+                  + '| {:.5f}'.format(local_result.f1()).ljust(Columns.SMALL)
+                  + '| {:.5f}'.format(new_devices_result.tpr()).ljust(Columns.SMALL)
+                  + '| {:.5f}'.format(new_devices_result.fpr()).ljust(Columns.SMALL)
+                  + '| {:.5f}'.format(new_devices_result.f1()).ljust(Columns.SMALL))
+
+
+# Compares the detection metrics and the wall time of a local experiment (one client owning the data of one device, tested on its own
+# device and on another one) trained on the full training set and on the training sets thinned by each thinning function
+def thinning_report(experiment: str, device_id: int, test_device_id: int, ratio: float, epochs: Optional[int], samples_per_device: int) -> None:
+    Ctp.enter_section('Thinning report for the {} of {} (ratio {})'.format(experiment, all_devices[device_id], ratio), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, epochs, samples_per_device, ratio),
+                             clients_devices=[[device_id]], test_devices=[test_device_id])
+    all_data = read_all_data(device_ids=[device_id, test_device_id])
+    clients_data, test_devices_data = get_configuration_data(all_data, params.clients_devices, params.test_devices)
+    splitting_function = get_client_unsupervised_initial_splitting if experiment == 'autoencoder' else get_client_supervised_initial_splitting
+    clients_train_val, clients_test = get_initial_splitting(splitting_function, clients_data, p_test=params.p_test, p_unused=params.p_unused)
+    experiment_function = select_experiment_function(experiment, None)
+
+    rows = []
+    for thinning in [None] + list(thinning_functions.keys()):
+        params.thinning = thinning
+        torch.manual_seed(0)
+        np.random.seed(0)
+        Ctp.deactivate()  # The detailed output of the experiments is not shown
+        start_time = time()
+        result = experiment_function(clients_train_val, clients_test, test_devices_data, params=params)
+        elapsed = time() - start_time
+        Ctp.activate()
+        rows.append(('full' if thinning is None else thinning, elapsed, result[0], result[1]))
+
+    print_thinning_results(rows)
+    Ctp.exit_section()
+
+
+# Training set of a client made of the synthetic data of one device: its benign rows for the autoencoders, all its rows with their
+# targets for the classifiers
+def get_batched_client(experiment: str, device_id: int, rows_per_key: int, params: SimpleNamespace) -> Tuple[TensorDataLoader, NormalizingModel]:
+    device_data = generate_device_data(device_id, rows_per_key)
+    builder = ResampledDatasetBuilder()
+    targets = []
+    for key, arr in device_data.items():
+        if experiment == 'autoencoder' and key != 'benign':
+            continue
+        targets.append(get_target_tensor(key, builder.add(arr)))
+    dataset = builder.build() if experiment == 'autoencoder' else builder.build(torch.cat(targets))
+    sub, div = get_sub_div(dataset.data, params.normalization)
+    architecture = SimpleAutoencoder if experiment == 'autoencoder' else BinaryClassifier
+    model = NormalizingModel(architecture(activation_function=params.activation_fn, hidden_layers=params.hidden_layers), sub, div)
+    return TensorDataLoader(dataset, batch_size=params.train_bs, shuffle=True), model
+
+
+# Wall time of the local training of the clients of a federation round, when the clients are trained one after the other and when they
+# are trained together in a batched model. Each repeat starts from the same initial models, and the best time of the repeats is kept
+# (the first one includes the warm-up of torch).
+def batched_report(experiment: str, n_clients: int, rows_per_key: int, epochs: int, repeats: int) -> None:
+    Ctp.enter_section('Batched training report for the {} of {} clients ({} epochs)'.format(experiment, n_clients, epochs), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, epochs, 0, 1.))
+    torch.manual_seed(0)
+    dls, models = zip(*[get_batched_client(experiment, device_id, rows_per_key, params) for device_id in range(n_clients)])
+    train_function = train_autoencoder if experiment == 'autoencoder' else train_classifier
+
+    Ctp.deactivate()
+    sequential_time, batched_time = float('inf'), float('inf')
+    for _ in range(repeats):
+        start_time = time()
+        for model, dl in zip(deepcopy(models), dls):
+            train_function(model, params, dl)
+        sequential_time = min(sequential_time, time() - start_time)
+        start_time = time()
+        train_clients_batched(list(deepcopy(models)), list(dls), params, autoencoder=(experiment == 'autoencoder'))
+        batched_time = min(batched_time, time() - start_time)
+    Ctp.activate()
+
+    n_batches = sum(len(dl) for dl in dls) * epochs
+    Ctp.print('Sequential: {:.2f}s ({:.0f} batches/s)'.format(sequential_time, n_batches / sequential_time))
+    Ctp.print('Batched: {:.2f}s ({:.0f} batches/s), speedup {:.2f}x'.format(batched_time, n_batches / batched_time,
+                                                                         sequential_time / batched_time))
+    Ctp.exit_section()
+
+
+# Same optimizer as torch.optim.SGD, but not recognized by flat_util.can_use_flat_fedsgd, so that FedSGD goes through the per-model path
+class PerModelSGD(torch.optim.SGD):
+    pass
+
+
+# Steps per second of FedSGD (one step being the training of each client on one batch, the attacks and the aggregation), with the
+# per-model path (an optimizer constructed per client and per step, the models flattened for the aggregation and the global model copied
+# into each client's model) and with the flat buffers of flat_util
+def fedsgd_report(experiment: str, n_clients: int, rows_per_key: int, batch_size: int) -> None:
+    Ctp.enter_section('FedSGD report for the {} of {} clients (batch size {})'.format(experiment, n_clients, batch_size), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, 1, 0, 1.), clients_devices=[[device_id] for device_id in range(n_clients)],
+                             malicious_clients=set())
+    params.train_bs = batch_size
+    torch.manual_seed(0)
+    dls, models = zip(*[get_batched_client(experiment, device_id, rows_per_key, params) for device_id in range(n_clients)])
+    global_model = deepcopy(models[0])
+    n_steps = min(len(dl) for dl in dls)
+
+    Ctp.deactivate()
+    times = {}
+    for name, optimizer in [('per-model', PerModelSGD), ('flat', torch.optim.SGD)]:
+        params.optimizer = optimizer
+        start_time = time()
+        if experiment == 'autoencoder':
+            train_autoencoders_fedsgd(deepcopy(global_model), [deepcopy(global_model) for _ in range(n_clients)], list(dls), params)
+        else:
+            train_classifiers_fedsgd(deepcopy(global_model), [deepcopy(global_model) for _ in range(n_clients)], list(dls), params, epoch=0)
+        times[name] = time() - start_time
+    Ctp.activate()
+
+    for name, elapsed in times.items():
+        Ctp.print('{}: {:.2f}s ({:.0f} steps/s)'.format(name.capitalize(), elapsed, n_steps / elapsed))
+    Ctp.print('Speedup {:.2f}x'.format(times['per-model'] / times['flat']))
+    Ctp.exit_section()
+
+
+# Wall time of the training of a client followed by a pass over its training set (the computation of the threshold for the autoencoders,
+# a test for the classifiers), with the rows normalized by the model in each batch and with the rows normalized once by the normalized data
+# cache. Each repeat starts from the same initial model and the same state of the generator, so that both modes should give the same model.
+def prenormalized_report(experiment: str, rows_per_key: int, epochs: int, repeats: int) -> None:
+    Ctp.enter_section('Pre-normalized datasets report for the {} ({} epochs)'.format(experiment, epochs), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, epochs, 0, 1.))
+    torch.manual_seed(0)
+    dl, model = get_batched_client(experiment, 0, rows_per_key, params)
+    train_function = train_autoencoder if experiment == 'autoencoder' else train_classifier
+    test_function = compute_reconstruction_losses if experiment == 'autoencoder' else test_classifier
+
+    Ctp.deactivate()
+    times, trained_models = {}, {}
+    for _ in range(repeats):
+        for name, enabled in [('per-batch', False), ('pre-normalized', True)]:
+            normalized_data_cache.set_enabled(enabled)  # Disabling the cache also clears it, so that each repeat normalizes the rows again
+            trained_models[name] = deepcopy(model)
+            torch.manual_seed(1)
+            start_time = time()
+            train_function(trained_models[name], params, dl)
+            test_function(trained_models[name], dl)
+            times[name] = min(times.get(name, float('inf')), time() - start_time)
+    normalized_data_cache.set_enabled(False)
+    Ctp.activate()
+
+    n_batches = len(dl) * (epochs + 1)
+    for name, elapsed in times.items():
+        Ctp.print('{}: {:.2f}s ({:.0f} batches/s)'.format(name.capitalize(), elapsed, n_batches / elapsed))
+    Ctp.print('Speedup {:.2f}x'.format(times['per-batch'] / times['pre-normalized']))
+    same_models = all(torch.equal(param, other_param) for param, other_param in zip(trained_models['per-batch'].parameters(),
+                                                                                   trained_models['pre-normalized'].parameters()))
+    Ctp.print('Same trained models: {}'.format(same_models))
+    Ctp.exit_section()
+
+
+# Modes of the execution benchmark: name, compile_models and bf16_autocast
+execution_modes = [('eager', None, False), ('script', 'script', False), ('compile', 'compile', False), ('eager bf16', None, True),
+                   ('script bf16', 'script', True), ('compile bf16', 'compile', True)]
+
+
+# Training throughput, inference throughput and accuracy of a client's model in each execution mode (see execution.py). The client is
+# trained on a synthetic device and tested on another one: the metric is the mean reconstruction loss of its benign rows for the
+# autoencoders, the F1-score for the classifiers. Each mode is first run on a copy of the model (the compilation is not measured), then
+# the model is trained from the same initial weights and the same state of the generator, and the test is timed over repeats passes.
+def execution_report(experiment: str, rows_per_key: int, epochs: int, repeats: int) -> None:
+    Ctp.enter_section('Execution modes report for the {} ({} epochs)'.format(experiment, epochs), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, epochs, 0, 1.))
+    torch.manual_seed(0)
+    train_dl, model = get_batched_client(experiment, 0, rows_per_key, params)
+    test_dl = TensorDataLoader(get_batched_client(experiment, 1, rows_per_key, params)[0].dataset, batch_size=params.test_bs)
+    train_function = train_autoencoder if experiment == 'autoencoder' else train_classifier
+    warm_up_params = SimpleNamespace(**{**vars(params), 'epochs': 1})
+
+    Ctp.print('Mode'.ljust(Columns.MEDIUM) + '| Train (batches/s)'.ljust(Columns.LARGE) + '| Test (rows/s)'.ljust(Columns.LARGE)
+              + ('| Test loss' if experiment == 'autoencoder' else '| F1-Score').ljust(Columns.MEDIUM) + '| Change', bold=True)
+    reference_metric = None
+    for name, compile_mode, bf16_autocast in execution_modes:
+        execution_mode.configure(compile_mode, bf16_autocast)
+        Ctp.deactivate()
+        warm_up_model = deepcopy(model)
+        train_function(warm_up_model, warm_up_params, train_dl)
+        if experiment == 'autoencoder':
+            compute_reconstruction_losses(warm_up_model, test_dl)
+        else:
+            test_classifier(warm_up_model, test_dl)
+
+        trained_model = deepcopy(model)
+        torch.manual_seed(1)
+        start_time = time()
+        train_function(trained_model, params, train_dl)
+        train_time = time() - start_time
+        test_time = float('inf')
+        for _ in range(repeats):
+            start_time = time()
+            if experiment == 'autoencoder':
+                metric = compute_reconstruction_losses(trained_model, test_dl).mean().item()
+            else:
+                metric = test_classifier(trained_model, test_dl).f1()
+            test_time = min(test_time, time() - start_time)
+        Ctp.activate()
+
+        if reference_metric is None:
+            reference_metric = metric
+        Ctp.print(name.ljust(Columns.MEDIUM) + '| {:.0f}'.format(len(train_dl) * epochs / train_time).ljust(Columns.LARGE)
+                  + '| {:.0f}'.format(len(test_dl.dataset) / test_time).ljust(Columns.LARGE)
+                  + '| {:.6f}'.format(metric).ljust(Columns.MEDIUM) + '| {:+.6f}'.format(metric - reference_metric))
+    execution_mode.configure(None, False)
+    Ctp.exit_section()
+
+
+# Aggregations as they were done before the flat aggregations: the state dicts of all the models are read and stacked for each key, and
+# the values of each parameter are fully sorted to keep the n_kept values above the n_excluded_down lowest ones (all the values are kept
+# if n_kept is None, for the mean)
+def legacy_aggregation(global_model: torch.nn.Module, models: List[torch.nn.Module], n_excluded_down: int = 0,
+                       n_kept: Optional[int] = None) -> None:
+    with torch.no_grad():
+        state_dict = global_model.state_dict()
+        for key in state_dict:
+            stacked = torch.stack([model.state_dict()[key] for model in models], dim=-1)
+            if n_kept is not None:
+                stacked = torch.narrow(torch.sort(stacked, dim=-1)[0], -1, n_excluded_down, n_kept)
+            state_dict[key] = stacked.mean(dim=-1)
+        global_model.load_state_dict(state_dict)
+
+
+# Aggregations of the benchmark: name, legacy aggregation for n clients and current aggregation function
+benchmarked_aggregations = [('mean', lambda n: lambda global_model, models: legacy_aggregation(global_model, models), federated_averaging),
+                            ('median', lambda n: lambda global_model, models: legacy_aggregation(global_model, models, (n - 1) // 2,
+                                                                                                 2 - n % 2), federated_median),
+                            ('trimmed mean 1', lambda n: lambda global_model, models: legacy_aggregation(global_model, models, 1, n - 2),
+                             federated_trimmed_mean_1),
+                            ('trimmed mean 2', lambda n: lambda global_model, models: legacy_aggregation(global_model, models, 2, n - 4),
+                             federated_trimmed_mean_2)]
+
+
+# Wall time of the aggregation of the clients' models into the global model for each number of clients, with the per-key aggregations and
+# with the flat aggregations of federated_util. The models of the clients are random perturbations of the same model (as after a round
+# of local training), and the best time of the repeats is kept. The max difference is the largest absolute difference between the
+# parameters of the global models aggregated both ways.
+def aggregation_report(experiment: str, clients_counts: List[int], repeats: int) -> None:
+    Ctp.enter_section('Aggregation report for the {}'.format(experiment), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, 1, 0, 1.))
+    architecture = SimpleAutoencoder if experiment == 'autoencoder' else BinaryClassifier
+    torch.manual_seed(0)
+    global_model = NormalizingModel(architecture(activation_function=params.activation_fn, hidden_layers=params.hidden_layers),
+                                    sub=torch.zeros(params.n_features), div=torch.ones(params.n_features))
+    Ctp.print('{} parameters per model'.format(sum(param.numel() for param in global_model.parameters())))
+
+    Ctp.print('Clients'.ljust(Columns.SMALL) + '| Aggregation'.ljust(Columns.MEDIUM) + '| Per-key (ms)'.ljust(Columns.MEDIUM)
+              + '| Flat (ms)'.ljust(Columns.MEDIUM) + '| Speedup'.ljust(Columns.SMALL) + '| Max difference', bold=True)
+    for n_clients in clients_counts:
+        models = [deepcopy(global_model) for _ in range(n_clients)]
+        with torch.no_grad():
+            for model in models:
+                for param in model.model.parameters():
+                    param.add_(torch.randn_like(param), alpha=0.01)
+
+        for name, legacy_aggregation, aggregation_function in benchmarked_aggregations:
+            if name.startswith('trimmed mean') and n_clients <= 2 * int(name[-1]):
+                continue
+            times, aggregated_models = {}, {}
+            for _ in range(repeats):
+                for mode, function in [('per-key', legacy_aggregation(n_clients)), ('flat', aggregation_function)]:
+                    aggregated_models[mode] = deepcopy(global_model)
+                    start_time = time()
+                    function(aggregated_models[mode], models)
+                    times[mode] = min(times.get(mode, float('inf')), time() - start_time)
+            max_difference = max((param - other_param).abs().max().item() for param, other_param
+                                 in zip(aggregated_models['per-key'].parameters(), aggregated_models['flat'].parameters()))
+            Ctp.print(str(n_clients).ljust(Columns.SMALL) + '| {}'.format(name).ljust(Columns.MEDIUM)
+                      + '| {:.2f}'.format(times['per-key'] * 1000).ljust(Columns.MEDIUM)
+                      + '| {:.2f}'.format(times['flat'] * 1000).ljust(Columns.MEDIUM)
+                      + '| {:.2f}x'.format(times['per-key'] / times['flat']).ljust(Columns.SMALL) + '| {:.1e}'.format(max_difference))
+    Ctp.exit_section()
+
+
+# Byzantine-robust aggregations of the benchmark (for 2 Byzantine clients), with the mean and the median as references: name, aggregation
+# function and minimal number of clients
+robust_aggregations = [('mean', federated_averaging, 1), ('median', federated_median, 1), ('krum', federated_krum_2, 7),
+                       ('multi-krum', federated_multi_krum_2, 7), ('bulyan', federated_bulyan_2, 11),
+                       ('geometric median', federated_geometric_median, 1)]
+
+
+# Wall time of the Byzantine-robust aggregations for each number of clients, and error of the aggregated model. The honest clients' models
+# are random perturbations of the same model and the 2 Byzantine clients send that model scaled by -10 (as in a model canceling attack).
+# The error is the largest absolute difference between the parameters of the aggregated model and the mean of the honest models.
+def robust_aggregation_report(experiment: str, clients_counts: List[int], repeats: int) -> None:
+    Ctp.enter_section('Byzantine-robust aggregation report for the {}'.format(experiment), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, 1, 0, 1.))
+    architecture = SimpleAutoencoder if experiment == 'autoencoder' else BinaryClassifier
+    torch.manual_seed(0)
+    global_model = NormalizingModel(architecture(activation_function=params.activation_fn, hidden_layers=params.hidden_layers),
+                                    sub=torch.zeros(params.n_features), div=torch.ones(params.n_features))
+    Ctp.print('{} parameters per model'.format(sum(param.numel() for param in global_model.parameters())))
+
+    Ctp.print('Clients'.ljust(Columns.SMALL) + '| Aggregation'.ljust(Columns.LARGE) + '| Time (ms)'.ljust(Columns.MEDIUM) + '| Error', bold=True)
+    for n_clients in clients_counts:
+        models = [deepcopy(global_model) for _ in range(n_clients)]
+        with torch.no_grad():
+            for model in models[2:]:
+                for param in model.model.parameters():
+                    param.add_(torch.randn_like(param), alpha=0.01)
+            for model in models[:2]:
+                for param in model.model.parameters():
+                    param.mul_(-10.)
+        honest_mean = deepcopy(global_model)
+        federated_averaging(honest_mean, models[2:])
+
+        for name, aggregation_function, n_min_clients in robust_aggregations:
+            if n_clients < n_min_clients:
+                continue
+            aggregated_model = deepcopy(global_model)
+            elapsed = float('inf')
+            for _ in range(repeats):
+                start_time = time()
+                aggregation_function(aggregated_model, models)
+                elapsed = min(elapsed, time() - start_time)
+            error = max((param - honest_param).abs().max().item() for param, honest_param
+                        in zip(aggregated_model.parameters(), honest_mean.parameters()))
+            Ctp.print(str(n_clients).ljust(Columns.SMALL) + '| {}'.format(name).ljust(Columns.LARGE)
+                      + '| {:.2f}'.format(elapsed * 1000).ljust(Columns.MEDIUM) + '| {:.1e}'.format(error))
+    Ctp.exit_section()
+
+
+# Model of a simulated client: a random perturbation of the global model, drawn from a generator seeded with the id of the client so that
+# the same clients can be simulated again
+def simulated_client_model(global_model: NormalizingModel, client_id: int) -> NormalizingModel:
+    generator = torch.Generator()
+    generator.manual_seed(client_id)
+    model = deepcopy(global_model)
+    with torch.no_grad():
+        for param in model.model.parameters():
+            param.add_(torch.randn(param.shape, generator=generator), alpha=0.01)
+    return model
+
+
+# Aggregation of the simulated clients with the aggregation function, all the models being resident at once (stacked), or folded into its
+# streaming counterpart one at a time (streaming). The aggregated parameters are sent back as a numpy array.
+def stacked_aggregation_path(global_model: NormalizingModel, aggregation_function: Callable, n_clients: int,
+                             output: multiprocessing.Queue) -> None:
+    tracker = StageMemoryTracker()
+    start_time = time()
+    aggregated_model = deepcopy(global_model)
+    tracker.run('Aggregation', lambda: aggregation_function(aggregated_model, [simulated_client_model(global_model, client_id)
+                                                                               for client_id in range(n_clients)]))
+    output.put((tracker.stages, time() - start_time, flatten_model(aggregated_model).numpy()))
+
+
+def streaming_aggregation_path(global_model: NormalizingModel, aggregation_function: Callable, n_clients: int,
+                               output: multiprocessing.Queue) -> None:
+    tracker = StageMemoryTracker()
+    start_time = time()
+    aggregated_model = deepcopy(global_model)
+    aggregator = get_streaming_aggregator(aggregation_function)
+
+    def aggregate() -> None:
+        for client_id in range(n_clients):
+            aggregator.add(simulated_client_model(global_model, client_id))
+        aggregator.aggregate_into(aggregated_model)
+
+    tracker.run('Aggregation', aggregate)
+    output.put((tracker.stages, time() - start_time, flatten_model(aggregated_model).numpy()))
+
+
+# Aggregations of the streaming benchmark: name and aggregation function
+streamed_aggregations = [('mean', federated_averaging), ('trimmed mean 2', federated_trimmed_mean_2), ('median', federated_median)]
+
+
+# Wall time and peak memory of the aggregation of many simulated clients (whose models are generated on the fly), with all the models
+# resident at once and with the streaming aggregators, along with the largest absolute difference between the aggregated parameters.
+# Each aggregation is run in its own process (see run_in_process), so that the peak memory of one does not hide the one of the other.
+def streaming_report(experiment: str, clients_counts: List[int]) -> None:
+    Ctp.enter_section('Streaming aggregation report for the {}'.format(experiment), Color.YELLOW)
+    params = SimpleNamespace(**get_thinning_params(experiment, 1, 0, 1.))
+    architecture = SimpleAutoencoder if experiment == 'autoencoder' else BinaryClassifier
+    torch.manual_seed(0)
+    global_model = NormalizingModel(architecture(activation_function=params.activation_fn, hidden_layers=params.hidden_layers),
+                                    sub=torch.zeros(params.n_features), div=torch.ones(params.n_features))
+    Ctp.print('{} parameters per model, median rank error of the streaming median: {:.3f} (95% confidence)'
+              .format(sum(param.numel() for param in global_model.parameters()), median_rank_error(256)))
+
+    Ctp.print('Clients'.ljust(Columns.SMALL) + '| Aggregation'.ljust(Columns.MEDIUM) + '| Stacked (s, MB)'.ljust(Columns.LARGE)
+              + '| Streaming (s, MB)'.ljust(Columns.LARGE) + '| Max difference', bold=True)
+    for n_clients in clients_counts:
+        for name, aggregation_function in streamed_aggregations:
+            results = {}
+            for mode, path in [('stacked', stacked_aggregation_path), ('streaming', streaming_aggregation_path)]:
+                results[mode] = run_in_process(path, global_model, aggregation_function, n_clients)
+            max_difference = np.abs(results['stacked'][2] - results['streaming'][2]).max()
+            Ctp.print(str(n_clients).ljust(Columns.SMALL) + '| {}'.format(name).ljust(Columns.MEDIUM)
+                      + ''.join('| {:.2f}, {:.1f}'.format(elapsed, stages[0][1] / 2 ** 20).ljust(Columns.LARGE)
+                                for stages, elapsed, _ in [results['stacked'], results['streaming']])
+                      + '| {:.1e}'.format(max_difference))
+    Ctp.exit_section()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    memory_parser = subparsers.add_parser('memory', help='Peak memory per stage of the data path, before and after the float32 zero-copy path')
+    memory_parser.add_argument('--device', dest='device_id', type=int, default=0, help='Id of the device whose data is used')
+    memory_parser.add_argument('--samples-per-device', dest='samples_per_device', type=int, default=100_000)
+    memory_parser.add_argument('--benign-prop', dest='benign_prop', type=float, default=0.0787)
+
+    thinning_parser = subparsers.add_parser('thinning', help='Detection metrics and wall time with the full and the thinned training sets')
+    thinning_parser.add_argument('experiment', help='Experiment to run (classifier or autoencoder)')
+    thinning_parser.add_argument('--device', dest='device_id', type=int, default=0, help='Id of the device of the client')
+    thinning_parser.add_argument('--test-device', dest='test_device_id', type=int, default=1, help='Id of the new device used for testing')
+    thinning_parser.add_argument('--ratio', type=float, default=0.1, help='Proportion of the training rows kept by the thinning')
+    thinning_parser.add_argument('--epochs', type=int, default=None, help='Number of epochs (by default the one of main.py)')
+    thinning_parser.add_argument('--samples-per-device', dest='samples_per_device', type=int, default=100_000)
+
+    batched_parser = subparsers.add_parser('batched', help='Wall time of the clients\' training, one after the other and batched together')
+    batched_parser.add_argument('experiment', help='Experiment to run (classifier or autoencoder)')
+    batched_parser.add_argument('--clients', dest='n_clients', type=int, default=8, help='Number of clients (one synthetic device each)')
+    batched_parser.add_argument('--rows-per-key', dest='rows_per_key', type=int, default=2000)
+    batched_parser.add_argument('--epochs', type=int, default=1)
+    batched_parser.add_argument('--repeats', type=int, default=2)
+
+    fedsgd_parser = subparsers.add_parser('fedsgd', help='Steps per second of FedSGD with the per-model path and with the flat buffers')
+    fedsgd_parser.add_argument('experiment', help='Experiment to run (classifier or autoencoder)')
+    fedsgd_parser.add_argument('--clients', dest='n_clients', type=int, default=8, help='Number of clients (one synthetic device each)')
+    fedsgd_parser.add_argument('--rows-per-key', dest='rows_per_key', type=int, default=2000)
+    fedsgd_parser.add_argument('--batch-size', dest='batch_size', type=int, default=8)
+
+    prenormalized_parser = subparsers.add_parser('prenormalized', help='Wall time of a client\'s training and test, with the rows normalized '
+                                                                       'in each batch and normalized once')
+    prenormalized_parser.add_argument('experiment', help='Experiment to run (classifier or autoencoder)')
+    prenormalized_parser.add_argument('--rows-per-key', dest='rows_per_key', type=int, default=2000)
+    prenormalized_parser.add_argument('--epochs', type=int, default=5)
+    prenormalized_parser.add_argument('--repeats', type=int, default=2)
+
+    execution_parser = subparsers.add_parser('execution', help='Training and test throughput, and accuracy, of the compiled and bfloat16 '
+                                                               'execution modes')
+    execution_parser.add_argument('experiment', help='Experiment to run (classifier or autoencoder)')
+    execution_parser.add_argument('--rows-per-key', dest='rows_per_key', type=int, default=2000)
+    execution_parser.add_argument('--epochs', type=int, default=5)
+    execution_parser.add_argument('--repeats', type=int, default=3)
+
+    aggregation_parser = subparsers.add_parser('aggregation', help='Wall time of the aggregations with the per-key and the flat aggregations, '
+                                                                   'from a few clients to many simulated clients')
+    aggregation_parser.add_argument('experiment', help='Experiment whose architecture is used (classifier or autoencoder)')
+    aggregation_parser.add_argument('--clients', dest='clients_counts', type=int, nargs='+', default=[8, 32, 128, 512, 1000],
+                                    help='Numbers of simulated clients')
+    aggregation_parser.add_argument('--repeats', type=int, default=3)
+
+    robust_parser = subparsers.add_parser('robust', help='Wall time and error of the Byzantine-robust aggregations, from a few clients to '
+                                                         'many simulated clients')
+    robust_parser.add_argument('experiment', help='Experiment whose architecture is used (classifier or autoencoder)')
+    robust_parser.add_argument('--clients', dest='clients_counts', type=int, nargs='+', default=[8, 32, 128, 512],
+                               help='Numbers of simulated clients')
+    robust_parser.add_argument('--repeats', type=int, default=3)
+
+    streaming_parser = subparsers.add_parser('streaming', help='Wall time and peak memory of the aggregation of many simulated clients, '
+                                                               'with all the models resident and with the streaming aggregators')
+    streaming_parser.add_argument('experiment', help='Experiment whose architecture is used (classifier or autoencoder)')
+    streaming_parser.add_argument('--clients', dest='clients_counts', type=int, nargs='+', default=[1000, 4000],
+                                  help='Numbers of simulated clients')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'memory':
+        memory_report(args.device_id, args.samples_per_device, args.benign_prop)
+    elif args.benchmark == 'thinning':
+        thinning_report(args.experiment, args.device_id, args.test_device_id, args.ratio, args.epochs, args.samples_per_device)
+    elif args.benchmark == 'batched':
+        batched_report(args.experiment, args.n_clients, args.rows_per_key, args.epochs, args.repeats)
+    elif args.benchmark == 'fedsgd':
+        fedsgd_report(args.experiment, args.n_clients, args.rows_per_key, args.batch_size)
+    elif args.benchmark == 'prenormalized':
+        prenormalized_report(args.experiment, args.rows_per_key, args.epochs, args.repeats)
+    elif args.benchmark == 'execution':
+        execution_report(args.experiment, args.rows_per_key, args.epochs, args.repeats)
+    elif args.benchmark == 'aggregation':
+        aggregation_report(args.experiment, args.clients_counts, args.repeats)
+    elif args.benchmark == 'robust':
+        robust_aggregation_report(args.experiment, args.clients_counts, args.repeats)
+    elif args.benchmark == 'streaming':
+        streaming_report(args.experiment, args.clients_counts)
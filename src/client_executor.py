@@ -0,0 +1,190 @@
+import traceback
+from collections import OrderedDict
+from copy import deepcopy
+from typing import List, Callable, Any, Optional, Dict
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+from context_printer import Color
+from context_printer import ContextPrinter as Ctp
+from torch.utils.data import Dataset
+
+from execution import execution_mode
+from normalized_data import normalized_data_cache
+from print_util import ClientPrinter
+from tensor_datasets import TensorDataLoader, get_n_samples
+
+
+# Moves the tensors of a dataset (ResampledDataset or CompactDataset) to shared memory, so that they are passed to the workers as
+# handles instead of being pickled
+def share_dataset(dataset: Dataset) -> None:
+    for value in vars(dataset).values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(tensor, torch.Tensor):
+                tensor.share_memory_()
+
+
+# Replays the draws from the global generator of n_passes passes over a dataloader (the seed of each iterator and, when shuffling, the
+# seed of its permutation, see TensorDataLoader), without going through the passes themselves
+def skip_dataloader_draws(dataloader: TensorDataLoader, n_passes: int) -> None:
+    for _ in range(n_passes):
+        next(iter(dataloader), None)
+
+
+# Loop of a worker process: the datasets are received once and kept (by their key) until the executor tells the worker to forget them,
+# and each task runs function(model, dataloader, *args) with the global generator in the given state. Only the result of the function
+# and, if requested, the state dict of the model (as numpy arrays) are sent back. The worker keeps its own normalized copies of the datasets
+# if the normalized data cache of the executor's process is enabled, and runs the models in the same execution mode (see execution.py).
+def worker_loop(task_queue: mp.SimpleQueue, result_queue: mp.SimpleQueue, n_threads: int, prenormalized_datasets: bool,
+                execution_settings: tuple) -> None:
+    torch.set_num_threads(n_threads)
+    normalized_data_cache.set_enabled(prenormalized_datasets)
+    execution_mode.configure(*execution_settings)
+    Ctp.deactivate()
+    datasets = {}
+    while True:
+        task = task_queue.get()
+        if task[0] == 'stop':
+            break
+        elif task[0] == 'dataset':
+            datasets[task[1]] = task[2]
+        elif task[0] == 'forget':
+            del datasets[task[1]]
+        else:
+            _, task_id, function, model, dataset_key, batch_size, shuffle, args, rng_state, return_state_dict = task
+            try:
+                torch.set_rng_state(torch.from_numpy(rng_state))
+                result = function(model, TensorDataLoader(datasets[dataset_key], batch_size, shuffle), *args)
+                state_dict = {key: value.numpy() for key, value in model.state_dict().items()} if return_state_dict else None
+                result_queue.put((task_id, result, state_dict, None))
+            except Exception:
+                result_queue.put((task_id, None, None, traceback.format_exc()))
+
+
+# Runs a function on the (model, dataloader) pair of each client in a pool of worker processes, each one using a share of the CPU
+# threads. The datasets are moved to shared memory and sent once to the worker that handles their client (the clients are assigned to
+# the workers by their position, so that a client stays on the same worker from one round to the next), then only the models, the
+# results and the state dicts travel between the processes. The workers are started when the executor is first used.
+# In deterministic mode, each task starts with the global generator in the state it would have if the clients were processed one after
+# the other in this process, and the workers use as many threads as this process, so that the results are the same as with the sequential
+# loops. Otherwise, each task is seeded with a number drawn from the global generator, and the threads are split between the workers.
+class ClientExecutor:
+    def __init__(self, n_workers: int = 0, deterministic: bool = True, max_datasets: int = 64) -> None:
+        self.n_workers = n_workers
+        self.deterministic = deterministic
+        self.max_datasets = max_datasets  # Maximum number of datasets kept by each worker
+        self.workers = []
+        self.task_queues = []
+        self.result_queue = None
+        self.sent_datasets = []
+
+    # Changes the number of workers (0 to run the clients sequentially in this process) and the mode, restarting the workers if needed
+    def configure(self, n_workers: int, deterministic: bool = True) -> None:
+        if (n_workers, deterministic) != (self.n_workers, self.deterministic):
+            self.shutdown()
+        self.n_workers = n_workers
+        self.deterministic = deterministic
+
+    # Whether the executor can run the clients of these dataloaders (only the tensor datasets can be shared with the workers)
+    def is_active(self, dataloaders: list) -> bool:
+        return self.n_workers > 0 and len(dataloaders) > 1 and all(isinstance(dataloader, TensorDataLoader) for dataloader in dataloaders)
+
+    def __start(self) -> None:
+        context = mp.get_context('spawn')
+        n_threads = torch.get_num_threads() if self.deterministic else max(1, torch.get_num_threads() // self.n_workers)
+        self.result_queue = context.SimpleQueue()
+        for _ in range(self.n_workers):
+            task_queue = context.SimpleQueue()
+            execution_settings = (execution_mode.compile_mode, execution_mode.bf16_autocast)
+            worker = context.Process(target=worker_loop, daemon=True, args=(task_queue, self.result_queue, n_threads,
+                                                                            normalized_data_cache.enabled, execution_settings))
+            worker.start()
+            self.workers.append(worker)
+            self.task_queues.append(task_queue)
+            self.sent_datasets.append(OrderedDict())
+
+    def shutdown(self) -> None:
+        for task_queue in self.task_queues:
+            task_queue.put(('stop',))
+        for worker in self.workers:
+            worker.join()
+        self.workers, self.task_queues, self.result_queue, self.sent_datasets = [], [], None, []
+
+    # Sends the dataset to the worker if it does not have it yet. The executor keeps a reference to each dataset sent, so that its id
+    # (the key of the dataset) cannot be reused by another dataset while the worker keeps it.
+    def __send_dataset(self, worker_id: int, dataset: Dataset) -> int:
+        sent_datasets = self.sent_datasets[worker_id]
+        dataset_key = id(dataset)
+        if dataset_key in sent_datasets:
+            sent_datasets.move_to_end(dataset_key)
+            return dataset_key
+
+        share_dataset(dataset)
+        self.task_queues[worker_id].put(('dataset', dataset_key, dataset))
+        sent_datasets[dataset_key] = dataset
+        while len(sent_datasets) > self.max_datasets:
+            forgotten_key, _ = sent_datasets.popitem(last=False)
+            self.task_queues[worker_id].put(('forget', forgotten_key))
+        return dataset_key
+
+    def __get_rng_state(self, dataloader: TensorDataLoader, n_passes: int) -> np.ndarray:
+        if self.deterministic:
+            rng_state = torch.get_rng_state().numpy()
+            skip_dataloader_draws(dataloader, n_passes)
+        else:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            rng_state = generator.get_state().numpy()
+        return rng_state
+
+    # Returns function(model, dataloader, *client_args) for each client, where client_args is the client's tuple in clients_args (if
+    # specified). n_passes is the number of passes the function makes over the dataloader (needed to replay its random draws in
+    # deterministic mode). If update_models is set, the models are updated with the state dicts of the models after the function.
+    def map(self, function: Callable[..., Any], models: List[nn.Module], dataloaders: List[TensorDataLoader],
+            clients_args: Optional[List[tuple]] = None, n_passes: int = 1, update_models: bool = False) -> List[Any]:
+        if not self.workers:
+            self.__start()
+        if clients_args is None:
+            clients_args = [()] * len(models)
+
+        sent_models = []
+        for task_id, (model, dataloader, args) in enumerate(zip(models, dataloaders, clients_args)):
+            worker_id = task_id % self.n_workers
+            dataset_key = self.__send_dataset(worker_id, dataloader.dataset)
+            rng_state = self.__get_rng_state(dataloader, n_passes)
+            sent_models.append(deepcopy(model))  # Kept until the results are received, since its tensors are shared with the worker
+            self.task_queues[worker_id].put(('run', task_id, function, sent_models[-1], dataset_key, dataloader.batch_size,
+                                             dataloader.shuffle, args, rng_state, update_models))
+
+        results = [None] * len(models)
+        state_dicts: Dict[int, Optional[dict]] = {}
+        errors = []
+        for _ in range(len(models)):
+            task_id, result, state_dict, error = self.result_queue.get()
+            if error is not None:
+                errors.append(error)
+            results[task_id] = result
+            state_dicts[task_id] = state_dict
+        if errors:
+            raise RuntimeError('A client failed in a worker process:\n' + errors[0])
+
+        if update_models:
+            for task_id, model in enumerate(models):
+                model.load_state_dict({key: torch.from_numpy(value) for key, value in state_dicts[task_id].items()})
+        return results
+
+
+# Executor shared by the training and testing loops. It runs the clients sequentially until it is configured with workers.
+client_executor = ClientExecutor()
+
+
+# Prints the output of the clients of a multitrain, multitest or thresholds loop run by the executor, as the sequential loop would: the
+# output recorded by each client's task (see print_util.ClientPrinter) is replayed in the section of the client, in the order of the clients
+def print_client_outputs(clients: List[tuple], printers: List[ClientPrinter]) -> None:
+    for i, ((title, dataloader), printer) in enumerate(zip((client[:2] for client in clients), printers)):
+        Ctp.enter_section('[{}/{}] '.format(i + 1, len(clients)) + title + ' ({} samples)'.format(get_n_samples(dataloader)),
+                          color=Color.NONE, header='      ')
+        printer.replay()
+        Ctp.exit_section()
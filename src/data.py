@@ -1,10 +1,14 @@
-from typing import Tuple, Dict, List, Callable
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from time import time
+from typing import Tuple, Dict, List, Callable, Optional
 
 import numpy as np
 import pandas as pd
 from context_printer import Color
 from context_printer import ContextPrinter as Ctp
-from sklearn.model_selection import KFold
 
 all_devices = ['Danmini_Doorbell',
                'Ecobee_Thermostat',
@@ -32,6 +36,10 @@ mirai_paths = [{device: data_path + device + '/mirai_attacks/' + attack + '.csv'
 gafgyt_paths = [{device: data_path + device + '/gafgyt_attacks/' + attack + '.csv' for device in all_devices}
                 for attack in gafgyt_attacks]
 
+# Binary float32 copies of the CSVs (one .npy file per device and traffic key), along with a manifest per device recording the size and
+# modification time of the CSVs they were converted from
+cache_path = data_path + 'cache/'
+
 multiclass_labels = {**{'benign': 0.},
                      **{'mirai_' + attack: float(i+1) for i, attack in enumerate(mirai_attacks)},
                      **{'gafgyt_' + attack: float(i+6) for i, attack in enumerate(gafgyt_attacks)}}
@@ -41,31 +49,232 @@ ClientData = List[DeviceData]
 FederationData = List[ClientData]
 
 
-def device_names(device_ids: List[int]) -> str:
-    return ', '.join([all_devices[device_id] for device_id in device_ids])
+# devices is the list of the names of all the devices (all_devices for N-BaIoT, see params.devices in main.py)
+def device_names(devices: List[str], device_ids: List[int]) -> str:
+    return ', '.join([devices[device_id] for device_id in device_ids])
+
+
+# Returns the path of the CSV file of each traffic key (benign, mirai attacks if applicable and gafgyt attacks) of a device
+def get_device_csv_paths(device: str) -> Dict[str, str]:
+    csv_paths = {'benign': benign_paths[device]}
+    if device in mirai_devices:
+        csv_paths.update({'mirai_' + attack: attack_paths[device] for attack, attack_paths in zip(mirai_attacks, mirai_paths)})
+    csv_paths.update({'gafgyt_' + attack: attack_paths[device] for attack, attack_paths in zip(gafgyt_attacks, gafgyt_paths)})
+    return csv_paths
+
+
+def get_cache_array_path(device: str, key: str) -> str:
+    return cache_path + device + '/' + key + '.npy'
+
+
+def get_cache_manifest_path(device: str) -> str:
+    return cache_path + device + '/manifest.json'
+
+
+# Size and modification time of a source file, used to detect whether its cached copy is stale
+def get_source_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_cache_manifest(device: str) -> dict:
+    manifest_path = get_cache_manifest_path(device)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as infile:
+        return json.load(infile)
+
+
+def write_cache_manifest(device: str, manifest: dict) -> None:
+    manifest_path = get_cache_manifest_path(device)
+    # Write to a temporary file first so that concurrent readers never see a partially written manifest
+    with open(manifest_path + '.tmp', 'w') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
 
 
-def read_device_data(device_id: int) -> DeviceData:
+def is_cache_fresh(manifest: dict, device: str, key: str, csv_path: str) -> bool:
+    entry = manifest.get(key)
+    return entry is not None and entry['source'] == csv_path and entry['signature'] == get_source_signature(csv_path) \
+        and os.path.exists(get_cache_array_path(device, key))
+
+
+def read_csv_array(csv_path: str) -> np.ndarray:
+    # The models work in float32 anyway so we cast right away, which halves the memory used by the data
+    return pd.read_csv(csv_path).to_numpy(dtype=np.float32)
+
+
+# Converts the CSV file of one traffic key of a device into a binary .npy file and returns the corresponding manifest entry
+def cache_traffic_data(device: str, key: str, csv_path: str) -> dict:
+    arr = read_csv_array(csv_path)
+    array_path = get_cache_array_path(device, key)
+    with open(array_path + '.tmp', 'wb') as outfile:
+        np.save(outfile, arr)
+    os.replace(array_path + '.tmp', array_path)
+    return {'source': csv_path, 'signature': get_source_signature(csv_path), 'shape': list(arr.shape), 'dtype': str(arr.dtype)}
+
+
+# One-time conversion of the CSVs of a device into the binary cache. Only the stale or missing files are converted again.
+def cache_device_data(device_id: int, force: bool = False) -> None:
+    device = all_devices[device_id]
+    os.makedirs(cache_path + device, exist_ok=True)
+    manifest = read_cache_manifest(device)
+    n_converted = 0
+    for key, csv_path in get_device_csv_paths(device).items():
+        if force or not is_cache_fresh(manifest, device, key, csv_path):
+            manifest[key] = cache_traffic_data(device, key, csv_path)
+            n_converted += 1
+    if n_converted > 0:
+        write_cache_manifest(device, manifest)
+    Ctp.print('[{}/{}] {}: {} file(s) converted'.format(device_id + 1, len(all_devices), device, n_converted))
+
+
+def cache_all_data(force: bool = False) -> None:
+    Ctp.enter_section('Converting the data to the binary cache', Color.YELLOW)
+    for device_id in range(len(all_devices)):
+        cache_device_data(device_id, force=force)
+    Ctp.exit_section()
+
+
+# Reads the data of a device. The arrays are memory-mapped from the binary cache (so that the OS only loads the pages that are actually
+# used and shares them between concurrent processes), and the cache is (re)built from the CSVs if it is missing or stale.
+# If use_cache is set to False the CSVs are parsed directly and the cache is neither read nor written.
+def read_device_data(device_id: int, use_cache: bool = True) -> DeviceData:
     Ctp.print('[{}/{}] Data from '.format(device_id + 1, len(all_devices)) + all_devices[device_id])
     device = all_devices[device_id]
-    device_data = {'benign': pd.read_csv(benign_paths[device]).to_numpy()}
-    if device in mirai_devices:
-        device_data.update({'mirai_' + attack: pd.read_csv(attack_paths[device]).to_numpy()
-                            for attack, attack_paths in zip(mirai_attacks, mirai_paths)})
+    csv_paths = get_device_csv_paths(device)
+    if not use_cache:
+        return {key: read_csv_array(csv_path) for key, csv_path in csv_paths.items()}
+
+    manifest = read_cache_manifest(device)
+    if not all(is_cache_fresh(manifest, device, key, csv_path) for key, csv_path in csv_paths.items()):
+        Ctp.print('The binary cache is missing or stale, converting the CSVs')
+        cache_device_data(device_id)
 
-    device_data.update({'gafgyt_' + attack: pd.read_csv(attack_paths[device]).to_numpy()
-                        for attack, attack_paths in zip(gafgyt_attacks, gafgyt_paths)})
-    return device_data
+    return {key: np.load(get_cache_array_path(device, key), mmap_mode='r') for key in csv_paths.keys()}
 
 
-def read_all_data() -> List[DeviceData]:
+# Reads (or converts to the binary cache if use_cache is set) a single traffic file. This is the unit of work of the parallel ingestion,
+# so it returns either the array or the manifest entry, along with the time it took.
+def read_traffic_file(device: str, key: str, csv_path: str, use_cache: bool) -> Tuple[Optional[np.ndarray], Optional[dict], float]:
+    start_time = time()
+    if use_cache:
+        arr, manifest_entry = None, cache_traffic_data(device, key, csv_path)
+    else:
+        arr, manifest_entry = read_csv_array(csv_path), None
+    return arr, manifest_entry, time() - start_time
+
+
+def print_file_timings(timings: Dict[Tuple[int, str], float]) -> None:
+    Ctp.enter_section('Per-file reading times (slowest first)', Color.NONE)
+    for (device_id, key), elapsed in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        Ctp.print('{:.2f}s: '.format(elapsed) + all_devices[device_id] + ' ' + key)
+    Ctp.print('Total: {:.2f}s over {} files'.format(sum(timings.values()), len(timings)))
+    Ctp.exit_section()
+
+
+# Reads the data of all devices using a pool of n_workers processes, each of which parses one (device, traffic key) file at a time.
+# When use_cache is set the workers only convert the missing or stale files to the binary cache, and the arrays are then memory-mapped
+# by this process, so that no array has to be sent back from the workers.
+def read_all_data_parallel(use_cache: bool, n_workers: int, device_ids: List[int]) -> List[DeviceData]:
+    Ctp.enter_section('Reading data with {} workers'.format(n_workers), Color.YELLOW)
+    devices_csv_paths = [get_device_csv_paths(device) for device in all_devices]
+    manifests = [read_cache_manifest(device) if use_cache else {} for device in all_devices]
+    data = [{} for _ in all_devices]
+    timings = {}
+
+    pending_files = []
+    for device_id, (device, csv_paths) in enumerate(zip(all_devices, devices_csv_paths)):
+        if device_id not in device_ids:
+            continue
+        if use_cache:
+            os.makedirs(cache_path + device, exist_ok=True)
+        pending_files += [(device_id, key, csv_path) for key, csv_path in csv_paths.items()
+                          if not (use_cache and is_cache_fresh(manifests[device_id], device, key, csv_path))]
+
+    n_pending = [0 for _ in all_devices]
+    for device_id, _, _ in pending_files:
+        n_pending[device_id] += 1
+
+    n_read_devices = 0
+
+    # Once all the files of a device are read, the device's data is assembled in the usual key order
+    def finish_device(finished_device_id: int) -> None:
+        nonlocal n_read_devices
+        n_read_devices += 1
+        device = all_devices[finished_device_id]
+        Ctp.print('[{}/{}] Data from '.format(n_read_devices, len(device_ids)) + device)
+        csv_paths = devices_csv_paths[finished_device_id]
+        if use_cache:
+            write_cache_manifest(device, manifests[finished_device_id])
+            data[finished_device_id] = {key: np.load(get_cache_array_path(device, key), mmap_mode='r') for key in csv_paths.keys()}
+        else:
+            data[finished_device_id] = {key: data[finished_device_id][key] for key in csv_paths.keys()}
+
+    for device_id in device_ids:
+        if n_pending[device_id] == 0:
+            finish_device(device_id)
+
+    if len(pending_files) > 0:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(read_traffic_file, all_devices[device_id], key, csv_path, use_cache): (device_id, key)
+                       for device_id, key, csv_path in pending_files}
+            for future in as_completed(futures):
+                device_id, key = futures[future]
+                arr, manifest_entry, elapsed = future.result()
+                timings[(device_id, key)] = elapsed
+                if use_cache:
+                    manifests[device_id][key] = manifest_entry
+                else:
+                    data[device_id][key] = arr
+
+                n_pending[device_id] -= 1
+                if n_pending[device_id] == 0:
+                    finish_device(device_id)
+
+        print_file_timings(timings)
+
+    Ctp.exit_section()
+    return data
+
+
+# Reads the data of the devices in device_ids (all devices by default). The data of the other devices is left empty, so that the
+# returned list can still be indexed by device id.
+def read_all_data(use_cache: bool = True, n_workers: int = 1, device_ids: Optional[List[int]] = None) -> List[DeviceData]:
+    if device_ids is None:
+        device_ids = list(range(len(all_devices)))
+
+    if n_workers > 1:
+        return read_all_data_parallel(use_cache, n_workers, device_ids)
+
     Ctp.enter_section('Reading data', Color.YELLOW)
-    data = [read_device_data(device_id) for device_id in range(len(all_devices))]
+    data = [read_device_data(device_id, use_cache=use_cache) if device_id in device_ids else {} for device_id in range(len(all_devices))]
     Ctp.exit_section()
     return data
 
 
+# Returns the sorted list of the devices whose data is used (by a client or as a test device) in at least one of the configurations
+def get_required_devices(configurations: List[Dict[str, list]]) -> List[int]:
+    required_devices = set()
+    for configuration in configurations:
+        for client_devices in configuration['clients_devices']:
+            required_devices.update(client_devices)
+        required_devices.update(configuration['test_devices'])
+    return sorted(required_devices)
+
+
+# Reads the data of the devices used by the configurations only. The files of these devices are read in full: the sampling budget
+# (samples_per_device) is only applied afterwards, when the datasets are resampled.
+def read_required_data(configurations: List[Dict[str, list]], use_cache: bool = True, n_workers: int = 1) -> List[DeviceData]:
+    device_ids = get_required_devices(configurations)
+    Ctp.print('Devices required by the configurations: ' + device_names(all_devices, device_ids))
+    return read_all_data(use_cache=use_cache, n_workers=n_workers, device_ids=device_ids)
+
+
 def get_client_data(all_data: List[DeviceData], client_devices: List[int]) -> ClientData:
+    for device_id in client_devices:
+        if len(all_data[device_id]) == 0:
+            raise ValueError('The data of device {} was not loaded'.format(device_id))
     return [all_data[device_id] for device_id in client_devices]
 
 
@@ -102,18 +311,40 @@ def split_client_data(data: ClientData, p_second_split: float, p_unused: float)
     return train_data, test_data
 
 
+# Plans the folds of a cross validation, exactly like sklearn's KFold without shuffling: the validation sets are contiguous blocks, and the
+# first (n_samples % n_splits) folds have one more sample than the others. The boundaries only depend on the length of the array and on the
+# number of splits, so they are memoized across folds, hyper-parameter sets and clients.
+@lru_cache(maxsize=None)
+def get_fold_boundaries(n_samples: int, n_splits: int) -> Tuple[Tuple[int, int], ...]:
+    if n_splits > n_samples:
+        raise ValueError('Cannot have number of splits n_splits={} greater than the number of samples: n_samples={}'.format(n_splits, n_samples))
+    fold_sizes = np.full(n_splits, n_samples // n_splits, dtype=int)
+    fold_sizes[:n_samples % n_splits] += 1
+    stops = np.cumsum(fold_sizes)
+    return tuple((int(stop - size), int(stop)) for size, stop in zip(fold_sizes, stops))
+
+
+# Returns the array without its rows [start, stop). The result is a view when the removed block is at one end of the array,
+# otherwise both remaining blocks are copied once into a single new array.
+def remove_rows(array: np.ndarray, start: int, stop: int) -> np.ndarray:
+    if start == 0:
+        return array[stop:]
+    if stop == len(array):
+        return array[:start]
+    return np.concatenate((array[:start], array[stop:]), axis=0)
+
+
 def split_client_data_current_fold(train_val_data: ClientData, n_splits: int, fold: int) \
         -> Tuple[ClientData, ClientData]:
 
-    kf = KFold(n_splits=n_splits)
     train_data, val_data = [], []
     for device_id, device_data in enumerate(train_val_data):
         train_data.append({})
         val_data.append({})
         for key, array in device_data.items():
-            train_index, val_index = list(kf.split(array))[fold]
-            train_data[device_id][key] = array[train_index]
-            val_data[device_id][key] = array[val_index]
+            start, stop = get_fold_boundaries(len(array), n_splits)[fold]
+            train_data[device_id][key] = remove_rows(array, start, stop)
+            val_data[device_id][key] = array[start:stop]
 
     return train_data, val_data
 
@@ -139,23 +370,26 @@ def get_benign_attack_samples_per_device(p_split: float, benign_prop: float, sam
     return benign_samples_per_device, attack_samples_per_device
 
 
-# Select n_samples rows from a numpy array, using either upsampling or downsampling.
-def resample_array(arr: np.ndarray, n_samples: int) -> np.ndarray:
+# Indexes of the n_samples rows selected from an array of n_rows rows, using either upsampling or downsampling.
+def resample_indexes(n_rows: int, n_samples: int) -> np.ndarray:
     # Compute the proportion between desired number of samples and input array's length
-    alpha = n_samples / len(arr)
+    alpha = n_samples / n_rows
 
-    # Repeat the original array as many times as possible (integer number of times)
+    # Repeat the indexes of the original array as many times as possible (integer number of times)
     repeats = int(alpha)
-    repeated_arr = arr.repeat(repeats, axis=0)
+    repeated_indexes = np.arange(n_rows, dtype=np.int32).repeat(repeats)
 
-    # Sample randomly without replacement the remaining samples
-    n_random_samples = n_samples - len(repeated_arr)
-    all_indexes = np.arange(len(arr))
-    np.random.seed(0)  # Fix the seed so that the resampling is not random (to have more meaningful results)
-    random_arr = arr[np.random.choice(all_indexes, n_random_samples, replace=False)]
-    np.random.seed(None)  # Reset the seed to a pseudo-random value so that the rest of the program is unaffected by the fixing of the seed
-    result = np.append(repeated_arr, random_arr, axis=0)
+    # Sample randomly without replacement the remaining indexes. The generator is local and has a fixed seed so that the resampling is
+    # not random (to have more meaningful results), without affecting the global seed used by the rest of the program.
+    n_random_samples = n_samples - len(repeated_indexes)
+    random_indexes = np.random.RandomState(0).choice(n_rows, n_random_samples, replace=False).astype(np.int32)
+    result = np.append(repeated_indexes, random_indexes)
 
     assert(len(result) == n_samples)
 
     return result
+
+
+# Select n_samples rows from a numpy array, using either upsampling or downsampling.
+def resample_array(arr: np.ndarray, n_samples: int) -> np.ndarray:
+    return arr[resample_indexes(len(arr), n_samples)]
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from typing import Callable, Union, Dict, TypeVar
+
+import torch
+from context_printer import ContextPrinter as Ctp
+# noinspection PyProtectedMember
+from torch.utils.data import Dataset
+
+from data import ClientData
+
+CachedValue = TypeVar('CachedValue', Dataset, Dict[str, Dataset])
+
+
+# Identifies the rows of a client's data without reading them: the splits are views of the arrays of the devices, so that the same split
+# of the same device is always the same memory (same address, shape and strides), whatever the run or the configuration
+def get_client_data_key(data: ClientData) -> tuple:
+    return tuple(tuple((key, arr.__array_interface__['data'][0], arr.shape, arr.strides, arr.dtype.str) for key, arr in device_data.items())
+                 for device_data in data)
+
+
+def get_nbytes(value: Union[Dataset, Dict[str, Dataset], torch.Tensor, tuple]) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    elif isinstance(value, (tuple, list)):
+        return sum(get_nbytes(item) for item in value)
+    elif isinstance(value, dict):
+        return sum(get_nbytes(item) for item in value.values())
+    else:  # Dataset holding its tensors as attributes
+        return sum(get_nbytes(item) for item in vars(value).values() if isinstance(item, (torch.Tensor, tuple)))
+
+
+# Cache of the datasets built from the clients' data, so that the datasets of a client are only built once for all the reruns of an
+# experiment (and for all the configurations in which the client appears), since the splits and the resampling are deterministic.
+# The least recently used datasets are evicted when the total size of the cached tensors exceeds max_bytes (0 disables the cache).
+# The entries keep a reference to the client's data, so that its memory cannot be reused by other arrays (which would then have the same key)
+# while the entry exists. The arrays of the client's data that are not views (the concatenated folds of the grid search for example) are
+# therefore counted in the size of the entry.
+class DatasetCache:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def set_max_bytes(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.__evict()
+
+    def __evict(self) -> None:
+        while self.n_bytes > self.max_bytes:
+            _, (_, _, n_bytes) = self.entries.popitem(last=False)
+            self.n_bytes -= n_bytes
+
+    # Returns the value built by build from the client's data with the given parameters, building it only if it is not cached
+    def get(self, data: ClientData, params: tuple, build: Callable[[], CachedValue]) -> CachedValue:
+        if self.max_bytes <= 0:
+            return build()
+
+        key = (get_client_data_key(data),) + params
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        self.misses += 1
+        value = build()
+        n_bytes = get_nbytes(value) + sum(arr.nbytes for device_data in data for arr in device_data.values() if arr.flags['OWNDATA'])
+        if n_bytes <= self.max_bytes:
+            self.entries[key] = (value, data, n_bytes)
+            self.n_bytes += n_bytes
+            self.__evict()
+        return value
+
+    def print_stats(self) -> None:
+        Ctp.print('Dataset cache: {} hits, {} misses, {} datasets cached ({:.1f} MB)'
+                  .format(self.hits, self.misses, len(self.entries), self.n_bytes / 2 ** 20))
+
+
+# Cache shared by the supervised and unsupervised datasets. It is disabled until it is given a size with set_max_bytes.
+dataset_cache = DatasetCache(max_bytes=0)
@@ -0,0 +1,57 @@
+from typing import Optional
+
+import torch.nn as nn
+from context_printer import ContextPrinter as Ctp
+
+from print_util import ClientPrinter
+
+
+# Stops a training when the monitored loss has not decreased by more than min_delta for patience consecutive epochs (or federation
+# rounds). If restore_best_weights is set, the weights of the model at the end of the best epoch are kept, so that the model can be set
+# back to them when the training stops. monitor is the loss followed by the local trainings: 'train' for the training loss of each epoch,
+# 'val' for the loss on a validation set when the training has one (the training loss is used otherwise).
+class EarlyStopping:
+    def __init__(self, patience: int, min_delta: float = 0., restore_best_weights: bool = False, monitor: str = 'train') -> None:
+        if monitor not in ['train', 'val']:
+            raise ValueError('Wrong value for monitor: ' + str(monitor))
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best_weights = restore_best_weights
+        self.monitor = monitor
+        self.best_loss = float('inf')
+        self.best_step = None  # Number of steps (epochs or rounds) made when the best loss was reached
+        self.n_steps = 0
+        self.n_steps_without_improvement = 0
+        self.best_state_dict = None
+
+    # Records the loss of a new epoch (or round) and returns True if the training should stop. A NaN loss never counts as an improvement.
+    # The message printed when the training stops goes through the printer of the client if specified (see print_util.ClientPrinter).
+    def step(self, loss: float, model: Optional[nn.Module] = None, printer: Optional[ClientPrinter] = None) -> bool:
+        self.n_steps += 1
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.best_step = self.n_steps
+            self.n_steps_without_improvement = 0
+            if self.restore_best_weights and model is not None:
+                self.best_state_dict = {key: value.detach().clone() for key, value in model.state_dict().items()}
+        else:
+            self.n_steps_without_improvement += 1
+
+        stop = self.n_steps_without_improvement >= self.patience
+        if stop:
+            (printer or ClientPrinter())(Ctp.print, 'Early stopping after {} steps without improvement (best loss {:.6f} at step {})'
+                                         .format(self.n_steps_without_improvement, self.best_loss, self.best_step))
+        return stop
+
+    # Sets the model back to the weights of the best epoch, if they were kept. Returns True if the model was restored.
+    def restore(self, model: nn.Module) -> bool:
+        if self.best_state_dict is None:
+            return False
+        model.load_state_dict(self.best_state_dict)
+        return True
+
+
+# Returns the early stopping described by config (the keyword arguments of EarlyStopping, see early_stopping and federated_early_stopping
+# in main.py), or None if config is None
+def get_early_stopping(config: Optional[dict]) -> Optional[EarlyStopping]:
+    return None if config is None else EarlyStopping(**config)
@@ -0,0 +1,65 @@
+import warnings
+import weakref
+from contextlib import nullcontext
+from typing import Optional, Callable, ContextManager
+
+import torch
+import torch.nn as nn
+from context_printer import ContextPrinter as Ctp
+
+from architectures import NormalizingModel
+
+
+# Compiles an inner model (a SimpleAutoencoder or a BinaryClassifier) with TorchScript ('script') or with torch.compile ('compile').
+# torch.compile is replaced by TorchScript on the versions of torch that do not have it. The compiled module shares its parameters with
+# the model, so that the optimizers, the aggregations and the flat buffers of flat_util keep working on the model itself.
+def compile_inner_model(model: nn.Module, compile_mode: str) -> Callable[[torch.Tensor], torch.Tensor]:
+    if compile_mode == 'compile' and hasattr(torch, 'compile'):
+        # The batch sizes differ (the last batch of an epoch, the test batches), so the shapes are compiled as dynamic from the start
+        return torch.compile(model, dynamic=True)
+    elif compile_mode in ['compile', 'script']:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)  # TorchScript is deprecated in the recent versions of torch
+            return torch.jit.script(model)
+    else:
+        raise ValueError('Wrong value for compile_models: ' + str(compile_mode))
+
+
+# Execution mode of the forward passes of the models in training and in inference: the inner models can be compiled (see
+# compile_inner_model) to cut the dispatch overhead of these small MLPs, and the forward passes and the losses can be computed under
+# bfloat16 autocast (the parameters, the gradients and the optimizer steps stay in float32). Each inner model is compiled the first time
+# it is used, and its compiled module is released with it. By default, the models are run as is, in float32.
+class ExecutionMode:
+    def __init__(self, compile_mode: Optional[str] = None, bf16_autocast: bool = False) -> None:
+        self.compile_mode = compile_mode
+        self.bf16_autocast = bf16_autocast
+        self.compiled_models = weakref.WeakKeyDictionary()
+
+    def configure(self, compile_mode: Optional[str], bf16_autocast: bool) -> None:
+        if compile_mode not in [None, 'script', 'compile']:
+            raise ValueError('Wrong value for compile_models: ' + str(compile_mode))
+        if bf16_autocast and not hasattr(torch, 'autocast'):
+            raise RuntimeError('bfloat16 autocast is not supported by this version of torch')
+        if compile_mode == 'compile' and not hasattr(torch, 'compile'):
+            Ctp.print('torch.compile is not available, the models are compiled with TorchScript instead')
+        self.compile_mode = compile_mode
+        self.bf16_autocast = bf16_autocast
+        self.compiled_models = weakref.WeakKeyDictionary()
+
+    # Returns the function to call on normalized rows instead of model.model
+    def inner_model(self, model: NormalizingModel) -> Callable[[torch.Tensor], torch.Tensor]:
+        if self.compile_mode is None:
+            return model.model
+        compiled_model = self.compiled_models.get(model.model)
+        if compiled_model is None:
+            compiled_model = compile_inner_model(model.model, self.compile_mode)
+            self.compiled_models[model.model] = compiled_model
+        return compiled_model
+
+    # Context in which the forward passes and the losses are computed
+    def autocast(self, device: torch.device) -> ContextManager:
+        return torch.autocast(device.type, dtype=torch.bfloat16) if self.bf16_autocast else nullcontext()
+
+
+# Execution mode shared by the training and testing loops, configured with the compile_models and bf16_autocast params of main.py
+execution_mode = ExecutionMode()
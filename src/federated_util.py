@@ -1,6 +1,6 @@
 from copy import deepcopy
 from types import SimpleNamespace
-from typing import List, Set, Tuple, Callable, Optional
+from typing import List, Set, Tuple, Callable, Optional, Dict
 
 import numpy as np
 import torch
@@ -12,28 +12,73 @@ from architectures import NormalizingModel
 from ml import set_models_sub_divs
 
 
-def federated_averaging(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+# A flat aggregation takes the parameters of the clients as the rows of a (n_clients, n_params) tensor and returns the aggregated row
+FlatAggregation = Callable[[torch.Tensor], torch.Tensor]
+
+
+# Flattens the state dict of a model into a row of parameters
+def flatten_model(model: torch.nn.Module) -> torch.Tensor:
+    return torch.cat([value.reshape(-1) for value in model.state_dict().values()])
+
+
+# Flattens the state dict of each model into a row of a (n_clients, n_params) tensor, in the order of the state dicts
+def flatten_models(models: List[torch.nn.Module]) -> torch.Tensor:
+    return torch.stack([flatten_model(model) for model in models])
+
+
+# Loads a row of flatten_models into the model
+def load_flat_params(model: torch.nn.Module, row: torch.Tensor) -> None:
+    state_dict = model.state_dict()
+    start = 0
+    for key, value in state_dict.items():
+        end = start + value.numel()
+        state_dict[key] = row[start:end].view(value.shape)
+        start = end
+    model.load_state_dict(state_dict)
+
+
+# The parameters of all the models are flattened once into a single tensor, reduced by a few vectorized operations over the clients,
+# and the result is scattered back into the global model
+def aggregate_flat(global_model: torch.nn.Module, models: List[torch.nn.Module], flat_aggregation: FlatAggregation) -> None:
     with torch.no_grad():
-        state_dict_mean = global_model.state_dict()
-        for key in state_dict_mean:
-            state_dict_mean[key] = torch.stack([model.state_dict()[key] for model in models], dim=-1).mean(dim=-1)
-        global_model.load_state_dict(state_dict_mean)
+        load_flat_params(global_model, flat_aggregation(flatten_models(models)))
+
+
+# The mean is taken over the last dimension of the (n_params, n_clients) transpose of the rows, which is the layout in which the
+# aggregations used to stack the state dicts, so that the results are the same
+def flat_averaging(rows: torch.Tensor) -> torch.Tensor:
+    return rows.t().contiguous().mean(dim=-1)
+
+
+# The median is selected with topk over the lower half of the values of each parameter (the n // 2 + 1 lowest ones, whose last two are the
+# middle values with an even number of clients) instead of sorting all the values
+def flat_median(rows: torch.Tensor) -> torch.Tensor:
+    n = len(rows)
+    lowest_values = torch.topk(rows, n // 2 + 1, dim=0, largest=False).values
+    if n % 2 == 1:
+        return lowest_values[-1]
+    return torch.stack([lowest_values[-2], lowest_values[-1]], dim=-1).mean(dim=-1)
+
+
+# Mean of the values of each parameter without the n_trimmed lowest and the n_trimmed highest ones. Instead of sorting the values, the
+# bounds of the kept values are selected with topk and the values are clamped to them: the trimmed values are then counted n_trimmed times
+# at each bound, which are subtracted from the sum (the outliers never enter the sum, so that they cannot swamp the kept values).
+def flat_trimmed_mean(rows: torch.Tensor, n_trimmed: int) -> torch.Tensor:
+    if n_trimmed == 0:
+        return flat_averaging(rows)
+    lower_bound = torch.topk(rows, n_trimmed + 1, dim=0, largest=False).values[-1]
+    upper_bound = torch.topk(rows, n_trimmed + 1, dim=0, largest=True).values[-1]
+    clamped_sum = torch.max(torch.min(rows, upper_bound), lower_bound).sum(dim=0)
+    return (clamped_sum - n_trimmed * (lower_bound + upper_bound)) / (len(rows) - 2 * n_trimmed)
+
+
+def federated_averaging(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, flat_averaging)
 
 
 # For 8 clients this is equivalent to federated trimmed mean 3
 def federated_median(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
-    n_excluded_down = (len(models) - 1) // 2
-    n_included = 2 if (len(models) % 2 == 0) else 1
-
-    with torch.no_grad():
-        state_dict_median = global_model.state_dict()
-        for key in state_dict_median:
-            # It seems that it's much faster to compute the median by manually sorting and narrowing onto the right element
-            # rather than using torch.median.
-            sorted_tensor, _ = torch.sort(torch.stack([model.state_dict()[key] for model in models], dim=-1), dim=-1)
-            trimmed_tensor = torch.narrow(sorted_tensor, -1, n_excluded_down, n_included)
-            state_dict_median[key] = trimmed_tensor.mean(dim=-1)
-        global_model.load_state_dict(state_dict_median)
+    aggregate_flat(global_model, models, flat_median)
 
 
 def federated_min_max(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
@@ -57,40 +102,149 @@ def federated_trimmed_mean_2(global_model: torch.nn.Module, models: List[torch.n
 
 
 def __federated_trimmed_mean(global_model: torch.nn.Module, models: List[torch.nn.Module], trim_num_up: int) -> None:
-    n = len(models)
-    n_remaining = n - 2 * trim_num_up
+    aggregate_flat(global_model, models, lambda rows: flat_trimmed_mean(rows, trim_num_up))
 
-    with torch.no_grad():
-        state_dict_result = global_model.state_dict()
-        for key in state_dict_result:
-            sorted_tensor, _ = torch.sort(torch.stack([model.state_dict()[key] for model in models], dim=-1), dim=-1)
-            trimmed_tensor = torch.narrow(sorted_tensor, -1, trim_num_up, n_remaining)
-            state_dict_result[key] = trimmed_tensor.mean(dim=-1)
-        global_model.load_state_dict(state_dict_result)
-
-
-# As defined in https://arxiv.org/pdf/2006.09365.pdf
-def s_resampling(models: List[torch.nn.Module], s: int) -> Tuple[List[torch.nn.Module], List[List[int]]]:
-    T = len(models)
-    c = [0 for _ in range(T)]
-    output_models = []
-    output_indexes = []
+
+# Squared euclidean distances between the rows, computed with a single cdist
+def squared_distances(rows: torch.Tensor) -> torch.Tensor:
+    return torch.cdist(rows, rows) ** 2
+
+
+# Krum scores of the rows whose squared distances are given (as defined in https://arxiv.org/abs/1703.02491): the sum of the squared
+# distances of each row to its n - n_byzantine - 2 closest other rows
+def krum_scores(sq_distances: torch.Tensor, n_byzantine: int) -> torch.Tensor:
+    n_neighbours = len(sq_distances) - n_byzantine - 2
+    sq_distances = sq_distances.clone().fill_diagonal_(float('inf'))
+    return torch.topk(sq_distances, n_neighbours, dim=1, largest=False).values.sum(dim=1)
+
+
+def check_n_clients(n_clients: int, n_min: int, name: str) -> None:
+    if n_clients < n_min:
+        raise ValueError('{} needs at least {} clients, got {}'.format(name, n_min, n_clients))
+
+
+# Multi-Krum: mean of the n_selected rows with the lowest Krum scores (n - n_byzantine rows by default). Krum is Multi-Krum with a single
+# selected row.
+def flat_multi_krum(rows: torch.Tensor, n_byzantine: int, n_selected: Optional[int] = None) -> torch.Tensor:
+    check_n_clients(len(rows), 2 * n_byzantine + 3, 'Krum')
+    if n_selected is None:
+        n_selected = len(rows) - n_byzantine
+    scores = krum_scores(squared_distances(rows), n_byzantine)
+    return rows[torch.topk(scores, n_selected, largest=False).indices].mean(dim=0)
+
+
+# Bulyan (as defined in https://arxiv.org/abs/1802.07927): n - 2 * n_byzantine rows are selected one after the other by Krum among the
+# remaining rows, then each parameter is the mean of the n - 4 * n_byzantine selected values that are the closest to their median.
+# The squared distances are computed and sorted once: the Krum scores among the remaining rows are then the sums of the first
+# distances to remaining rows in each sorted row (at least one neighbour per row when few rows remain).
+def flat_bulyan(rows: torch.Tensor, n_byzantine: int) -> torch.Tensor:
+    check_n_clients(len(rows), 4 * n_byzantine + 3, 'Bulyan')
+    sorted_distances, neighbours = torch.sort(squared_distances(rows).fill_diagonal_(-1.), dim=1)
+    sorted_distances, neighbours = sorted_distances[:, 1:], neighbours[:, 1:]  # Each row is first its own closest neighbour
+    candidates = torch.ones(len(rows), dtype=torch.bool, device=rows.device)
+    remaining_neighbours = torch.ones_like(neighbours, dtype=torch.bool)
+    selected_indexes = []
+    for n_remaining in range(len(rows), 2 * n_byzantine, -1):
+        n_neighbours = max(n_remaining - n_byzantine - 2, 1)
+        closest_neighbours = remaining_neighbours & (torch.cumsum(remaining_neighbours, dim=1, dtype=torch.int32) <= n_neighbours)
+        scores = torch.where(closest_neighbours, sorted_distances, torch.zeros_like(sorted_distances)).sum(dim=1)
+        selected_index = int(torch.argmin(torch.where(candidates, scores, torch.full_like(scores, float('inf')))))
+        candidates[selected_index] = False
+        remaining_neighbours &= neighbours != selected_index
+        selected_indexes.append(selected_index)
+
+    # The values the farthest from the median are zeroed out of the sum rather than the closest ones being gathered
+    selected_rows = rows[selected_indexes]
+    farthest_indexes = torch.topk((selected_rows - flat_median(selected_rows)).abs(), 2 * n_byzantine, dim=0).indices
+    return selected_rows.scatter(0, farthest_indexes, 0.).sum(dim=0) / (len(selected_rows) - 2 * n_byzantine)
+
+
+# Geometric median of the rows (the point with the lowest sum of euclidean distances to them) computed with the Weiszfeld algorithm,
+# starting from the mean. Each iteration is a weighted mean of all the rows, whose weights are the inverses of their distances to the
+# current estimate (computed with a single cdist, and bounded by 1 / eps so that an estimate on a row does not divide by zero). The
+# iterations stop when the estimate moves by less than tolerance (relatively to its norm).
+def flat_geometric_median(rows: torch.Tensor, max_iterations: int = 100, tolerance: float = 1e-6, eps: float = 1e-8) -> torch.Tensor:
+    median = rows.mean(dim=0)
+    for _ in range(max_iterations):
+        weights = 1. / torch.cdist(median.unsqueeze(0), rows).squeeze(0).clamp(min=eps)
+        new_median = torch.mv(rows.t(), weights / weights.sum())
+        converged = torch.norm(new_median - median) <= tolerance * torch.norm(median)
+        median = new_median
+        if converged:
+            break
+    return median
+
+
+# Shortcuts of the Byzantine-robust aggregations for 1 and 2 Byzantine clients, so that they can be set as a single param like the
+# trimmed means
+def federated_krum_1(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, lambda rows: flat_multi_krum(rows, 1, n_selected=1))
+
+
+def federated_krum_2(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, lambda rows: flat_multi_krum(rows, 2, n_selected=1))
+
+
+def federated_multi_krum_1(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, lambda rows: flat_multi_krum(rows, 1))
+
+
+def federated_multi_krum_2(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, lambda rows: flat_multi_krum(rows, 2))
+
+
+def federated_bulyan_1(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, lambda rows: flat_bulyan(rows, 1))
+
+
+def federated_bulyan_2(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, lambda rows: flat_bulyan(rows, 2))
+
+
+def federated_geometric_median(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    aggregate_flat(global_model, models, flat_geometric_median)
+
+
+# Flat counterparts of the aggregation functions above, used to aggregate rows of parameters directly (the resampled rows of s-resampling
+# and the flat buffers of flat_util). The other aggregation functions are called on models.
+flat_aggregations: Dict[Callable, FlatAggregation] = {federated_averaging: flat_averaging,
+                                                      federated_median: flat_median,
+                                                      federated_trimmed_mean_1: lambda rows: flat_trimmed_mean(rows, 1),
+                                                      federated_trimmed_mean_2: lambda rows: flat_trimmed_mean(rows, 2),
+                                                      federated_krum_1: lambda rows: flat_multi_krum(rows, 1, n_selected=1),
+                                                      federated_krum_2: lambda rows: flat_multi_krum(rows, 2, n_selected=1),
+                                                      federated_multi_krum_1: lambda rows: flat_multi_krum(rows, 1),
+                                                      federated_multi_krum_2: lambda rows: flat_multi_krum(rows, 2),
+                                                      federated_bulyan_1: lambda rows: flat_bulyan(rows, 1),
+                                                      federated_bulyan_2: lambda rows: flat_bulyan(rows, 2),
+                                                      federated_geometric_median: flat_geometric_median}
+
+
+# (T, s) matrix of the indexes of the s models averaged into each of the T resampled models of s-resampling, each model being sampled at
+# most s times. Each index is drawn uniformly among the models sampled less than s times so far, which is the distribution of the
+# rejection sampling of the paper, without the rejections: a model is removed from the available ones once it has been sampled s times.
+def s_resampling_indexes(T: int, s: int) -> torch.Tensor:
+    counts = np.zeros(T, dtype=int)
+    available = list(range(T))
+    output_indexes = np.empty((T, s), dtype=np.int64)
     for t in range(T):
-        j = [-1 for _ in range(s)]
         for i in range(s):
-            while True:
-                j[i] = np.random.randint(T)
-                if c[j[i]] < s:
-                    c[j[i]] += 1
-                    break
-        output_indexes.append(j)
-        with torch.no_grad():
-            g_t_bar = deepcopy(models[0])
-            sampled_models = [models[j[i]] for i in range(s)]
-            federated_averaging(g_t_bar, sampled_models)
-            output_models.append(g_t_bar)
-
-    return output_models, output_indexes
+            position = np.random.randint(len(available))
+            index = available[position]
+            output_indexes[t, i] = index
+            counts[index] += 1
+            if counts[index] == s:
+                available[position] = available[-1]
+                available.pop()
+    return torch.from_numpy(output_indexes)
+
+
+# As defined in https://arxiv.org/pdf/2006.09365.pdf. The rows of parameters of the T models (see flatten_models) are gathered along the
+# index matrix and averaged in a single operation, so that the resampled models are rows of parameters rather than copies of the models.
+def s_resampling(rows: torch.Tensor, s: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    output_indexes = s_resampling_indexes(len(rows), s)
+    with torch.no_grad():
+        return rows[output_indexes.to(rows.device)].mean(dim=1), output_indexes
 
 
 def model_update_scaling(global_model: torch.nn.Module, malicious_clients_models: List[torch.nn.Module], factor: float) -> None:
@@ -134,14 +288,34 @@ def mimic_attack(models: List[torch.nn.Module], malicious_clients: Set[int], mim
             models[i].load_state_dict(models[mimicked_client].state_dict())
 
 
-def init_federated_models(train_dls: List[DataLoader], params: SimpleNamespace, architecture: Callable):
-    # Initialization of a global model
-    n_clients = len(params.clients_devices)
+# Copies the global model into the models of the clients in place: their parameters (with their gradients), buffers and training modes
+# become those of the global model, as if they were deep copies of it. The models of the clients are then kept across the rounds (and the
+# FedSGD steps) instead of being allocated anew, along with their compiled modules (see execution.py).
+def broadcast_global_model(global_model: torch.nn.Module, models: List[torch.nn.Module]) -> None:
+    with torch.no_grad():
+        for model in models:
+            for param, global_param in zip(model.parameters(), global_model.parameters()):
+                param.copy_(global_param)
+                param.grad = None if global_param.grad is None else global_param.grad.clone()
+            for buffer, global_buffer in zip(model.buffers(), global_model.buffers()):
+                buffer.copy_(global_buffer)
+            for module, global_module in zip(model.modules(), global_model.modules()):
+                module.training = global_module.training
+
+
+def new_global_model(params: SimpleNamespace, architecture: Callable) -> NormalizingModel:
     global_model = NormalizingModel(architecture(activation_function=params.activation_fn, hidden_layers=params.hidden_layers),
                                     sub=torch.zeros(params.n_features), div=torch.ones(params.n_features))
 
     if params.cuda:
         global_model = global_model.cuda()
+    return global_model
+
+
+def init_federated_models(train_dls: List[DataLoader], params: SimpleNamespace, architecture: Callable):
+    # Initialization of a global model
+    n_clients = len(params.clients_devices)
+    global_model = new_global_model(params, architecture)
 
     models = [deepcopy(global_model) for _ in range(n_clients)]
     set_models_sub_divs(params.normalization, models, train_dls, color=Color.RED)
@@ -151,7 +325,7 @@ def init_federated_models(train_dls: List[DataLoader], params: SimpleNamespace,
     else:
         federated_averaging(global_model, models)
 
-    models = [deepcopy(global_model) for _ in range(n_clients)]
+    broadcast_global_model(global_model, models)
     return global_model, models
 
 
@@ -183,12 +357,23 @@ def model_aggregation(global_model: torch.nn.Module, models: List[torch.nn.Modul
         -> Tuple[torch.nn.Module, List[torch.nn.Module]]:
 
     if params.resampling is not None:
-        models, indexes = s_resampling(models, params.resampling)
+        resampled_rows, indexes = s_resampling(flatten_models(models), params.resampling)
         if verbose:
-            Ctp.print(indexes)
-    params.aggregation_function(global_model, models)
+            Ctp.print(indexes.tolist())
+        flat_aggregation = flat_aggregations.get(params.aggregation_function)
+        if flat_aggregation is not None:
+            with torch.no_grad():
+                load_flat_params(global_model, flat_aggregation(resampled_rows))
+        else:
+            # The resampled models are only materialized for the aggregation functions without a flat counterpart
+            resampled_models = [deepcopy(models[0]) for _ in range(len(resampled_rows))]
+            for resampled_model, row in zip(resampled_models, resampled_rows):
+                load_flat_params(resampled_model, row)
+            params.aggregation_function(global_model, resampled_models)
+    else:
+        params.aggregation_function(global_model, models)
 
     # Distribute the global model back to each client
-    models = [deepcopy(global_model) for _ in range(len(params.clients_devices))]
+    broadcast_global_model(global_model, models)
 
     return global_model, models
@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+from typing import List, Optional
+
+import torch
+from context_printer import ContextPrinter as Ctp
+
+from architectures import NormalizingModel
+from federated_util import s_resampling, flat_aggregations
+
+
+# The global model and the models of the clients (NormalizingModels with the same architecture) whose parameters are views into
+# contiguous buffers: the parameters of each client are a row of a (n_clients, n_params) tensor, and their gradients a row of a tensor of
+# the same shape. The steps of the optimizer, the poisoning attacks and the aggregation are then operations on whole rows, instead of
+# going through the parameters of each model one by one, and the global model is distributed to the clients by a single copy.
+# The parameters are laid out in the order of the state dicts (normalization values first, then the parameters of the inner model).
+class FlatModels:
+    def __init__(self, global_model: NormalizingModel, models: List[NormalizingModel]) -> None:
+        self.global_model = global_model
+        self.models = models
+        names_params = list(global_model.named_parameters())
+        self.n_params = sum(param.numel() for _, param in names_params)
+        # Columns of the parameters of the inner model (the normalization values are not trained and not attacked)
+        self.model_start = sum(param.numel() for name, param in names_params if not name.startswith('model.'))
+
+        device = global_model.sub.device
+        self.global_params = torch.cat([param.data.reshape(-1) for _, param in names_params])
+        self.params = torch.stack([torch.cat([param.data.reshape(-1) for param in model.parameters()]) for model in models])
+        self.grads = torch.zeros((len(models), self.n_params), device=device)
+
+        self.__set_views(global_model, self.global_params, None)
+        for model, row, grad_row in zip(models, self.params, self.grads):
+            self.__set_views(model, row, grad_row)
+
+    @staticmethod
+    def __set_views(model: NormalizingModel, row: torch.Tensor, grad_row: Optional[torch.Tensor]) -> None:
+        start = 0
+        for param in model.parameters():
+            end = start + param.numel()
+            param.data = row[start:end].view(param.shape)
+            if grad_row is not None and param.requires_grad:
+                param.grad = grad_row[start:end].view(param.shape)
+            start = end
+
+    def zero_grad(self) -> None:
+        self.grads.zero_()
+
+    # Step of a plain SGD on the parameters of the inner models of all the clients, which is the step that a freshly constructed
+    # torch.optim.SGD (without momentum) would make on each model
+    def sgd_step(self, lr: float, weight_decay: float) -> None:
+        with torch.no_grad():
+            params, grads = self.params[:, self.model_start:], self.grads[:, self.model_start:]
+            if weight_decay != 0:
+                grads = grads.add(params, alpha=weight_decay)
+            params.add_(grads, alpha=-lr)
+
+    # Copies the global model into the model of each client
+    def distribute(self) -> None:
+        self.params.copy_(self.global_params.expand_as(self.params))
+
+
+# Whether the FedSGD steps can be made on the flat buffers: the clients' optimizers are constructed anew at each step, so that a plain SGD
+# has no state and its step is the same operation on all the rows
+def can_use_flat_fedsgd(params: SimpleNamespace) -> bool:
+    return params.optimizer is torch.optim.SGD and params.optimizer_params.get('momentum', 0) == 0
+
+
+# Row counterpart of federated_util.model_poisoning
+def flat_model_poisoning(flat_models: FlatModels, params: SimpleNamespace, mimicked_client_id: Optional[int] = None) -> None:
+    malicious_clients = sorted(params.malicious_clients)
+    if not malicious_clients:
+        return
+    n_honest = len(flat_models.models) - len(malicious_clients)
+    rows, global_row = flat_models.params, flat_models.global_params
+
+    with torch.no_grad():
+        if params.model_poisoning is not None:
+            if params.model_poisoning == 'cancel_attack':
+                # Only the inner models are attacked, not the normalization values
+                rows[malicious_clients, flat_models.model_start:] = global_row[flat_models.model_start:] * (- n_honest / len(malicious_clients))
+            elif params.model_poisoning == 'mimic_attack':
+                rows[malicious_clients] = rows[mimicked_client_id].clone()
+            else:
+                raise ValueError('Wrong value for model_poisoning: ' + str(params.model_poisoning))
+
+        # Rescale the model updates of the malicious clients
+        rows[malicious_clients] = global_row + (rows[malicious_clients] - global_row) * params.model_update_factor
+
+
+# Row counterpart of federated_util.model_aggregation. The aggregation functions without a flat counterpart (see
+# federated_util.flat_aggregations) are called on the models, whose parameters are the rows of the buffer anyway.
+def flat_model_aggregation(flat_models: FlatModels, params: SimpleNamespace, verbose: bool = False) -> None:
+    with torch.no_grad():
+        rows = flat_models.params
+        if params.resampling is not None:
+            resampled_rows, indexes = s_resampling(rows, params.resampling)
+            if verbose:
+                Ctp.print(indexes.tolist())
+            # The models of the clients are replaced by the resampled models until the global model is distributed
+            rows.copy_(resampled_rows)
+
+        flat_aggregation = flat_aggregations.get(params.aggregation_function)
+        if flat_aggregation is not None:
+            flat_models.global_params.copy_(flat_aggregation(rows))
+        else:
+            params.aggregation_function(flat_models.global_model, flat_models.models)
+
+        flat_models.distribute()
@@ -2,7 +2,7 @@ import itertools
 from copy import deepcopy
 from time import time
 from types import SimpleNamespace
-from typing import List, Dict, Callable, Union
+from typing import List, Dict, Callable, Union, Optional
 
 from context_printer import ContextPrinter as Ctp, Color
 
@@ -25,17 +25,18 @@ def get_all_clients_devices(configurations: List[Dict[str, list]]) -> List[tuple
     return list(all_clients_devices_dict)
 
 
-# Compute the result of the experiment summed over the splits of the cross validation
+# Compute the result of the experiment summed over the splits of the cross validation. The number of epochs made in each split is appended
+# to trained_epochs if it is specified.
 def compute_cv_result(train_val_data: ClientData, experiment: str, params: SimpleNamespace,
-                      n_splits: int) -> Union[BinaryClassificationResult, float]:
+                      n_splits: int, trained_epochs: Optional[List[int]] = None) -> Union[BinaryClassificationResult, float]:
     result = BinaryClassificationResult() if experiment == 'classifier' else 0.
     for fold in range(n_splits):
         Ctp.enter_section('Fold [{}/{}]'.format(fold + 1, n_splits), Color.GRAY)
         train_data, val_data = split_client_data_current_fold(train_val_data, n_splits, fold)
         if experiment == 'classifier':
-            result += local_classifier_train_val(train_data, val_data, params=params)
+            result += local_classifier_train_val(train_data, val_data, params=params, trained_epochs=trained_epochs)
         elif experiment == 'autoencoder':
-            result += local_autoencoder_train_val(train_data, val_data, params=params)
+            result += local_autoencoder_train_val(train_data, val_data, params=params, trained_epochs=trained_epochs)
         else:
             raise ValueError()
         Ctp.exit_section()
@@ -45,12 +46,12 @@ def compute_cv_result(train_val_data: ClientData, experiment: str, params: Simpl
 
 # Compute the result of the experiment on a specified proportion of validation data
 def compute_single_split_result(train_val_data: ClientData, experiment: str, params: SimpleNamespace,
-                                val_part: float) -> Union[BinaryClassificationResult, float]:
+                                val_part: float, trained_epochs: Optional[List[int]] = None) -> Union[BinaryClassificationResult, float]:
     train_data, val_data = split_client_data(train_val_data, p_second_split=val_part, p_unused=0.0)
     if experiment == 'classifier':
-        result = local_classifier_train_val(train_data, val_data, params=params)
+        result = local_classifier_train_val(train_data, val_data, params=params, trained_epochs=trained_epochs)
     elif experiment == 'autoencoder':
-        result = local_autoencoder_train_val(train_data, val_data, params=params)
+        result = local_autoencoder_train_val(train_data, val_data, params=params, trained_epochs=trained_epochs)
     else:
         raise ValueError()
 
@@ -76,12 +77,14 @@ def run_grid_search(all_data: List[DeviceData], setup: str, experiment: str,
     all_clients_devices = get_all_clients_devices(configurations)
     Ctp.print(all_clients_devices)
     clients_results = {}
+    clients_epochs = {}  # Number of epochs actually made for each result, which can be fewer than specified with early stopping
     for i, client_devices_tuple in enumerate(all_clients_devices):
         client_devices = list(client_devices_tuple)
-        Ctp.enter_section('Client {} with devices: '.format(i) + device_names(client_devices), Color.WHITE)
+        Ctp.enter_section('Client {} with devices: '.format(i) + device_names(params_dict['devices'], client_devices), Color.WHITE)
         client_data = get_client_data(all_data, client_devices)
         train_val_data, _ = splitting_function(client_data, p_test=params_dict['p_test'], p_unused=params_dict['p_unused'])
         clients_results[repr(client_devices)] = {}
+        clients_epochs[repr(client_devices)] = {}
 
         for j, experiment_params_tuple in enumerate(params_product):  # Grid search: we iterate over the sets of parameters to be tested
             start_time = time()
@@ -89,11 +92,13 @@ def run_grid_search(all_data: List[DeviceData], setup: str, experiment: str,
             params_dict.update(experiment_params)
             Ctp.enter_section('Experiment [{}/{}] with params: '.format(j + 1, len(params_product)) + str(experiment_params), Color.NONE)
             params = SimpleNamespace(**params_dict)
+            trained_epochs = []
             if params_dict['n_splits'] == 1:  # We do not use cross-validation
-                result = compute_single_split_result(train_val_data, experiment, params, params_dict['val_part'])
+                result = compute_single_split_result(train_val_data, experiment, params, params_dict['val_part'], trained_epochs)
             else:  # Cross validation: we sum the results over the folds
-                result = compute_cv_result(train_val_data, experiment, params, params_dict['n_splits'])
+                result = compute_cv_result(train_val_data, experiment, params, params_dict['n_splits'], trained_epochs)
             clients_results[repr(client_devices)][repr(experiment_params)] = result
+            clients_epochs[repr(client_devices)][repr(experiment_params)] = trained_epochs
             Ctp.print("Elapsed time: {:.1f} seconds".format(time() - start_time))
             Ctp.exit_section()
         Ctp.exit_section()
@@ -101,8 +106,10 @@ def run_grid_search(all_data: List[DeviceData], setup: str, experiment: str,
     if collaborative:
         # Now that we have the results for each client we can recombine them into the original configurations by summing the results
         configurations_results = {}
+        configurations_epochs = {}
         for i, configuration in enumerate(configurations):
             configurations_results[repr(configuration['clients_devices'])] = {}
+            configurations_epochs[repr(configuration['clients_devices'])] = {}
             for j, experiment_params_tuple in enumerate(params_product):
                 experiment_params = {key: arg for (key, arg) in zip(varying_params.keys(), experiment_params_tuple)}
                 configurations_results[repr(configuration['clients_devices'])][repr(experiment_params)] = BinaryClassificationResult() \
@@ -110,12 +117,15 @@ def run_grid_search(all_data: List[DeviceData], setup: str, experiment: str,
                 for client_devices in configuration['clients_devices']:  # We sum the results of each client in the configuration
                     result = clients_results[repr(client_devices)][repr(experiment_params)]
                     configurations_results[repr(configuration['clients_devices'])][repr(experiment_params)] += result
+                # The epochs of each client are kept
+                configurations_epochs[repr(configuration['clients_devices'])][repr(experiment_params)] = \
+                    [clients_epochs[repr(client_devices)][repr(experiment_params)] for client_devices in configuration['clients_devices']]
 
         # We save the results in a json file
         results_path = create_new_numbered_dir(base_path)
-        save_results_gs(results_path, configurations_results, constant_params)
+        save_results_gs(results_path, configurations_results, constant_params, configurations_epochs)
 
     else:
         # We save the results in a json file
         results_path = create_new_numbered_dir(base_path)
-        save_results_gs(results_path, clients_results, constant_params)
+        save_results_gs(results_path, clients_results, constant_params, clients_epochs)
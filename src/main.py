@@ -1,16 +1,24 @@
 from argparse import ArgumentParser
+from typing import Optional
 
 import torch.utils.data
 
-from data import read_all_data, all_devices
+from data import read_required_data, all_devices, get_required_devices
+from client_executor import client_executor
+from dataset_cache import dataset_cache
+from execution import execution_mode
+from normalized_data import normalized_data_cache
 from federated_util import *
 from grid_search import run_grid_search
 from supervised_data import get_client_supervised_initial_splitting
+from synthetic_data import get_synthetic_devices, read_synthetic_data
 from test_hparams import test_hyperparameters
 from unsupervised_data import get_client_unsupervised_initial_splitting
 
 
-def main(experiment: str, setup: str, federated: str, test: bool, collaborative: bool):
+def main(experiment: str, setup: str, federated: str, test: bool, collaborative: bool, use_data_cache: bool = True,
+         data_workers: int = 1, synthetic_devices: Optional[int] = None, synthetic_rows: int = 10_000, synthetic_seed: int = 0,
+         client_workers: int = 0, deterministic_workers: bool = True, verbose: bool = True, dataset_cache_bytes: int = 0):
     Ctp.set_automatic_skip(True)
     Ctp.print('\n\t\t\t\t\t' + (federated.upper() + ' ' if federated is not None else '') + setup.upper() + ' ' + experiment.upper()
               + (' TESTING' if test else ' GRID SEARCH') + '\n', bold=True)
@@ -27,7 +35,41 @@ def main(experiment: str, setup: str, federated: str, test: bool, collaborative:
                      'cuda': False,  # It looks like cuda is slower than CPU for me so I enforce using the CPU
                      'benign_prop': 0.0787,
                      # Desired proportion of benign data in the train/validation sets (or None to keep the natural proportions)
-                     'samples_per_device': 100_000}  # Total number of datapoints (train & val + unused + test) for each device.
+                     'samples_per_device': 100_000,  # Total number of datapoints (train & val + unused + test) for each device.
+                     # If True, the duplicated rows of the datasets are stored once with their multiplicity, which is used as a weight
+                     'compact_datasets': False,
+                     # Thinning of the training sets: None, 'stride', 'k-center' or 'herding' (see thinning.py), keeping thinning_ratio of
+                     # the rows of each split
+                     'thinning': None,
+                     'thinning_ratio': 0.1,
+                     # If True, the clients' models are trained together in a single batched model (see batched_training.py) instead of
+                     # one after the other
+                     'batched_clients': False,
+                     # If set, the train sets of the clients are not gathered in datasets: the training loops read the rows of their whole
+                     # train splits in chunks of this number of rows (see streaming_data.py), without resampling, thinning or compacting them
+                     'streaming_chunk_size': None,
+                     # If True, the rows of each dataset are normalized once by the normalization values of the model (see
+                     # normalized_data.py) instead of being normalized by the model in each batch
+                     'prenormalized_datasets': False,
+                     # Early stopping of the local trainings (see early_stopping.py): None to always make all the epochs, or the arguments of
+                     # EarlyStopping, e.g. {'patience': 10, 'min_delta': 1e-4, 'restore_best_weights': True, 'monitor': 'train'} ('val' to
+                     # monitor the validation loss in the grid searches)
+                     'early_stopping': None,
+                     # Early stopping of the FedAvg rounds on the federated loss of the global model (its validation loss for the
+                     # autoencoders, its training loss for the classifiers): None or e.g. {'patience': 3, 'min_delta': 1e-4}, with
+                     # 'restore_best_weights': True to go back to the global model of the best round. The actual epochs and rounds are
+                     # saved with the results.
+                     'federated_early_stopping': None,
+                     # Execution of the models (see execution.py): None to run them as is, 'script' to compile them with TorchScript or
+                     # 'compile' to compile them with torch.compile, and bf16_autocast to compute their forward passes in bfloat16
+                     'compile_models': None,
+                     'bf16_autocast': False,
+                     # Maximum size of the datasets kept in memory to be reused by the next runs and configurations (0 to disable the
+                     # cache, see dataset_cache.py). The cached entries also pin the client data they were built from (the thinned
+                     # copies and the concatenated folds for example), so the memory used can grow by up to this size.
+                     'dataset_cache_bytes': dataset_cache_bytes,
+                     # If False, the training loops do not compute the statistics of their progress lines (the printing is deactivated)
+                     'verbose': verbose}
 
     # p_test, p_unused and p_train_val are the proportions of *all data* that go into respectively the *test set*, the *unused set*
     # and the *train_val set*.
@@ -48,6 +90,13 @@ def main(experiment: str, setup: str, federated: str, test: bool, collaborative:
 
     common_params.update({'p_train_val': p_train_val, 'val_part': val_part})
 
+    dataset_cache.set_max_bytes(common_params['dataset_cache_bytes'])
+    normalized_data_cache.set_enabled(common_params['prenormalized_datasets'])
+    execution_mode.configure(common_params['compile_models'], common_params['bf16_autocast'])
+
+    # The clients are trained and tested in client_workers processes (see client_executor.py), or sequentially if it is 0
+    client_executor.configure(client_workers, deterministic=deterministic_workers)
+
     if common_params['cuda']:
         Ctp.print('Using CUDA')
     else:
@@ -71,15 +120,24 @@ def main(experiment: str, setup: str, federated: str, test: bool, collaborative:
     # Note that other architecture-specific parameters, such as the dimensions of the hidden layers, can be specified in either in the
     # varying_params for the grid searches, or in the configurations_params for the tests.
 
-    n_devices = len(all_devices)
+    # Names of the devices, indexed by the device ids of the configurations. The N-BaIoT devices are replaced by synthetic devices (see
+    # synthetic_data.py) if synthetic_devices is set.
+    devices = get_synthetic_devices(synthetic_devices) if synthetic_devices is not None else all_devices
+    common_params['devices'] = devices
+    n_devices = len(devices)
 
     # TODO: Be careful to switch that back to 64 for other aggregation functions
     fedsgd_params = {'train_bs': 8}  # We can divide the batch size by the number of clients to make fedSGD closer to the centralized method
     fedavg_params = {'federation_rounds': 30,
                      'gamma_round': 0.75}
 
+    # If streaming_aggregation is set (FedAvg only), the clients are trained one at a time and each model is folded into the streaming
+    # counterpart of the aggregation function as soon as it is trained (see streaming_aggregation.py), instead of keeping all the models to
+    # stack them. It is only available for the mean, the median and the trimmed means, without s-resampling, model poisoning or batched
+    # clients.
     federation_params = {'aggregation_function': federated_averaging,
-                         'resampling': None}  # s-resampling
+                         'resampling': None,  # s-resampling
+                         'streaming_aggregation': False}
 
     if federated is not None:
         if federated == 'fedsgd':
@@ -128,7 +186,10 @@ def main(experiment: str, setup: str, federated: str, test: bool, collaborative:
     Ctp.print(configurations)
 
     # Loading the data
-    all_data = read_all_data()
+    if synthetic_devices is not None:
+        all_data = read_synthetic_data(n_devices, synthetic_rows, seed=synthetic_seed, device_ids=get_required_devices(configurations))
+    else:
+        all_data = read_required_data(configurations, use_cache=use_data_cache, n_workers=data_workers)
 
     if experiment == 'autoencoder':
         constant_params = {**common_params, **autoencoder_params, **poisoning_params}
@@ -148,6 +209,11 @@ def main(experiment: str, setup: str, federated: str, test: bool, collaborative:
                                      {'hidden_layers': [29], 'optimizer_params': {'lr': 1.0, 'weight_decay': 0.0}},
                                      {'hidden_layers': [29], 'optimizer_params': {'lr': 1.0, 'weight_decay': 0.0}}]
 
+            # These hyper-parameters were tuned for the 9 configurations of N-BaIoT: with synthetic devices, all the configurations use the
+            # ones of the first configuration
+            if synthetic_devices is not None:
+                configurations_params = [configurations_params[0]] * len(configurations)
+
             test_hyperparameters(all_data, setup, experiment, federated, splitting_function, constant_params, configurations_params, configurations)
         else:  # GRID-SEARCH
             varying_params = {'hidden_layers': [[86, 58, 38, 29, 38, 58, 86], [58, 29, 58], [29]],
@@ -175,6 +241,11 @@ def main(experiment: str, setup: str, federated: str, test: bool, collaborative:
                                      {'optimizer_params': {'lr': 0.5, 'weight_decay': 0.0}, 'hidden_layers': [115, 58]},
                                      {'optimizer_params': {'lr': 0.5, 'weight_decay': 0.0001}, 'hidden_layers': [115, 58]}]
 
+            # These hyper-parameters were tuned for the 9 configurations of N-BaIoT: with synthetic devices, all the configurations use the
+            # ones of the first configuration
+            if synthetic_devices is not None:
+                configurations_params = [configurations_params[0]] * len(configurations)
+
             test_hyperparameters(all_data, setup, experiment, federated, splitting_function, constant_params, configurations_params, configurations)
         else:  # GRID-SEARCH
             varying_params = {'optimizer_params': [{'lr': 0.5, 'weight_decay': 0.},
@@ -185,6 +256,9 @@ def main(experiment: str, setup: str, federated: str, test: bool, collaborative:
     else:
         raise ValueError
 
+    dataset_cache.print_stats()
+    client_executor.shutdown()
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -219,6 +293,37 @@ if __name__ == "__main__":
     parser.add_argument('--verbose-depth', dest='max_depth', type=int, help='Maximum number of nested sections after which the printing will stop')
     parser.set_defaults(max_depth=None)
 
+    data_cache_parser = parser.add_mutually_exclusive_group(required=False)
+    data_cache_parser.add_argument('--data-cache', dest='data_cache', action='store_true',
+                                   help='Memory-map the data from its binary cache, building the cache from the CSVs if it is missing or stale (default)')
+    data_cache_parser.add_argument('--no-data-cache', dest='data_cache', action='store_false',
+                                   help='Parse the CSVs directly without reading or writing the binary cache')
+    parser.set_defaults(data_cache=True)
+
+    parser.add_argument('--data-workers', dest='data_workers', type=int,
+                        help='Number of processes used to read the data files in parallel (default: 1, i.e. sequential reading)')
+    parser.set_defaults(data_workers=1)
+
+    parser.add_argument('--synthetic', dest='synthetic_devices', type=int,
+                        help='Use this number of synthetic devices instead of the N-BaIoT dataset (default: None, i.e. the real data)')
+    parser.set_defaults(synthetic_devices=None)
+    parser.add_argument('--synthetic-rows', dest='synthetic_rows', type=int, help='Number of rows of each key of each synthetic device')
+    parser.set_defaults(synthetic_rows=10_000)
+    parser.add_argument('--synthetic-seed', dest='synthetic_seed', type=int, help='Random seed of the synthetic data')
+    parser.set_defaults(synthetic_seed=0)
+
+    parser.add_argument('--client-workers', dest='client_workers', type=int,
+                        help='Number of processes used to train and test the clients in parallel (default: 0, i.e. sequentially)')
+    parser.set_defaults(client_workers=0)
+    parser.add_argument('--nondeterministic-workers', dest='deterministic_workers', action='store_false',
+                        help='Let the client workers draw their own random numbers and split the CPU threads between them, instead of '
+                             'reproducing the results of the sequential training')
+    parser.set_defaults(deterministic_workers=True)
+
+    parser.add_argument('--dataset-cache-mb', dest='dataset_cache_mb', type=int,
+                        help='Size in MB of the cache of the datasets reused by the reruns and the configurations (default: 0, i.e. disabled)')
+    parser.set_defaults(dataset_cache_mb=0)
+
     args = parser.parse_args()
 
     if not args.verbose:  # Deactivate all printing in the console
@@ -227,4 +332,7 @@ if __name__ == "__main__":
     if args.max_depth is not None:
         Ctp.set_max_depth(args.max_depth)  # Set the max depth at which we print in the console
 
-    main(args.experiment, args.setup, args.federated, args.test, args.collaborative)
+    main(args.experiment, args.setup, args.federated, args.test, args.collaborative, use_data_cache=args.data_cache,
+         data_workers=args.data_workers, synthetic_devices=args.synthetic_devices, synthetic_rows=args.synthetic_rows,
+         synthetic_seed=args.synthetic_seed, client_workers=args.client_workers, deterministic_workers=args.deterministic_workers,
+         verbose=args.verbose, dataset_cache_bytes=args.dataset_cache_mb * 2 ** 20)
@@ -1,6 +1,75 @@
+import math
+from typing import Optional
+
 import torch
 
 
+# Statistics of values weighted by integer multiplicities (see tensor_datasets.CompactDataset). They are equal to the same statistics
+# computed on the expanded values, in which each value is repeated as many times as its weight: exactly for the quantile, and up to the
+# rounding errors for the mean and standard deviation (which are accumulated in float64).
+def weighted_mean(values: torch.Tensor, weights: torch.Tensor) -> torch.Tensor:
+    weights = weights.double().reshape((-1,) + (1,) * (values.dim() - 1))
+    return ((values.double() * weights).sum(dim=0) / weights.sum()).to(values.dtype)
+
+
+# Unbiased, like torch.std
+def weighted_std(values: torch.Tensor, weights: torch.Tensor) -> torch.Tensor:
+    weights = weights.double().reshape((-1,) + (1,) * (values.dim() - 1))
+    mean = (values.double() * weights).sum(dim=0) / weights.sum()
+    variance = (weights * (values.double() - mean) ** 2).sum(dim=0) / (weights.sum() - 1)
+    return variance.sqrt().to(values.dtype)
+
+
+# Linear interpolation between the two expanded values around the rank q * (n - 1), like torch.quantile, without expanding the values:
+# the expanded rank of each sorted value is found in the cumulative sum of the weights
+def weighted_quantile(values: torch.Tensor, weights: torch.Tensor, q: float) -> torch.Tensor:
+    if torch.isnan(values).any():  # Like torch.quantile
+        return torch.tensor(float('nan'), dtype=values.dtype, device=values.device)
+    sorted_values, order = torch.sort(values)
+    cumulative_weights = torch.cumsum(weights.long()[order], dim=0)
+    rank = torch.tensor(q, dtype=values.dtype).item() * (cumulative_weights[-1].item() - 1)  # q is rounded to the dtype of the values first
+    ranks = torch.tensor([math.floor(rank), math.ceil(rank)], device=values.device)
+    below, above = sorted_values[torch.searchsorted(cumulative_weights, ranks, right=True)]
+    return torch.lerp(below, above, torch.tensor(rank - math.floor(rank), dtype=values.dtype, device=values.device))
+
+
+# Counts of the (label, prediction) pairs of n_classes classes, as a flat tensor of n_classes * n_classes counts in which the count of
+# (label, pred) is at index label * n_classes + pred, computed with a single bincount. If weight is specified, each row counts as many times
+# as its weight.
+def count_confusion(pred: torch.Tensor, label: torch.Tensor, n_classes: int = 2, weight: Optional[torch.Tensor] = None) -> torch.Tensor:
+    indexes = label.reshape(-1).long() * n_classes + pred.reshape(-1).long()
+    if weight is None:
+        return torch.bincount(indexes, minlength=n_classes * n_classes)
+    # The weights are integer multiplicities, which float64 represents exactly
+    return torch.bincount(indexes, weights=weight.reshape(-1).double(), minlength=n_classes * n_classes).long()
+
+
+# Confusion matrix accumulated in a tensor, on the device of the predictions: each update is a single bincount and does not read anything
+# back, so that the counts are only synchronized with the host when they are materialized, to be printed or saved. The rows of the matrix
+# are the labels and its columns the predictions. The labels and the predictions are class ids (0 or 1 for the binary classifiers, the
+# values of data.multiclass_labels for the multiclass targets).
+class ConfusionMatrix:
+    def __init__(self, n_classes: int = 2) -> None:
+        self.n_classes = n_classes
+        self.counts = None  # Flat counts (see count_confusion), allocated on the device of the first update
+
+    def update(self, pred: torch.Tensor, label: torch.Tensor, weight: Optional[torch.Tensor] = None) -> None:
+        counts = count_confusion(pred, label, self.n_classes, weight)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def matrix(self) -> torch.Tensor:
+        if self.counts is None:
+            return torch.zeros((self.n_classes, self.n_classes), dtype=torch.long)
+        return self.counts.reshape(self.n_classes, self.n_classes)
+
+    # Materializes the counts of a binary confusion matrix
+    def result(self) -> 'BinaryClassificationResult':
+        if self.n_classes != 2:
+            raise ValueError('Only a binary confusion matrix can be converted to a BinaryClassificationResult')
+        (tn, fp), (fn, tp) = self.matrix().tolist()
+        return BinaryClassificationResult(tp=tp, tn=tn, fp=fp, fn=fn)
+
+
 class BinaryClassificationResult:
     def __init__(self, tp: int = 0, tn: int = 0, fp: int = 0, fn: int = 0):
         self.tp = tp  # Number of true positives
@@ -29,12 +98,14 @@ class BinaryClassificationResult:
     def add_fn(self, val: int) -> None:
         self.fn += val
 
-    # Update the result based on the pred tensor and on the label tensor
-    def update(self, pred: torch.Tensor, label: torch.Tensor) -> None:
-        self.add_tp(torch.logical_and(torch.eq(pred, label), label.bool()).int().sum().item())
-        self.add_tn(torch.logical_and(torch.eq(pred, label), torch.logical_not(label.bool())).int().sum().item())
-        self.add_fp(torch.logical_and(torch.logical_not(torch.eq(pred, label)), torch.logical_not(label.bool())).int().sum().item())
-        self.add_fn(torch.logical_and(torch.logical_not(torch.eq(pred, label)), label.bool()).int().sum().item())
+    # Update the result based on the pred tensor and on the label tensor. If weight is specified, each row counts as many times as its weight.
+    # The loops that update a result at each batch should rather accumulate a ConfusionMatrix, which does not synchronize at each update.
+    def update(self, pred: torch.Tensor, label: torch.Tensor, weight: Optional[torch.Tensor] = None) -> None:
+        tn, fp, fn, tp = count_confusion(pred, label, weight=weight).tolist()
+        self.add_tp(tp)
+        self.add_tn(tn)
+        self.add_fp(fp)
+        self.add_fn(fn)
 
     # True positive rate
     def tpr(self) -> float:
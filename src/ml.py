@@ -1,4 +1,4 @@
-from typing import Tuple, List
+from typing import Tuple, List, Iterable, Optional
 
 import torch
 from context_printer import Color
@@ -7,12 +7,20 @@ from context_printer import ContextPrinter as Ctp
 from torch.utils.data import DataLoader
 
 from architectures import NormalizingModel
+from metrics import weighted_mean, weighted_std
+from streaming_data import StreamingDataLoader
+from tensor_datasets import get_counts, get_n_samples
 
 
-def get_sub_div(data: torch.Tensor, normalization: str) -> Tuple[torch.tensor, torch.tensor]:
+# If weights are specified, each row counts as many times as its weight
+def get_sub_div(data: torch.Tensor, normalization: str, weights: Optional[torch.Tensor] = None) -> Tuple[torch.tensor, torch.tensor]:
     if normalization == '0-mean 1-var':
-        sub = data.mean(dim=0)
-        div = data.std(dim=0)
+        if weights is None:
+            sub = data.mean(dim=0)
+            div = data.std(dim=0)
+        else:
+            sub = weighted_mean(data, weights)
+            div = weighted_std(data, weights)
     elif normalization == 'min-max':
         sub = data.min(dim=0)[0]
         div = data.max(dim=0)[0] - sub
@@ -25,10 +33,59 @@ def get_sub_div(data: torch.Tensor, normalization: str) -> Tuple[torch.tensor, t
     return sub, div
 
 
+# Computes the same normalization values as get_sub_div, but online over chunks of the data, so that the data never has to be entirely
+# in memory. The mean and variance of the chunks are merged with Chan's parallel algorithm (in float64 to limit the rounding errors).
+def get_online_sub_div(chunks: Iterable[torch.Tensor], normalization: str) -> Tuple[torch.tensor, torch.tensor]:
+    if normalization not in ['0-mean 1-var', 'min-max', 'none']:
+        raise NotImplementedError
+
+    n_samples, n_features = 0, None
+    mean, m2, minimum, maximum = None, None, None, None
+    for chunk in chunks:
+        chunk = chunk.double()
+        n_chunk = len(chunk)
+        if n_chunk == 0:
+            continue
+        n_features = chunk.shape[1]
+        if normalization == '0-mean 1-var':
+            chunk_mean = chunk.mean(dim=0)
+            chunk_m2 = ((chunk - chunk_mean) ** 2).sum(dim=0)
+            if mean is None:
+                mean, m2 = chunk_mean, chunk_m2
+            else:
+                delta = chunk_mean - mean
+                mean = mean + delta * n_chunk / (n_samples + n_chunk)
+                m2 = m2 + chunk_m2 + delta ** 2 * n_samples * n_chunk / (n_samples + n_chunk)
+        elif normalization == 'min-max':
+            chunk_min, chunk_max = chunk.min(dim=0)[0], chunk.max(dim=0)[0]
+            minimum = chunk_min if minimum is None else torch.min(minimum, chunk_min)
+            maximum = chunk_max if maximum is None else torch.max(maximum, chunk_max)
+        n_samples += n_chunk
+
+    if n_samples == 0:
+        raise ValueError('Cannot compute the normalization values without data')
+
+    if normalization == '0-mean 1-var':
+        sub = mean
+        div = (m2 / (n_samples - 1)).sqrt()  # Unbiased, like torch.std
+    elif normalization == 'min-max':
+        sub = minimum
+        div = maximum - minimum
+    else:
+        sub = torch.zeros(n_features)
+        div = torch.ones(n_features)
+
+    return sub.float(), div.float()
+
+
 def set_model_sub_div(normalization: str, model: NormalizingModel, train_dl: DataLoader) -> None:
-    data = train_dl.dataset[:][0]
-    Ctp.print('Computing normalization with {} train samples'.format(len(data)))
-    sub, div = get_sub_div(data, normalization)
+    if isinstance(train_dl, StreamingDataLoader):
+        Ctp.print('Computing normalization online with {} train samples'.format(len(train_dl.dataset)))
+        sub, div = get_online_sub_div(train_dl.iter_data_chunks(), normalization)
+    else:
+        data = train_dl.dataset[:][0]
+        Ctp.print('Computing normalization with {} train samples'.format(get_n_samples(train_dl)))
+        sub, div = get_sub_div(data, normalization, weights=get_counts(train_dl))
     model.set_sub_div(sub, div)
 
 
@@ -0,0 +1,84 @@
+import weakref
+from typing import Union, Tuple
+
+import torch
+import torch.nn as nn
+# noinspection PyProtectedMember
+from torch.utils.data import Dataset
+
+from architectures import NormalizingModel
+from tensor_datasets import ResampledDataset, CompactDataset, TensorDataLoader
+
+TensorDataset = Union[ResampledDataset, CompactDataset]
+
+
+# Returns a dataset of the same type with the same indexes (or counts) and tensors, whose source rows are normalized with sub and div.
+# Only the source rows are normalized, so that the upsampled rows of a ResampledDataset are not normalized several times.
+def normalize_dataset(dataset: TensorDataset, sub: torch.Tensor, div: torch.Tensor) -> TensorDataset:
+    with torch.no_grad():
+        data = (dataset.data - sub) / div
+    if isinstance(dataset, CompactDataset):
+        return CompactDataset(data, dataset.counts, *dataset.tensors)
+    return ResampledDataset(data, dataset.indexes, *dataset.tensors)
+
+
+# Rows of a dataset normalized for a model: they are taken from the normalized copy of the dataset as long as the normalization values of
+# the model are those of the copy, and normalized by the model otherwise (when the normalization values of the clients change during the
+# training, as in FedSGD where they are aggregated at each step)
+class NormalizedDatasetView(Dataset):
+    def __init__(self, dataset: TensorDataset, normalized_dataset: TensorDataset, sub: torch.Tensor, div: torch.Tensor,
+                 model: NormalizingModel) -> None:
+        self.dataset = dataset
+        self.normalized_dataset = normalized_dataset
+        self.sub = sub
+        self.div = div
+        self.model = model
+
+    def __getitem__(self, index: Union[int, slice, torch.Tensor]) -> tuple:
+        if torch.equal(self.model.sub, self.sub) and torch.equal(self.model.div, self.div):
+            return self.normalized_dataset[index]
+        items = self.dataset[index]
+        with torch.no_grad():
+            return (self.model.normalize(items[0]),) + items[1:]
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+
+# Cache of the normalized copies of the tensor datasets, so that the rows of a client's datasets (train, threshold and test) are
+# normalized once for all the epochs and all the passes, instead of being normalized by the model in each batch. The normalization being
+# an element-wise operation, the normalized rows are exactly those that the model would compute from the batches.
+# Each dataset keeps a single normalized copy, along with the normalization values it was computed with: the copy is computed again if
+# the dataset is used with other normalization values, and it is released with its dataset. If the normalization values of the model
+# change while its dataloader is iterated over, the next batches are normalized by the model (see NormalizedDatasetView).
+class NormalizedDataCache:
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.entries = weakref.WeakKeyDictionary()
+
+    def set_enabled(self, enabled: bool) -> None:
+        self.enabled = enabled
+        if not enabled:
+            self.entries.clear()
+
+    def get_dataset(self, dataset: TensorDataset, model: NormalizingModel) -> NormalizedDatasetView:
+        entry = self.entries.get(dataset)
+        if entry is None or not (torch.equal(entry[0], model.sub) and torch.equal(entry[1], model.div)):
+            sub, div = model.sub.detach().clone(), model.div.detach().clone()
+            entry = (sub, div, normalize_dataset(dataset, sub, div))
+            self.entries[dataset] = entry
+        return NormalizedDatasetView(dataset, entry[2], entry[0], entry[1], model)
+
+    # Returns the dataloader to iterate over with the model, and whether its rows are already normalized (in which case they should be
+    # given to the inner model model.model). The dataloader over the normalized rows has the same batch size and shuffling as the original
+    # one (and draws the same random numbers), but its dataset is a view: the weights and the segments should be read from the original
+    # dataloader. The original dataloader is returned if the cache is disabled, or if the dataloader or the model are not supported
+    # (a StreamingDataLoader or a model without normalization for example).
+    def get_dataloader(self, model: nn.Module, dataloader) -> Tuple[object, bool]:
+        if not self.enabled or not isinstance(model, NormalizingModel) or not isinstance(dataloader, TensorDataLoader):
+            return dataloader, False
+        return TensorDataLoader(self.get_dataset(dataloader.dataset, model), dataloader.batch_size, dataloader.shuffle), True
+
+
+# Cache shared by the training and testing loops. It is disabled until it is enabled with set_enabled.
+normalized_data_cache = NormalizedDataCache()
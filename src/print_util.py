@@ -1,10 +1,10 @@
-from typing import Optional
+from typing import Optional, Callable, Tuple
 
 import torch
 from context_printer import Color
 from context_printer import ContextPrinter as Ctp
 
-from metrics import BinaryClassificationResult
+from metrics import BinaryClassificationResult, weighted_quantile, weighted_mean, weighted_std
 
 
 class Columns:
@@ -13,6 +13,30 @@ class Columns:
     LARGE = 22
 
 
+# Statistics of the losses printed by print_loss_stats: min, Q-0.01, mean, Q-0.99, max and std
+LossStats = Tuple[float, float, float, float, float, float]
+
+
+# Prints the output of the training or the test of a client: the print functions are called right away, or recorded along with their
+# arguments (the statistics to print, not the tensors they are computed from) if deferred is set. The deferred calls are used when the
+# client is run in a worker process of the client executor, whose own output is not shown: they are sent back with the result of the
+# client and replayed by the main process in the order of the clients, so that the output does not depend on the number of workers.
+class ClientPrinter:
+    def __init__(self, deferred: bool = False) -> None:
+        self.deferred = deferred
+        self.calls = []
+
+    def __call__(self, function: Callable, *args, **kwargs) -> None:
+        if self.deferred:
+            self.calls.append((function, args, kwargs))
+        else:
+            function(*args, **kwargs)
+
+    def replay(self) -> None:
+        for function, args, kwargs in self.calls:
+            function(*args, **kwargs)
+
+
 def print_federation_round(federation_round: int, n_rounds: int) -> None:
     Ctp.enter_section('Federation round [{}/{}]'.format(federation_round + 1, n_rounds), Color.DARK_GRAY)
 
@@ -27,8 +51,8 @@ def print_rates(result: BinaryClassificationResult) -> None:
     Ctp.print('TP: {} - TN: {} - FP: {} - FN:{}'.format(result.tp, result.tn, result.fp, result.fn))
 
 
-def print_train_classifier_header() -> None:
-    Ctp.print('Epoch'.ljust(Columns.SMALL)
+def print_train_classifier_header(first_column: str = 'Epoch') -> None:
+    Ctp.print(first_column.ljust(Columns.SMALL)
               + '| Batch'.ljust(Columns.MEDIUM)
               + '| TPR'.ljust(Columns.MEDIUM)
               + '| TNR'.ljust(Columns.MEDIUM)
@@ -39,8 +63,8 @@ def print_train_classifier_header() -> None:
 
 
 def print_train_classifier(epoch: int, num_epochs: int, batch: int, num_batches: int,
-                           result: BinaryClassificationResult, lr: float, persistent: bool = False) -> None:
-    Ctp.print('[{}/{}]'.format(epoch + 1, num_epochs).ljust(Columns.SMALL)
+                           result: BinaryClassificationResult, lr: float, persistent: bool = False, title: Optional[str] = None) -> None:
+    Ctp.print((title if title is not None else '[{}/{}]'.format(epoch + 1, num_epochs)).ljust(Columns.SMALL)
               + '| [{}/{}]'.format(batch + 1, num_batches).ljust(Columns.MEDIUM)
               + '| {:.5f}'.format(result.tpr()).ljust(Columns.MEDIUM)
               + '| {:.5f}'.format(result.tnr()).ljust(Columns.MEDIUM)
@@ -64,17 +88,28 @@ def print_autoencoder_loss_header(first_column: str = 'Dataset', print_positives
               bold=True)
 
 
-def print_autoencoder_loss_stats(title: str, losses: torch.Tensor, positives: Optional[int] = None,
-                                 n_samples: Optional[int] = None, lr: Optional[float] = None) -> None:
+# If weights are specified, each loss counts as many times as its weight
+def compute_loss_stats(losses: torch.Tensor, weights: Optional[torch.Tensor] = None) -> LossStats:
+    if weights is None:
+        q_01, q_99 = torch.quantile(losses, torch.tensor([0.01, 0.99], dtype=losses.dtype, device=losses.device)).tolist()  # A single sort
+        mean, std = losses.mean().item(), losses.std().item()
+    else:
+        q_01, mean, q_99, std = weighted_quantile(losses, weights, 0.01).item(), weighted_mean(losses, weights).item(), \
+                                weighted_quantile(losses, weights, 0.99).item(), weighted_std(losses, weights).item()
+    return losses.min().item(), q_01, mean, q_99, losses.max().item(), std
+
 
+def print_loss_stats(title: str, stats: LossStats, positives: Optional[int] = None, n_samples: Optional[int] = None,
+                     lr: Optional[float] = None) -> None:
     print_positives = (positives is not None and n_samples is not None)
     Ctp.print(title.ljust(Columns.MEDIUM)
-              + '| {:.4f}'.format(losses.min()).ljust(Columns.MEDIUM)
-              + '| {:.4f}'.format(torch.quantile(losses, 0.01).item()).ljust(Columns.MEDIUM)
-              + '| {:.4f}'.format(losses.mean()).ljust(Columns.MEDIUM)
-              + '| {:.4f}'.format(torch.quantile(losses, 0.99).item()).ljust(Columns.MEDIUM)
-              + '| {:.4f}'.format(losses.max()).ljust(Columns.MEDIUM)
-              + '| {:.4f}'.format(losses.std()).ljust(Columns.MEDIUM)
+              + ''.join('| {:.4f}'.format(stat).ljust(Columns.MEDIUM) for stat in stats)
               + ('| {}/{}'.format(positives, n_samples).ljust(Columns.LARGE)
                  + '| {:.4f}%'.format(100.0 * positives / n_samples).ljust(Columns.MEDIUM) if print_positives else '')
               + ('| {:.6f}'.format(lr) if lr is not None else ''))
+
+
+# If weights are specified, each loss counts as many times as its weight
+def print_autoencoder_loss_stats(title: str, losses: torch.Tensor, positives: Optional[int] = None,
+                                 n_samples: Optional[int] = None, lr: Optional[float] = None, weights: Optional[torch.Tensor] = None) -> None:
+    print_loss_stats(title, compute_loss_stats(losses, weights), positives=positives, n_samples=n_samples, lr=lr)
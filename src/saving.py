@@ -16,8 +16,9 @@ def dumper(obj: Any) -> Union[dict, str]:
             return obj.__dict__
 
 
+# trainings holds the training actually made in each run of each configuration (see test_hparams.compute_rerun_results)
 def save_results_test(path: str, local_results: dict, new_devices_results: dict, thresholds: Optional[dict],
-                      constant_params, configurations_params: List[dict]) -> None:
+                      constant_params, configurations_params: List[dict], trainings: Optional[dict] = None) -> None:
     # Save the results to a new unique file (file name based on current time)
     with open(path + 'local_results.json', 'w') as outfile:
         json.dump(local_results, outfile, default=dumper, indent=2)
@@ -32,14 +33,23 @@ def save_results_test(path: str, local_results: dict, new_devices_results: dict,
         with open(path + 'thresholds.json', 'w') as outfile:
             json.dump(thresholds, outfile, default=dumper, indent=2)
 
+    if trainings is not None:
+        with open(path + 'trainings.json', 'w') as outfile:
+            json.dump(trainings, outfile, default=dumper, indent=2)
 
-def save_results_gs(path: str, local_results: dict, constant_params: dict) -> None:
+
+# trained_epochs holds the number of epochs actually made for each result (one per fold of the cross validation)
+def save_results_gs(path: str, local_results: dict, constant_params: dict, trained_epochs: Optional[dict] = None) -> None:
     # Save the results to a new unique file (file name based on current time)
     with open(path + 'local_results.json', 'w') as outfile:
         json.dump(local_results, outfile, default=dumper, indent=2)
     with open(path + 'constant_params.json', 'w') as outfile:
         json.dump(constant_params, outfile, default=dumper, indent=2)
 
+    if trained_epochs is not None:
+        with open(path + 'trained_epochs.json', 'w') as outfile:
+            json.dump(trained_epochs, outfile, default=dumper, indent=2)
+
 
 def create_new_numbered_dir(base_path: str) -> Optional[str]:
     for run_id in range(1000):
@@ -0,0 +1,240 @@
+import math
+from abc import ABC, abstractmethod
+from copy import deepcopy
+from types import SimpleNamespace
+from typing import Iterable, Callable, Dict, Optional, List, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+from context_printer import ContextPrinter as Ctp, Color
+# noinspection PyProtectedMember
+from torch.utils.data import DataLoader
+
+from architectures import NormalizingModel
+from federated_util import federated_averaging, federated_median, federated_trimmed_mean_1, federated_trimmed_mean_2, flatten_model, \
+    load_flat_params, flat_median, model_aggregation, broadcast_global_model, new_global_model, model_update_scaling
+from ml import set_model_sub_div
+from tensor_datasets import get_n_samples
+
+
+# Aggregation of the clients' models that folds them in one at a time, as they finish their training, instead of stacking all of them
+# (see the aggregation functions of federated_util). Each model is flattened into a row of parameters and added to the state of the
+# aggregator, so that the model can be released right after: the memory of the aggregator does not depend on the number of clients.
+class StreamingAggregator(ABC):
+    def __init__(self) -> None:
+        self.n_models = 0
+
+    def add(self, model: nn.Module, weight: float = 1.) -> None:
+        with torch.no_grad():
+            self.add_row(flatten_model(model), weight)
+        self.n_models += 1
+
+    @abstractmethod
+    def add_row(self, row: torch.Tensor, weight: float) -> None:
+        pass
+
+    # Aggregated row of parameters of the models added so far
+    @abstractmethod
+    def result(self) -> torch.Tensor:
+        pass
+
+    def aggregate_into(self, global_model: nn.Module) -> None:
+        if self.n_models == 0:
+            raise ValueError('No model was added to the aggregator')
+        with torch.no_grad():
+            load_flat_params(global_model, self.result())
+
+
+# Weighted mean of the models (the weight of a client being the number of its training samples for FedAvg, 1 by default for the plain
+# mean of federated_averaging). The running sums are kept in float64, so that their rounding errors stay negligible with many clients.
+class StreamingMean(StreamingAggregator):
+    def __init__(self) -> None:
+        super(StreamingMean, self).__init__()
+        self.weighted_sum = None
+        self.total_weight = 0.
+
+    def add_row(self, row: torch.Tensor, weight: float) -> None:
+        if self.weighted_sum is None:
+            self.weighted_sum = torch.zeros(row.shape, dtype=torch.float64, device=row.device)
+            self.dtype = row.dtype
+        self.weighted_sum.add_(row.double(), alpha=weight)
+        self.total_weight += weight
+
+    def result(self) -> torch.Tensor:
+        return (self.weighted_sum / self.total_weight).to(self.dtype)
+
+
+# Mean of the values of each parameter without the n_trimmed lowest and the n_trimmed highest ones, as in federated_util.flat_trimmed_mean.
+# Only the running sum and the n_trimmed lowest and highest values seen so far are kept (2 * n_trimmed + 1 rows): with a fixed number of
+# trimmed values, the streaming trimmed mean is exact (up to the float64 rounding of the sums) rather than approximated.
+class StreamingTrimmedMean(StreamingAggregator):
+    def __init__(self, n_trimmed: int) -> None:
+        super(StreamingTrimmedMean, self).__init__()
+        self.n_trimmed = n_trimmed
+        self.sum = None
+        self.lowest_values = None
+        self.highest_values = None
+
+    def add_row(self, row: torch.Tensor, weight: float) -> None:
+        if weight != 1.:
+            raise ValueError('The streaming trimmed mean is not weighted')
+        if self.sum is None:
+            self.sum = torch.zeros(row.shape, dtype=torch.float64, device=row.device)
+            self.lowest_values, self.highest_values = row.unsqueeze(0)[:self.n_trimmed], row.unsqueeze(0)[:self.n_trimmed]
+        else:
+            n_kept = min(self.n_trimmed, self.n_models + 1)
+            self.lowest_values = torch.topk(torch.cat([self.lowest_values, row.unsqueeze(0)]), n_kept, dim=0, largest=False).values
+            self.highest_values = torch.topk(torch.cat([self.highest_values, row.unsqueeze(0)]), n_kept, dim=0, largest=True).values
+        self.sum.add_(row.double())
+
+    def result(self) -> torch.Tensor:
+        if self.n_models <= 2 * self.n_trimmed:
+            raise ValueError('The trimmed mean of {} values needs more than {} models, got {}'
+                             .format(self.n_trimmed, 2 * self.n_trimmed, self.n_models))
+        trimmed_sum = self.sum - self.lowest_values.double().sum(dim=0) - self.highest_values.double().sum(dim=0)
+        return (trimmed_sum / (self.n_models - 2 * self.n_trimmed)).to(self.lowest_values.dtype)
+
+
+# Bound on the error of the median of a reservoir of reservoir_size models, in rank: by the Dvoretzky-Kiefer-Wolfowitz inequality, with
+# probability at least 1 - delta, the empirical distribution of each parameter in the reservoir is within epsilon of its distribution over
+# all the clients, so that the median of the reservoir is a quantile between 0.5 - epsilon and 0.5 + epsilon of the clients' values.
+# The reservoir is a sample without replacement, which is at least as concentrated as the sample with replacement of the inequality.
+def median_rank_error(reservoir_size: int, delta: float = 0.05) -> float:
+    return math.sqrt(math.log(2. / delta) / (2. * reservoir_size))
+
+
+# Median of the values of each parameter, approximated by the median of a uniform sample of reservoir_size models (reservoir sampling):
+# it is exact as long as at most reservoir_size models are added, and its error is bounded in rank otherwise (see median_rank_error).
+# The reservoir is drawn with the global numpy generator, as the indexes of s-resampling. It grows with the models added, so that it never
+# holds more than min(reservoir_size, number of models) rows.
+class StreamingMedian(StreamingAggregator):
+    def __init__(self, reservoir_size: int = 256) -> None:
+        super(StreamingMedian, self).__init__()
+        self.reservoir_size = reservoir_size
+        self.reservoir = []
+
+    def add_row(self, row: torch.Tensor, weight: float) -> None:
+        if weight != 1.:
+            raise ValueError('The streaming median is not weighted')
+        if self.n_models < self.reservoir_size:
+            self.reservoir.append(row)
+        else:
+            index = np.random.randint(self.n_models + 1)
+            if index < self.reservoir_size:
+                self.reservoir[index] = row
+
+    def result(self) -> torch.Tensor:
+        return flat_median(torch.stack(self.reservoir))
+
+
+# Streaming counterparts of the aggregation functions of federated_util. The other aggregation functions (Krum, Bulyan, the geometric
+# median...) need all the models at once.
+streaming_aggregators: Dict[Callable, Callable[[], StreamingAggregator]] = {federated_averaging: StreamingMean,
+                                                                           federated_median: StreamingMedian,
+                                                                           federated_trimmed_mean_1: lambda: StreamingTrimmedMean(1),
+                                                                           federated_trimmed_mean_2: lambda: StreamingTrimmedMean(2)}
+
+
+def get_streaming_aggregator(aggregation_function: Callable) -> StreamingAggregator:
+    if aggregation_function not in streaming_aggregators:
+        raise ValueError('No streaming counterpart for the aggregation function ' + aggregation_function.__name__)
+    return streaming_aggregators[aggregation_function]()
+
+
+# Counterpart of federated_util.model_aggregation (without s-resampling, which needs all the models) for models that are given one at a
+# time, typically by a generator that trains each client and yields its model: each model is folded into the aggregation before the next
+# one is requested, so that only one client's model is alive at a time. If weights is set, the models are weighted by it (the mean only).
+def streaming_model_aggregation(global_model: nn.Module, models: Iterable[nn.Module], params: SimpleNamespace,
+                                weights: Optional[Iterable[float]] = None) -> None:
+    if params.resampling is not None:
+        raise ValueError('s-resampling is not supported by the streaming aggregation')
+    aggregator = get_streaming_aggregator(params.aggregation_function)
+    if weights is None:
+        for model in models:
+            aggregator.add(model)
+    else:
+        for model, weight in zip(models, weights):
+            aggregator.add(model, weight)
+    aggregator.aggregate_into(global_model)
+
+
+# Aggregation of models that are all computed before being aggregated, such as the thresholds of the clients: if
+# params.streaming_aggregation is set, they are folded one at a time into the streaming counterpart of the aggregation function (see
+# main.py), otherwise they are aggregated all at once by model_aggregation. In both cases the global model is then distributed back to the
+# models.
+def aggregate_models(global_model: nn.Module, models: List[nn.Module], params: SimpleNamespace, verbose: bool = False) \
+        -> Tuple[nn.Module, List[nn.Module]]:
+    if not params.streaming_aggregation:
+        return model_aggregation(global_model, models, params, verbose=verbose)
+
+    streaming_model_aggregation(global_model, models, params)
+    broadcast_global_model(global_model, models)
+    return global_model, models
+
+
+# The streaming FedAvg rounds train the clients one at a time from the global model (see streaming_federated_round), so the options that
+# need all the clients' models at once are rejected: s-resampling, the model poisoning attacks (which copy or cancel the other clients'
+# models) and the batched training of the clients
+def check_streaming_aggregation(params: SimpleNamespace) -> None:
+    get_streaming_aggregator(params.aggregation_function)
+    if params.resampling is not None:
+        raise ValueError('s-resampling is not supported by the streaming aggregation')
+    if params.model_poisoning is not None:
+        raise ValueError('The model poisoning attacks are not supported by the streaming aggregation')
+    if params.batched_clients:
+        raise ValueError('The clients cannot be trained in a batch with the streaming aggregation')
+
+
+# Streaming counterpart of federated_util.init_federated_models: the normalization values of each client are computed on a temporary copy
+# of the global model and folded right away into the global ones (their min and max with the min-max normalization, their mean otherwise),
+# so that no client model is kept. Only the global model is returned.
+def init_streaming_global_model(train_dls: List[DataLoader], params: SimpleNamespace, architecture: Callable) -> NormalizingModel:
+    global_model = new_global_model(params, architecture)
+    aggregator = StreamingMean()
+    sub, max_value = None, None
+
+    Ctp.enter_section('Computing the normalization values for each client', Color.RED)
+    for train_dl in train_dls:
+        model = deepcopy(global_model)
+        set_model_sub_div(params.normalization, model, train_dl)
+        if params.normalization == 'min-max':
+            sub = model.sub.data if sub is None else torch.min(sub, model.sub.data)
+            max_value = model.sub.data + model.div.data if max_value is None else torch.max(max_value, model.sub.data + model.div.data)
+        else:
+            aggregator.add(model)
+    Ctp.exit_section()
+
+    if params.normalization == 'min-max':
+        global_model.set_sub_div(sub, max_value - sub)
+    else:
+        aggregator.aggregate_into(global_model)
+    return global_model
+
+
+# FedAvg round in which the clients are trained one after the other, each on a copy of the global model that is folded into the streaming
+# aggregation and released as soon as it is trained: a single client's model is alive at a time, whatever the number of clients. trains
+# is the list of the (title, dataloader) of the clients and train_function is train_autoencoder or train_classifier. The updates of the
+# malicious clients are scaled by params.model_update_factor before being folded in. The global model is only replaced by the aggregation
+# after the last client, and the number of epochs of each client is returned.
+def streaming_federated_round(global_model: nn.Module, trains: List[Tuple[str, DataLoader]], params: SimpleNamespace,
+                              train_function: Callable[..., int], lr_factor: float = 1.0, main_title: str = 'Training the clients',
+                              color: Union[str, Color] = Color.NONE) -> List[int]:
+    aggregator = get_streaming_aggregator(params.aggregation_function)
+    n_epochs = []
+
+    Ctp.enter_section(main_title, color)
+    for client_id, (title, dataloader) in enumerate(trains):
+        Ctp.enter_section('[{}/{}] '.format(client_id + 1, len(trains)) + title + ' ({} samples)'.format(get_n_samples(dataloader)),
+                          color=Color.NONE, header='      ')
+        model = deepcopy(global_model)
+        n_epochs.append(train_function(model, params, dataloader, lr_factor))
+        if client_id in params.malicious_clients:
+            model_update_scaling(global_model=global_model, malicious_clients_models=[model], factor=params.model_update_factor)
+        aggregator.add(model)
+        del model
+        Ctp.exit_section()
+    Ctp.exit_section()
+
+    aggregator.aggregate_into(global_model)
+    return n_epochs
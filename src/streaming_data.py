@@ -0,0 +1,172 @@
+from types import SimpleNamespace
+from typing import List, Optional, Iterator, Tuple, Callable, Union
+
+import numpy as np
+import pandas as pd
+import torch
+
+from data import all_devices, get_device_csv_paths, get_cache_array_path, read_cache_manifest, is_cache_fresh, ClientData
+
+
+# A traffic file (CSV or binary .npy shard in the N-BaIoT format) of which only the rows [start, stop) are used
+class StreamingFile:
+    def __init__(self, path: str, key: str, start: int = 0, stop: Optional[int] = None) -> None:
+        self.path = path
+        self.key = key
+        self.start = start
+        self.stop = stop
+        self.n_rows = None
+
+    def is_binary(self) -> bool:
+        return self.path.endswith('.npy')
+
+    def count_rows(self) -> int:
+        if self.n_rows is None:
+            if self.is_binary():
+                total_rows = np.load(self.path, mmap_mode='r').shape[0]
+            else:
+                with open(self.path, 'r') as infile:
+                    total_rows = sum(1 for _ in infile) - 1  # We do not count the header
+            stop = total_rows if self.stop is None else min(self.stop, total_rows)
+            self.n_rows = max(stop - self.start, 0)
+        return self.n_rows
+
+    # Yields the rows of the file as float32 arrays of at most chunk_size rows, so that the file is never entirely in memory
+    def iter_chunks(self, chunk_size: int) -> Iterator[np.ndarray]:
+        stop = self.start + self.count_rows()
+        if self.is_binary():
+            arr = np.load(self.path, mmap_mode='r')
+            for chunk_start in range(self.start, stop, chunk_size):
+                yield np.array(arr[chunk_start:min(chunk_start + chunk_size, stop)], dtype=np.float32)
+        else:
+            reader = pd.read_csv(self.path, skiprows=range(1, self.start + 1), nrows=stop - self.start, chunksize=chunk_size)
+            for chunk in reader:
+                yield chunk.to_numpy(dtype=np.float32)
+
+
+# The rows of a traffic key that are already an array, such as the splits of the device data (which are memory-mapped from the binary cache
+# of the dataset, see data.read_device_data). Only the chunk being read is copied, so the pages of the other rows stay on disk.
+class StreamingArray:
+    def __init__(self, array: np.ndarray, key: str) -> None:
+        self.array = array
+        self.key = key
+
+    def count_rows(self) -> int:
+        return len(self.array)
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[np.ndarray]:
+        for chunk_start in range(0, len(self.array), chunk_size):
+            yield np.array(self.array[chunk_start:chunk_start + chunk_size], dtype=np.float32)
+
+
+# The data of a client that is read chunk by chunk from its files (or arrays) instead of being held in memory. Its length is its number of
+# rows.
+class StreamingSource:
+    def __init__(self, files: List[Union[StreamingFile, StreamingArray]], n_features: int = 115) -> None:
+        self.files = files
+        self.n_features = n_features
+
+    def __len__(self) -> int:
+        return sum(streaming_file.count_rows() for streaming_file in self.files)
+
+    # The files are read in a random order if rng is specified
+    def iter_chunks(self, chunk_size: int, rng: Optional[np.random.Generator] = None) -> Iterator[Tuple[str, np.ndarray]]:
+        file_order = rng.permutation(len(self.files)) if rng is not None else range(len(self.files))
+        for file_id in file_order:
+            streaming_file = self.files[file_id]
+            for chunk in streaming_file.iter_chunks(chunk_size):
+                if chunk.shape[1] != self.n_features:
+                    name = streaming_file.path if isinstance(streaming_file, StreamingFile) else streaming_file.key
+                    raise ValueError('{} has {} features instead of {}'.format(name, chunk.shape[1], self.n_features))
+                yield streaming_file.key, chunk
+
+
+# Iterates over a StreamingSource batch by batch, like a TensorDataLoader over a dataset would (including the len, batch_size and dataset
+# attributes used by the training loops), while only holding one chunk of rows in memory. Batches can span several chunks and files, so
+# that all the batches but the last one are full. When shuffling, the order of the files and the order of the rows within each chunk
+# are randomized (the shuffling is therefore local to chunks of chunk_size rows). Like a TensorDataLoader, each epoch draws a number from
+# the global generator when the iterator is created, which seeds the generator of the shuffling.
+# If target_function is specified, each batch is a (data, target) tuple where target_function(key, n_rows) gives the targets of the rows
+# of a traffic key (see supervised_data.get_target_tensor), otherwise it is a (data,) tuple.
+class StreamingDataLoader:
+    def __init__(self, source: StreamingSource, batch_size: int, chunk_size: int = 100_000, shuffle: bool = False,
+                 target_function: Optional[Callable[[str, int], torch.Tensor]] = None, cuda: bool = False) -> None:
+        self.dataset = source
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.shuffle = shuffle
+        self.target_function = target_function
+        self.cuda = cuda
+
+    def __len__(self) -> int:
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __make_batch(self, data: np.ndarray, target: Optional[torch.Tensor]) -> tuple:
+        batch = (torch.from_numpy(data),) if target is None else (torch.from_numpy(data), target)
+        if self.cuda:
+            batch = tuple(tensor.cuda() for tensor in batch)
+        return batch
+
+    def __iter__(self) -> Iterator[tuple]:
+        seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        return self.__iter_batches(np.random.default_rng([seed]) if self.shuffle else None)
+
+    def __iter_batches(self, rng: Optional[np.random.Generator]) -> Iterator[tuple]:
+        with_targets = self.target_function is not None
+        remaining_data, remaining_target = None, None
+        for key, chunk in self.dataset.iter_chunks(self.chunk_size, rng=rng):
+            target = self.target_function(key, len(chunk)) if with_targets else None
+            if rng is not None:
+                permutation = rng.permutation(len(chunk))
+                chunk = chunk[permutation]
+                target = target[permutation] if with_targets else None
+
+            # Prepend the rows left over from the previous chunk
+            if remaining_data is not None:
+                chunk = np.concatenate((remaining_data, chunk), axis=0)
+                target = torch.cat((remaining_target, target), dim=0) if with_targets else None
+
+            n_full_batches = len(chunk) // self.batch_size
+            for i in range(n_full_batches):
+                start, end = i * self.batch_size, (i + 1) * self.batch_size
+                yield self.__make_batch(chunk[start:end], target[start:end] if with_targets else None)
+
+            end = n_full_batches * self.batch_size
+            remaining_data = chunk[end:] if end < len(chunk) else None
+            remaining_target = target[end:] if (with_targets and remaining_data is not None) else None
+
+        if remaining_data is not None:
+            yield self.__make_batch(remaining_data, remaining_target)
+
+    # Yields the data of each chunk (without targets and without shuffling), used for example to compute the normalization values online
+    def iter_data_chunks(self) -> Iterator[torch.Tensor]:
+        for _, chunk in self.dataset.iter_chunks(self.chunk_size):
+            yield torch.from_numpy(chunk)
+
+
+# Returns a streaming source over the files of the devices (the whole files, or only the rows [start, stop) of each file). The binary
+# shards of the cache are used when they are up to date, otherwise the CSVs are read.
+def get_devices_streaming_source(device_ids: List[int], keys: Optional[List[str]] = None, start: int = 0, stop: Optional[int] = None,
+                                 use_cache: bool = True) -> StreamingSource:
+    files = []
+    for device_id in device_ids:
+        device = all_devices[device_id]
+        manifest = read_cache_manifest(device) if use_cache else {}
+        for key, csv_path in get_device_csv_paths(device).items():
+            if keys is not None and key not in keys:
+                continue
+            path = get_cache_array_path(device, key) if (use_cache and is_cache_fresh(manifest, device, key, csv_path)) else csv_path
+            files.append(StreamingFile(path, key, start=start, stop=stop))
+    return StreamingSource(files)
+
+
+# Returns a streaming source over the rows of the data of a client (e.g. its train split), in the order of its devices and keys
+def get_client_streaming_source(client_data: ClientData, n_features: int = 115) -> StreamingSource:
+    return StreamingSource([StreamingArray(arr, key) for device_data in client_data for key, arr in device_data.items()], n_features)
+
+
+# The streamed train sets are the whole train splits read as they are (see params.streaming_chunk_size in main.py), so they cannot be thinned
+# or compacted, which needs all their rows at once
+def check_streaming_params(params: SimpleNamespace) -> None:
+    if params.thinning is not None or params.compact_datasets:
+        raise ValueError('The streamed train sets cannot be thinned or compacted')
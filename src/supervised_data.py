@@ -1,24 +1,29 @@
+from functools import partial
 from types import SimpleNamespace
-from typing import List, Tuple, Optional, Set
+from typing import List, Tuple, Optional, Set, Union
 
 import numpy as np
 import torch
 import torch.utils
 import torch.utils.data
 # noinspection PyProtectedMember
-from torch.utils.data import DataLoader, Dataset, TensorDataset
+from torch.utils.data import Dataset
 
-from data import multiclass_labels, ClientData, FederationData, split_client_data, resample_array, get_benign_attack_samples_per_device
+from dataset_cache import dataset_cache
+from data import multiclass_labels, ClientData, FederationData, split_client_data, get_benign_attack_samples_per_device
+from streaming_data import StreamingDataLoader, get_client_streaming_source, check_streaming_params
+from tensor_datasets import ResampledDatasetBuilder, compact_dataset, TensorDataLoader
+from thinning import thin_clients_data, thin_samples_per_device
 
 
-def get_target_tensor(key: str, arr: np.ndarray, multiclass: bool = False,
+def get_target_tensor(key: str, n_samples: int, multiclass: bool = False,
                       poisoning: Optional[str] = None, p_poison: Optional[float] = None) -> torch.Tensor:
     if multiclass:
         if poisoning is not None:
             raise NotImplementedError('Poisoning not implemented for multiclass data')
-        return torch.full((arr.shape[0], 1), multiclass_labels[key])
+        return torch.full((n_samples, 1), multiclass_labels[key])
     else:
-        target = torch.full((arr.shape[0], 1), (0. if key == 'benign' else 1.))
+        target = torch.full((n_samples, 1), (0. if key == 'benign' else 1.))
         if poisoning is not None:
             if poisoning == 'all_labels_flipping' \
                     or (poisoning == 'benign_labels_flipping' and key == 'benign') \
@@ -34,10 +39,13 @@ def get_target_tensor(key: str, arr: np.ndarray, multiclass: bool = False,
 
 
 # Creates a dataset with the given client's data. If n_benign and n_attack are specified, up or down sampling will be used to have the right
-# amount of that class of data. The data can also be poisoned if needed.
-def get_dataset(data: ClientData, benign_samples_per_device: Optional[int] = None, attack_samples_per_device: Optional[int] = None,
-                cuda: bool = False, multiclass: bool = False, poisoning: Optional[str] = None, p_poison: Optional[float] = None) -> Dataset:
-    data_list, target_list = [], []
+# amount of that class of data. The resampling is virtual: the dataset only stores the source rows once along with the resampled indexes.
+# The data can also be poisoned if needed. If compact is set, the identical rows are merged into a CompactDataset.
+def build_dataset(data: ClientData, benign_samples_per_device: Optional[int] = None, attack_samples_per_device: Optional[int] = None,
+                  cuda: bool = False, multiclass: bool = False, poisoning: Optional[str] = None, p_poison: Optional[float] = None,
+                  compact: bool = False) -> Dataset:
+    builder = ResampledDatasetBuilder()
+    target_list = []
     resample = benign_samples_per_device is not None and attack_samples_per_device is not None
 
     for device_data in data:
@@ -48,61 +56,82 @@ def get_dataset(data: ClientData, benign_samples_per_device: Optional[int] = Non
         for key, arr in device_data.items():  # This will iterate over the benign splits, gafgyt splits and mirai splits (if applicable)
             if resample:
                 if key == 'benign':
-                    arr = resample_array(arr, benign_samples_per_device)
+                    n_samples = builder.add(arr, benign_samples_per_device)
                 else:
                     # We evenly divide the attack samples among the existing attacks on that device
-                    arr = resample_array(arr, n_samples_attack)
+                    n_samples = builder.add(arr, n_samples_attack)
+            else:
+                n_samples = builder.add(arr)
 
-            data_tensor = torch.tensor(arr).float()
-            target_tensor = get_target_tensor(key, arr, multiclass=multiclass, poisoning=poisoning, p_poison=p_poison)
-            if cuda:
-                data_tensor = data_tensor.cuda()
-                target_tensor = target_tensor.cuda()
-            data_list.append(data_tensor)
-            target_list.append(target_tensor)
+            target_list.append(get_target_tensor(key, n_samples, multiclass=multiclass, poisoning=poisoning, p_poison=p_poison))
 
-    dataset = TensorDataset(torch.cat(data_list, dim=0), torch.cat(target_list, dim=0))
+    dataset = builder.build(torch.cat(target_list, dim=0), cuda=cuda)
+    if compact:
+        dataset = compact_dataset(dataset)
     return dataset
 
 
+# Same as build_dataset, but the dataset is only built once for all the runs (and configurations) that use it. The poisoned datasets are
+# not cached since the label flipping is random.
+def get_dataset(data: ClientData, benign_samples_per_device: Optional[int] = None, attack_samples_per_device: Optional[int] = None,
+                cuda: bool = False, multiclass: bool = False, poisoning: Optional[str] = None, p_poison: Optional[float] = None,
+                compact: bool = False) -> Dataset:
+    def build() -> Dataset:
+        return build_dataset(data, benign_samples_per_device=benign_samples_per_device, attack_samples_per_device=attack_samples_per_device,
+                             cuda=cuda, multiclass=multiclass, poisoning=poisoning, p_poison=p_poison, compact=compact)
+
+    if poisoning is not None:
+        return build()
+    return dataset_cache.get(data, ('supervised', benign_samples_per_device, attack_samples_per_device, cuda, multiclass, compact), build)
+
+
 def get_train_dl(client_train_data: ClientData, train_bs: int, benign_samples_per_device: Optional[int] = None,
                  attack_samples_per_device: Optional[int] = None,
                  cuda: bool = False, multiclass: bool = False, poisoning: Optional[str] = None,
-                 p_poison: Optional[float] = None) -> DataLoader:
+                 p_poison: Optional[float] = None, compact: bool = False) -> TensorDataLoader:
     dataset_train = get_dataset(client_train_data, benign_samples_per_device=benign_samples_per_device,
                                 attack_samples_per_device=attack_samples_per_device, cuda=cuda,
-                                multiclass=multiclass, poisoning=poisoning, p_poison=p_poison)
-    train_dl = DataLoader(dataset_train, batch_size=train_bs, shuffle=True)
+                                multiclass=multiclass, poisoning=poisoning, p_poison=p_poison, compact=compact)
+    train_dl = TensorDataLoader(dataset_train, batch_size=train_bs, shuffle=True)
     return train_dl
 
 
 def get_test_dl(client_test_data: ClientData, test_bs: int, benign_samples_per_device: Optional[int] = None,
                 attack_samples_per_device: Optional[int] = None,
-                cuda: bool = False, multiclass: bool = False) -> DataLoader:
+                cuda: bool = False, multiclass: bool = False, compact: bool = False) -> TensorDataLoader:
     dataset_test = get_dataset(client_test_data, benign_samples_per_device=benign_samples_per_device,
-                               attack_samples_per_device=attack_samples_per_device, cuda=cuda, multiclass=multiclass)
-    test_dl = DataLoader(dataset_test, batch_size=test_bs)
+                               attack_samples_per_device=attack_samples_per_device, cuda=cuda, multiclass=multiclass, compact=compact)
+    test_dl = TensorDataLoader(dataset_test, batch_size=test_bs)
     return test_dl
 
 
 def get_train_dls(train_data: FederationData, train_bs: int, malicious_clients: Set[int],
                   benign_samples_per_device: Optional[int] = None, attack_samples_per_device: Optional[int] = None, cuda: bool = False,
                   multiclass: bool = False, poisoning: Optional[str] = None,
-                  p_poison: Optional[float] = None) -> List[DataLoader]:
+                  p_poison: Optional[float] = None, compact: bool = False) -> List[TensorDataLoader]:
     train_dls = [get_train_dl(client_train_data, train_bs,
                               benign_samples_per_device=benign_samples_per_device, attack_samples_per_device=attack_samples_per_device,
                               cuda=cuda, multiclass=multiclass,
                               poisoning=(poisoning if client_id in malicious_clients else None),
-                              p_poison=(p_poison if client_id in malicious_clients else None))
+                              p_poison=(p_poison if client_id in malicious_clients else None), compact=compact)
                  for client_id, client_train_data in enumerate(train_data)]
     return train_dls
 
 
+# Streaming counterpart of get_train_dls (see streaming_data.py): the training loops read the rows of the train splits chunk by chunk instead
+# of iterating over a dataset holding them. The whole splits are streamed, without resampling them to the numbers of samples per device.
+def get_streaming_train_dls(train_data: FederationData, train_bs: int, chunk_size: int, n_features: int = 115, cuda: bool = False,
+                            multiclass: bool = False) -> List[StreamingDataLoader]:
+    return [StreamingDataLoader(get_client_streaming_source(client_train_data, n_features), train_bs, chunk_size=chunk_size, shuffle=True,
+                                target_function=partial(get_target_tensor, multiclass=multiclass), cuda=cuda)
+            for client_train_data in train_data]
+
+
 def get_test_dls(test_data: FederationData, test_bs: int, benign_samples_per_device: Optional[int] = None,
                  attack_samples_per_device: Optional[int] = None,
-                 cuda: bool = False, multiclass: bool = False) -> List[DataLoader]:
+                 cuda: bool = False, multiclass: bool = False, compact: bool = False) -> List[TensorDataLoader]:
     test_dls = [get_test_dl(client_test_data, test_bs, benign_samples_per_device=benign_samples_per_device,
-                            attack_samples_per_device=attack_samples_per_device, cuda=cuda, multiclass=multiclass)
+                            attack_samples_per_device=attack_samples_per_device, cuda=cuda, multiclass=multiclass, compact=compact)
                 for client_test_data in test_data]
     return test_dls
 
@@ -113,7 +142,8 @@ def get_client_supervised_initial_splitting(client_data: ClientData, p_test: flo
 
 
 def prepare_dataloaders(train_data: FederationData, local_test_data: FederationData, new_test_data: ClientData, params: SimpleNamespace,
-                        federated: bool = False) -> Tuple[List[DataLoader], List[DataLoader], DataLoader]:
+                        federated: bool = False) \
+        -> Tuple[List[Union[TensorDataLoader, StreamingDataLoader]], List[TensorDataLoader], TensorDataLoader]:
     if federated:
         malicious_clients = params.malicious_clients
         poisoning = params.data_poisoning
@@ -124,18 +154,29 @@ def prepare_dataloaders(train_data: FederationData, local_test_data: FederationD
         p_poison = None
 
     # Creating the dataloaders
-    benign_samples_per_device, attack_samples_per_device = get_benign_attack_samples_per_device(p_split=params.p_train_val,
-                                                                                                benign_prop=params.benign_prop,
-                                                                                                samples_per_device=params.samples_per_device)
-    train_dls = get_train_dls(train_data, params.train_bs, malicious_clients=malicious_clients, benign_samples_per_device=benign_samples_per_device,
-                              attack_samples_per_device=attack_samples_per_device, cuda=params.cuda, poisoning=poisoning, p_poison=p_poison)
+    if params.streaming_chunk_size is not None:
+        check_streaming_params(params)
+        if poisoning is not None and len(malicious_clients) > 0:
+            raise ValueError('The streamed train sets cannot be poisoned')
+        train_dls = get_streaming_train_dls(train_data, params.train_bs, params.streaming_chunk_size, n_features=params.n_features,
+                                            cuda=params.cuda)
+    else:
+        benign_samples_per_device, attack_samples_per_device = get_benign_attack_samples_per_device(p_split=params.p_train_val,
+                                                                                                    benign_prop=params.benign_prop,
+                                                                                                    samples_per_device=params.samples_per_device)
+        train_data = thin_clients_data(train_data, params.thinning, params.thinning_ratio)
+        benign_samples_per_device = thin_samples_per_device(benign_samples_per_device, params.thinning, params.thinning_ratio)
+        attack_samples_per_device = thin_samples_per_device(attack_samples_per_device, params.thinning, params.thinning_ratio)
+        train_dls = get_train_dls(train_data, params.train_bs, malicious_clients=malicious_clients,
+                                  benign_samples_per_device=benign_samples_per_device, attack_samples_per_device=attack_samples_per_device,
+                                  cuda=params.cuda, poisoning=poisoning, p_poison=p_poison, compact=params.compact_datasets)
 
     benign_samples_per_device, attack_samples_per_device = get_benign_attack_samples_per_device(p_split=params.p_test, benign_prop=params.benign_prop,
                                                                                                 samples_per_device=params.samples_per_device)
     local_test_dls = get_test_dls(local_test_data, params.test_bs, benign_samples_per_device=benign_samples_per_device,
-                                  attack_samples_per_device=attack_samples_per_device, cuda=params.cuda)
+                                  attack_samples_per_device=attack_samples_per_device, cuda=params.cuda, compact=params.compact_datasets)
 
     new_test_dl = get_test_dl(new_test_data, params.test_bs, benign_samples_per_device=benign_samples_per_device,
-                              attack_samples_per_device=attack_samples_per_device, cuda=params.cuda)
+                              attack_samples_per_device=attack_samples_per_device, cuda=params.cuda, compact=params.compact_datasets)
 
     return train_dls, local_test_dls, new_test_dl
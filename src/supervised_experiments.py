@@ -1,5 +1,5 @@
 from types import SimpleNamespace
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 
 import torch
 from context_printer import Color
@@ -9,15 +9,22 @@ from torch.utils.data import DataLoader
 
 from architectures import BinaryClassifier, NormalizingModel
 from data import ClientData, FederationData, device_names, get_benign_attack_samples_per_device
-from federated_util import init_federated_models, model_aggregation, select_mimicked_client, model_poisoning
+from early_stopping import get_early_stopping
+from federated_util import init_federated_models, select_mimicked_client, model_poisoning, broadcast_global_model, model_aggregation
 from metrics import BinaryClassificationResult
 from ml import set_model_sub_div, set_models_sub_divs
 from print_util import print_federation_round, print_rates, print_federation_epoch
+from streaming_aggregation import check_streaming_aggregation, init_streaming_global_model, streaming_federated_round
 from supervised_data import get_train_dl, get_test_dl, prepare_dataloaders
-from supervised_ml import multitrain_classifiers, multitest_classifiers, train_classifier, test_classifier, train_classifiers_fedsgd
+from supervised_ml import multitrain_classifiers, multitest_classifiers, train_classifier, test_classifier, train_classifiers_fedsgd, \
+    compute_classifier_loss
+from tensor_datasets import get_n_samples
+from thinning import thin_clients_data, thin_samples_per_device
 
 
-def local_classifier_train_val(train_data: ClientData, val_data: ClientData, params: SimpleNamespace) -> BinaryClassificationResult:
+# The number of epochs made by the training is appended to trained_epochs if it is specified
+def local_classifier_train_val(train_data: ClientData, val_data: ClientData, params: SimpleNamespace,
+                               trained_epochs: Optional[List[int]] = None) -> BinaryClassificationResult:
     p_train = params.p_train_val * (1. - params.val_part)
     p_val = params.p_train_val * params.val_part
 
@@ -25,13 +32,16 @@ def local_classifier_train_val(train_data: ClientData, val_data: ClientData, par
     benign_samples_per_device, attack_samples_per_device = get_benign_attack_samples_per_device(p_split=p_train,
                                                                                                 benign_prop=params.benign_prop,
                                                                                                 samples_per_device=params.samples_per_device)
+    train_data = thin_clients_data([train_data], params.thinning, params.thinning_ratio)[0]
+    benign_samples_per_device = thin_samples_per_device(benign_samples_per_device, params.thinning, params.thinning_ratio)
+    attack_samples_per_device = thin_samples_per_device(attack_samples_per_device, params.thinning, params.thinning_ratio)
     train_dl = get_train_dl(train_data, params.train_bs, benign_samples_per_device=benign_samples_per_device,
-                            attack_samples_per_device=attack_samples_per_device, cuda=params.cuda)
+                            attack_samples_per_device=attack_samples_per_device, cuda=params.cuda, compact=params.compact_datasets)
 
     benign_samples_per_device, attack_samples_per_device = get_benign_attack_samples_per_device(p_split=p_val, benign_prop=params.benign_prop,
                                                                                                 samples_per_device=params.samples_per_device)
     val_dl = get_test_dl(val_data, params.test_bs, benign_samples_per_device=benign_samples_per_device,
-                         attack_samples_per_device=attack_samples_per_device, cuda=params.cuda)
+                         attack_samples_per_device=attack_samples_per_device, cuda=params.cuda, compact=params.compact_datasets)
 
     # Initialize the model and compute the normalization values with the client's local training data
     model = NormalizingModel(BinaryClassifier(activation_function=params.activation_fn, hidden_layers=params.hidden_layers),
@@ -43,21 +53,24 @@ def local_classifier_train_val(train_data: ClientData, val_data: ClientData, par
     set_model_sub_div(params.normalization, model, train_dl)
 
     # Local training
-    Ctp.enter_section('Training for {} epochs with {} samples'.format(params.epochs, len(train_dl.dataset[:][0])), color=Color.GREEN)
-    train_classifier(model, params, train_dl)
+    Ctp.enter_section('Training for {} epochs with {} samples'.format(params.epochs, get_n_samples(train_dl)), color=Color.GREEN)
+    n_epochs = train_classifier(model, params, train_dl, val_loader=val_dl)
     Ctp.exit_section()
+    if trained_epochs is not None:
+        trained_epochs.append(n_epochs)
 
     # Local validation
-    Ctp.print('Validating with {} samples'.format(len(val_dl.dataset[:][0])))
+    Ctp.print('Validating with {} samples'.format(get_n_samples(val_dl)))
     result = test_classifier(model, val_dl)
     print_rates(result)
 
     return result
 
 
+# The last element of the returned tuple records the training actually made: the number of epochs of each client
 def local_classifiers_train_test(train_data: FederationData, local_test_data: FederationData,
                                  new_test_data: ClientData, params: SimpleNamespace) \
-        -> Tuple[BinaryClassificationResult, BinaryClassificationResult]:
+        -> Tuple[BinaryClassificationResult, BinaryClassificationResult, dict]:
     train_dls, local_test_dls, new_test_dl = prepare_dataloaders(train_data, local_test_data, new_test_data, params, federated=False)
 
     # Initialize the models and compute the normalization values with each client's local training data
@@ -71,25 +84,25 @@ def local_classifiers_train_test(train_data: FederationData, local_test_data: Fe
     set_models_sub_divs(params.normalization, models, train_dls, color=Color.RED)
 
     # Training
-    multitrain_classifiers(trains=list(zip(['Training client {} on: '.format(i) + device_names(client_devices)
-                                            for i, client_devices in enumerate(params.clients_devices)],
-                                           train_dls, models)),
-                           params=params, main_title='Training the clients', color=Color.GREEN)
+    n_epochs = multitrain_classifiers(trains=list(zip(['Training client {} on: '.format(i) + device_names(params.devices, client_devices)
+                                                       for i, client_devices in enumerate(params.clients_devices)],
+                                                      train_dls, models)),
+                                      params=params, main_title='Training the clients', color=Color.GREEN)
 
     # Local testing
-    local_result = multitest_classifiers(tests=list(zip(['Testing client {} on: '.format(i) + device_names(client_devices)
+    local_result = multitest_classifiers(tests=list(zip(['Testing client {} on: '.format(i) + device_names(params.devices, client_devices)
                                                          for i, client_devices in enumerate(params.clients_devices)],
                                                         local_test_dls, models)),
                                          main_title='Testing the clients on their own devices', color=Color.BLUE)
 
     # New devices testing
     new_devices_result = multitest_classifiers(
-        tests=list(zip(['Testing client {} on: '.format(i) + device_names(params.test_devices) for i in range(n_clients)],
+        tests=list(zip(['Testing client {} on: '.format(i) + device_names(params.devices, params.test_devices) for i in range(n_clients)],
                        [new_test_dl for _ in range(n_clients)], models)),
-        main_title='Testing the clients on the new devices: ' + device_names(params.test_devices),
+        main_title='Testing the clients on the new devices: ' + device_names(params.devices, params.test_devices),
         color=Color.DARK_CYAN)
 
-    return local_result, new_devices_result
+    return local_result, new_devices_result, {'epochs': n_epochs}
 
 
 def federated_testing(global_model: torch.nn.Module, local_test_dls: List[DataLoader], new_test_dl: DataLoader,
@@ -100,7 +113,8 @@ def federated_testing(global_model: torch.nn.Module, local_test_dls: List[DataLo
     tests = []
     for client_id, client_devices in enumerate(params.clients_devices):
         if client_id not in params.malicious_clients:
-            tests.append(('Testing global model on: ' + device_names(client_devices), local_test_dls[client_id], global_model))
+            tests.append(('Testing global model on: ' + device_names(params.devices, client_devices), local_test_dls[client_id],
+                          global_model))
 
     result = multitest_classifiers(tests=tests,
                                    main_title='Testing the global model on data from all clients', color=Color.BLUE)
@@ -108,20 +122,37 @@ def federated_testing(global_model: torch.nn.Module, local_test_dls: List[DataLo
 
     # Global model testing on new devices
     result = multitest_classifiers(
-        tests=list(zip(['Testing global model on: ' + device_names(params.test_devices)], [new_test_dl], [global_model])),
-        main_title='Testing the global model on the new devices: ' + device_names(params.test_devices),
+        tests=list(zip(['Testing global model on: ' + device_names(params.devices, params.test_devices)], [new_test_dl], [global_model])),
+        main_title='Testing the global model on the new devices: ' + device_names(params.devices, params.test_devices),
         color=Color.DARK_CYAN)
     new_devices_results.append(result)
 
 
+# Federated training loss of the global model: its loss on the training set of each client (the federated classifiers have no
+# validation set), averaged over the clients weighted by their numbers of samples
+def federated_training_loss(global_model: torch.nn.Module, train_dls: List[DataLoader]) -> float:
+    n_samples = [get_n_samples(dataloader) for dataloader in train_dls]
+    losses = [compute_classifier_loss(global_model, dataloader) for dataloader in train_dls]
+    return sum(loss * client_n_samples for loss, client_n_samples in zip(losses, n_samples)) / sum(n_samples)
+
+
+# The federation stops early if params.federated_early_stopping is specified and the federated training loss of the global model stops
+# decreasing. If it restores the best weights and the best round is not the last one, the global model of the best round is distributed
+# back to the clients and the results are computed again with it: they are appended after those of the rounds made, so that the last
+# results returned are those of the restored model. The last element of the returned tuple records the training actually made: the number
+# of rounds, the round with the best training loss, the round restored (None if none) and the number of epochs of each client in each round.
 def fedavg_classifiers_train_test(train_data: FederationData, local_test_data: FederationData,
                                   new_test_data: ClientData, params: SimpleNamespace) \
-        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult]]:
+        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], dict]:
     # Preparation of the dataloaders
     train_dls, local_test_dls, new_test_dl = prepare_dataloaders(train_data, local_test_data, new_test_data, params, federated=True)
 
-    # Initialization of the models
-    global_model, models = init_federated_models(train_dls, params, architecture=BinaryClassifier)
+    # Initialization of the models. With the streaming aggregation, the models of the clients only exist while they are trained.
+    if params.streaming_aggregation:
+        check_streaming_aggregation(params)
+        global_model, models = init_streaming_global_model(train_dls, params, architecture=BinaryClassifier), None
+    else:
+        global_model, models = init_federated_models(train_dls, params, architecture=BinaryClassifier)
 
     # Initialization of the results
     local_results, new_devices_results = [], []
@@ -129,33 +160,61 @@ def fedavg_classifiers_train_test(train_data: FederationData, local_test_data: F
     # Selection of a client to mimic in case we use the mimic attack
     mimicked_client_id = select_mimicked_client(params)
 
+    client_titles = ['Training client {} on: '.format(i) + device_names(params.devices, client_devices)
+                     for i, client_devices in enumerate(params.clients_devices)]
+    early_stopping = get_early_stopping(params.federated_early_stopping)
+    rounds_epochs = []
     for federation_round in range(params.federation_rounds):
         print_federation_round(federation_round, params.federation_rounds)
 
         # Local training of each client
-        multitrain_classifiers(trains=list(zip(['Training client {} on: '.format(i) + device_names(client_devices)
-                                                for i, client_devices in enumerate(params.clients_devices)],
-                                               train_dls, models)),
-                               params=params, lr_factor=(params.gamma_round ** federation_round),
-                               main_title='Training the clients', color=Color.GREEN)
-
-        # Model poisoning attacks
-        models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=True)
-
-        # Aggregation
-        global_model, models = model_aggregation(global_model, models, params, verbose=True)
+        lr_factor = params.gamma_round ** federation_round
+        if params.streaming_aggregation:
+            # Each model is aggregated as soon as it is trained. The global model is not distributed back to the clients: the next round
+            # copies it again.
+            clients_epochs = streaming_federated_round(global_model, list(zip(client_titles, train_dls)), params, train_classifier,
+                                                       lr_factor=lr_factor, main_title='Training the clients', color=Color.GREEN)
+        else:
+            clients_epochs = multitrain_classifiers(trains=list(zip(client_titles, train_dls, models)), params=params, lr_factor=lr_factor,
+                                                    main_title='Training the clients', color=Color.GREEN)
+
+            # Model poisoning attacks
+            models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=True)
+
+            # Aggregation
+            global_model, models = model_aggregation(global_model, models, params, verbose=True)
 
         # Testing
         federated_testing(global_model, local_test_dls, new_test_dl, params, local_results, new_devices_results)
+        rounds_epochs.append(clients_epochs)
 
+        stop = early_stopping is not None and early_stopping.step(federated_training_loss(global_model, train_dls), global_model)
+        Ctp.exit_section()
+        if stop:
+            break
+
+    # If the best round is not the last one, its global model is distributed back to the clients and tested again
+    restored_round = None
+    if early_stopping is not None and early_stopping.best_step != len(rounds_epochs) and early_stopping.restore(global_model):
+        restored_round = early_stopping.best_step
+        Ctp.enter_section('Restored global model of round {}'.format(restored_round), Color.DARK_GRAY)
+        if models is not None:
+            broadcast_global_model(global_model, models)
+        federated_testing(global_model, local_test_dls, new_test_dl, params, local_results, new_devices_results)
         Ctp.exit_section()
 
-    return local_results, new_devices_results
+    training = {'rounds': len(rounds_epochs), 'best_round': early_stopping.best_step if early_stopping is not None else None,
+                'restored_round': restored_round, 'epochs': rounds_epochs}
+    return local_results, new_devices_results, training
 
 
+# The last element of the returned tuple records the training actually made: the number of epochs
 def fedsgd_classifiers_train_test(train_data: FederationData, local_test_data: FederationData,
                                   new_test_data: ClientData, params: SimpleNamespace) \
-        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult]]:
+        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], dict]:
+    if params.streaming_aggregation:
+        raise ValueError('The streaming aggregation is only available with FedAvg: the FedSGD steps aggregate all the clients at once')
+
     # Preparation of the dataloaders
     train_dls, local_test_dls, new_test_dl = prepare_dataloaders(train_data, local_test_data, new_test_data, params, federated=True)
 
@@ -176,4 +235,4 @@ def fedsgd_classifiers_train_test(train_data: FederationData, local_test_data: F
         federated_testing(global_model, local_test_dls, new_test_dl, params, local_results, new_devices_results)
         Ctp.exit_section()
 
-    return local_results, new_devices_results
+    return local_results, new_devices_results, {'epochs': params.epochs}
@@ -8,75 +8,157 @@ from context_printer import ContextPrinter as Ctp
 # noinspection PyProtectedMember
 from torch.utils.data import DataLoader
 
+from architectures import NormalizingModel
+from batched_training import multitrain_batched
+from client_executor import client_executor, print_client_outputs
+from early_stopping import get_early_stopping
+from execution import execution_mode
 from federated_util import model_poisoning, model_aggregation
-from metrics import BinaryClassificationResult
-from print_util import print_train_classifier, print_train_classifier_header, print_rates
+from flat_util import FlatModels, can_use_flat_fedsgd, flat_model_poisoning, flat_model_aggregation
+from metrics import BinaryClassificationResult, ConfusionMatrix
+from normalized_data import normalized_data_cache
+from print_util import ClientPrinter, print_train_classifier, print_train_classifier_header, print_rates
+from tensor_datasets import is_compact, split_batch, get_n_samples
+
+
+# Output of the model (to be computed in the autocast context of execution.py), with its inner model run in the execution mode of
+# execution.py. If normalized is True, the data is already normalized (see normalized_data.py) and is given directly to the inner model.
+def forward(model: NormalizingModel, data: torch.Tensor, normalized: bool) -> torch.Tensor:
+    return execution_mode.inner_model(model)(data if normalized else model.normalize(data))
+
+
+# If weight is specified, each row counts as many times as its weight in the loss and in the result (the criterion should then not
+# reduce the loss). If optimizer is None, the gradients are only accumulated into the gradients of the parameters (which are then zeroed
+# and used by the caller, see flat_util.FlatModels). See forward for normalized. Returns the loss computed by the criterion.
+def optimize(model: nn.Module, data: torch.Tensor, label: torch.Tensor, optimizer: Optional[torch.optim.Optimizer],
+             criterion: torch.nn.Module, result: Optional[ConfusionMatrix] = None, weight: Optional[torch.Tensor] = None,
+             normalized: bool = False) -> torch.Tensor:
+    with execution_mode.autocast(data.device):
+        output = forward(model, data, normalized)
+        loss = criterion(output, label)
+    if optimizer is not None:
+        optimizer.zero_grad()
+    if weight is None:
+        loss.mean().backward()
+    else:
+        weight = weight.float()
+        ((loss.reshape(-1) * weight).sum() / weight.sum()).backward()
+    if optimizer is not None:
+        optimizer.step()
 
+    if result is not None:
+        result.update(torch.gt(output.detach(), 0.5), label, weight)
+    return loss
 
-def optimize(model: nn.Module, data: torch.Tensor, label: torch.Tensor, optimizer: torch.optim.Optimizer, criterion: torch.nn.Module,
-             result: Optional[BinaryClassificationResult] = None) -> None:
-    output = model(data)
-    loss = criterion(output, label)
-    optimizer.zero_grad()
-    loss.mean().backward()
-    optimizer.step()
 
-    pred = torch.gt(output, torch.tensor(0.5)).int()
-    if result is not None:
-        result.update(pred, label)
+# The loss is not reduced by the criterion when the rows of the dataloader are weighted
+def get_criterion(weighted: bool) -> nn.Module:
+    return nn.BCELoss(reduction='none') if weighted else nn.BCELoss()
+
+
+# Sum of the losses of the rows of a batch, from the loss returned by optimize (reduced by the criterion if the rows are not weighted)
+def get_batch_loss_sum(loss: torch.Tensor, n_rows: int, weight: Optional[torch.Tensor]) -> torch.Tensor:
+    return loss.detach() * n_rows if weight is None else (loss.detach().reshape(-1) * weight).sum()
 
 
-def train_classifier(model: nn.Module, params: SimpleNamespace, train_loader: DataLoader, lr_factor: float = 1.0) -> None:
-    criterion = nn.BCELoss()
+# Returns the number of epochs actually made, which is less than params.epochs if the training is stopped early (see early_stopping.py).
+# The validation loader is only used by the early stopping, when it monitors the validation loss. The output goes through the printer if
+# specified (see print_util.ClientPrinter).
+def train_classifier(model: nn.Module, params: SimpleNamespace, train_loader: DataLoader, lr_factor: float = 1.0,
+                     val_loader: Optional[DataLoader] = None, printer: Optional[ClientPrinter] = None) -> int:
+    printer = printer or ClientPrinter()
+    early_stopping = get_early_stopping(params.early_stopping)
+    weighted = is_compact(train_loader)
+    criterion = get_criterion(weighted)
     optimizer = params.optimizer(model.parameters(), **params.optimizer_params)
     for param_group in optimizer.param_groups:
         param_group['lr'] = param_group['lr'] * lr_factor
 
     scheduler = params.lr_scheduler(optimizer, **params.lr_scheduler_params)
+    train_loader, normalized = normalized_data_cache.get_dataloader(model, train_loader)
 
-    print_train_classifier_header()
+    printer(print_train_classifier_header)
     model.train()
 
+    n_epochs = 0
     for epoch in range(params.epochs):
+        n_epochs += 1
         lr = optimizer.param_groups[0]['lr']
-        result = BinaryClassificationResult()
-        for i, (data, label) in enumerate(train_loader):
-            optimize(model, data, label, optimizer, criterion, result)
+        # The confusion matrix is only used for the progress lines, so it is not accumulated if they are not printed
+        result = ConfusionMatrix() if params.verbose else None
+        loss_sum, n_rows = torch.zeros(()), 0
+        for i, batch in enumerate(train_loader):
+            (data, label), weight = split_batch(batch, weighted)
+            loss = optimize(model, data, label, optimizer, criterion, result, weight, normalized)
+            if early_stopping is not None:
+                loss_sum += get_batch_loss_sum(loss, len(data), weight)
+                n_rows += len(data) if weight is None else int(weight.sum().item())
+
+            if i % 1000 == 0 and result is not None:
+                printer(print_train_classifier, epoch, params.epochs, i, len(train_loader), result.result(), lr, persistent=False)
+
+        if result is not None:
+            printer(print_train_classifier, epoch, params.epochs, len(train_loader) - 1, len(train_loader), result.result(), lr,
+                    persistent=True)
 
-            if i % 1000 == 0:
-                print_train_classifier(epoch, params.epochs, i, len(train_loader), result, lr, persistent=False)
+        scheduler.step()
 
-        print_train_classifier(epoch, params.epochs, len(train_loader) - 1, len(train_loader), result, lr, persistent=True)
+        if early_stopping is not None:
+            if early_stopping.monitor == 'val' and val_loader is not None:
+                monitored_loss = compute_classifier_loss(model, val_loader)
+                model.train()
+            else:
+                monitored_loss = (loss_sum / max(n_rows, 1)).item()
+            if early_stopping.step(monitored_loss, model, printer):
+                break
 
-        scheduler.step()
+    if early_stopping is not None:
+        early_stopping.restore(model)
+    return n_epochs
 
 
 def train_classifiers_fedsgd(global_model: nn.Module, models: List[nn.Module], dls: List[DataLoader], params: SimpleNamespace, epoch: int,
                              lr_factor: float = 1.0, mimicked_client_id: Optional[int] = None) -> Tuple[torch.nn.Module, List[torch.nn.Module]]:
-    criterion = nn.BCELoss()
+    weighted = [is_compact(dl) for dl in dls]
+    criterions = [get_criterion(client_weighted) for client_weighted in weighted]
     lr = params.optimizer_params['lr'] * lr_factor
 
     # Set the models to train mode
     for model in models:
         model.train()
 
-    result = BinaryClassificationResult()
+    result = ConfusionMatrix() if params.verbose else None  # Only accumulated for the progress lines
     print_train_classifier_header()
 
+    dls, normalized = zip(*[normalized_data_cache.get_dataloader(model, dl) for model, dl in zip(models, dls)])
+    # With a plain SGD, the steps, the attacks and the aggregation are made on the rows of flat buffers of parameters
+    flat_models = FlatModels(global_model, models) if can_use_flat_fedsgd(params) else None
     for i, data_label_tuple in enumerate(zip(*dls)):
-        for model, (data, label) in zip(models, data_label_tuple):
-            optimizer = params.optimizer(model.parameters(), lr=lr, weight_decay=params.optimizer_params['weight_decay'])
-            optimize(model, data, label, optimizer, criterion, result)
-
-        # Model poisoning attacks
-        models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=False)
-
-        # Aggregation
-        global_model, models = model_aggregation(global_model, models, params, verbose=False)
-
-        if i % 100 == 0:
-            print_train_classifier(epoch, params.epochs, i, len(dls[0]), result, lr, persistent=False)
-    print_train_classifier(epoch, params.epochs, len(dls[0]) - 1, len(dls[0]), result, lr, persistent=True)
+        if flat_models is not None:
+            flat_models.zero_grad()
+        for model, batch, client_weighted, criterion, client_normalized in zip(models, data_label_tuple, weighted, criterions, normalized):
+            (data, label), weight = split_batch(batch, client_weighted)
+            if flat_models is not None:
+                optimize(model, data, label, None, criterion, result, weight, client_normalized)
+            else:
+                optimizer = params.optimizer(model.parameters(), lr=lr, weight_decay=params.optimizer_params['weight_decay'])
+                optimize(model, data, label, optimizer, criterion, result, weight, client_normalized)
+
+        if flat_models is not None:
+            flat_models.sgd_step(lr, params.optimizer_params['weight_decay'])
+            flat_model_poisoning(flat_models, params, mimicked_client_id=mimicked_client_id)
+            flat_model_aggregation(flat_models, params)
+        else:
+            # Model poisoning attacks
+            models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=False)
+
+            # Aggregation
+            global_model, models = model_aggregation(global_model, models, params, verbose=False)
+
+        if i % 100 == 0 and result is not None:
+            print_train_classifier(epoch, params.epochs, i, len(dls[0]), result.result(), lr, persistent=False)
+    if result is not None:
+        print_train_classifier(epoch, params.epochs, len(dls[0]) - 1, len(dls[0]), result.result(), lr, persistent=True)
 
     return global_model, models
 
@@ -84,28 +166,69 @@ def train_classifiers_fedsgd(global_model: nn.Module, models: List[nn.Module], d
 def test_classifier(model: nn.Module, test_loader: DataLoader) -> BinaryClassificationResult:
     with torch.no_grad():
         model.eval()
-        result = BinaryClassificationResult()
-        for i, (data, label) in enumerate(test_loader):
-            output = model(data)
+        confusion_matrix = ConfusionMatrix()
+        weighted = is_compact(test_loader)
+        test_loader, normalized = normalized_data_cache.get_dataloader(model, test_loader)
+        for i, batch in enumerate(test_loader):
+            (data, label), weight = split_batch(batch, weighted)
+            with execution_mode.autocast(data.device):
+                output = forward(model, data, normalized)
 
-            pred = torch.gt(output, torch.tensor(0.5)).int()
-            result.update(pred, label)
+            confusion_matrix.update(torch.gt(output, 0.5), label, weight)
 
-        return result
+        return confusion_matrix.result()
+
+
+# Mean loss of the model over a dataloader, counting the multiplicities of the rows of a CompactDataset
+def compute_classifier_loss(model: nn.Module, dataloader: DataLoader) -> float:
+    with torch.no_grad():
+        model.eval()
+        weighted = is_compact(dataloader)
+        criterion = get_criterion(weighted)
+        dataloader, normalized = normalized_data_cache.get_dataloader(model, dataloader)
+        loss_sum, n_rows = torch.zeros(()), 0
+        for batch in dataloader:
+            (data, label), weight = split_batch(batch, weighted)
+            with execution_mode.autocast(data.device):
+                loss = criterion(forward(model, data, normalized), label)
+            loss_sum += get_batch_loss_sum(loss, len(data), weight)
+            n_rows += len(data) if weight is None else int(weight.sum().item())
+        return (loss_sum / max(n_rows, 1)).item()
+
+
+# Task of the client executor, with the model and the dataloader as first arguments. It returns its output along with the number of
+# epochs, to be printed by the main process (see print_util.ClientPrinter).
+def train_classifier_task(model: nn.Module, dataloader: DataLoader, params: SimpleNamespace, lr_factor: float) -> Tuple[int, ClientPrinter]:
+    printer = ClientPrinter(deferred=True)
+    return train_classifier(model, params, dataloader, lr_factor, printer=printer), printer
 
 
 # this function will train each model on its associated dataloader, and will print the title for it
 # lr_factor is used to multiply the lr that is contained in params (and that should remain constant)
+# Returns the number of epochs made by each model (see multitrain_autoencoders)
 def multitrain_classifiers(trains: List[Tuple[str, DataLoader, nn.Module]], params: SimpleNamespace, lr_factor: float = 1.0,
-                           main_title: str = 'Multitrain classifiers', color: Union[str, Color] = Color.NONE) -> None:
+                           main_title: str = 'Multitrain classifiers', color: Union[str, Color] = Color.NONE) -> List[int]:
     Ctp.enter_section(main_title, color)
-    for i, (title, dataloader, model) in enumerate(trains):
-        Ctp.enter_section('[{}/{}] '.format(i + 1, len(trains)) + title + ' ({} samples)'.format(len(dataloader.dataset[:][0])),
-                          color=Color.NONE, header='      ')
-        train_classifier(model, params, dataloader, lr_factor)
-        Ctp.exit_section()
+    fixed_epochs = params.early_stopping is None
+    if params.batched_clients and len(trains) > 1 and fixed_epochs:
+        multitrain_batched(trains, params, autoencoder=False, lr_factor=lr_factor)
+        n_epochs = [params.epochs] * len(trains)
+    elif client_executor.is_active([dataloader for _, dataloader, _ in trains]) and (fixed_epochs or not client_executor.deterministic):
+        n_epochs, printers = zip(*client_executor.map(train_classifier_task, [model for _, _, model in trains],
+                                                      [dataloader for _, dataloader, _ in trains], clients_args=[(params, lr_factor)] * len(trains),
+                                                      n_passes=params.epochs, update_models=True))
+        n_epochs = list(n_epochs)
+        print_client_outputs(trains, printers)
+    else:
+        n_epochs = []
+        for i, (title, dataloader, model) in enumerate(trains):
+            Ctp.enter_section('[{}/{}] '.format(i + 1, len(trains)) + title + ' ({} samples)'.format(get_n_samples(dataloader)),
+                              color=Color.NONE, header='      ')
+            n_epochs.append(train_classifier(model, params, dataloader, lr_factor))
+            Ctp.exit_section()
 
     Ctp.exit_section()
+    return n_epochs
 
 
 # this function will test each model on its associated dataloader, and will print the title for it
@@ -113,9 +236,13 @@ def multitest_classifiers(tests: List[Tuple[str, DataLoader, nn.Module]], main_t
                           color: Union[str, Color] = Color.NONE) -> BinaryClassificationResult:
     Ctp.enter_section(main_title, color)
     result = BinaryClassificationResult()
+    if client_executor.is_active([dataloader for _, dataloader, _ in tests]):
+        current_results = client_executor.map(test_classifier, [model for _, _, model in tests], [dataloader for _, dataloader, _ in tests])
+    else:
+        current_results = None
     for i, (title, dataloader, model) in enumerate(tests):
-        Ctp.print('[{}/{}] '.format(i + 1, len(tests)) + title + ' ({} samples)'.format(len(dataloader.dataset[:][0])), bold=True)
-        current_result = test_classifier(model, dataloader)
+        Ctp.print('[{}/{}] '.format(i + 1, len(tests)) + title + ' ({} samples)'.format(get_n_samples(dataloader)), bold=True)
+        current_result = test_classifier(model, dataloader) if current_results is None else current_results[i]
         result += current_result
         print_rates(current_result)
     Ctp.exit_section()
@@ -0,0 +1,95 @@
+from typing import List, Optional, Dict
+
+import numpy as np
+from context_printer import Color
+from context_printer import ContextPrinter as Ctp
+
+from data import mirai_attacks, gafgyt_attacks, DeviceData
+
+# Synthetic data with the same layout as N-BaIoT (same 115 features and same benign, mirai_* and gafgyt_* keys), so that the whole pipeline
+# can run (and scale to any number of devices) without the dataset. Each device has its own benign distribution, and each attack has a
+# signature shared by all the devices that is perturbed for each device, so that the attacks of new devices are similar but not identical to
+# the ones seen in training. The data of a device only depends on the seed and on the id of the device, not on the number of devices.
+
+n_features = 115
+n_attack_features = 10  # Number of features shifted by each attack
+autocorrelation_window = 8  # Length of the moving average applied to the noise, making consecutive rows correlated like real traffic
+
+
+def synthetic_device_name(device_id: int) -> str:
+    return 'Synthetic_Device_{:03d}'.format(device_id)
+
+
+# Like in N-BaIoT, 2 devices out of 9 cannot be infected by mirai (so they only have the 5 gafgyt attacks)
+def has_mirai(device_id: int) -> bool:
+    return device_id % 9 not in (2, 6)
+
+
+def get_synthetic_keys(device_id: int) -> List[str]:
+    mirai_keys = ['mirai_' + attack for attack in mirai_attacks] if has_mirai(device_id) else []
+    return ['benign'] + mirai_keys + ['gafgyt_' + attack for attack in gafgyt_attacks]
+
+
+# Names of n_devices synthetic devices, used in place of data.all_devices (see params.devices in main.py)
+def get_synthetic_devices(n_devices: int) -> List[str]:
+    return [synthetic_device_name(device_id) for device_id in range(n_devices)]
+
+
+# Signature of each attack: the features it shifts and the shift (in standard deviations of the benign traffic) of each of them
+def get_attack_signatures(seed: int) -> Dict[str, np.ndarray]:
+    rng = np.random.default_rng([seed])
+    signatures = {}
+    for key in ['mirai_' + attack for attack in mirai_attacks] + ['gafgyt_' + attack for attack in gafgyt_attacks]:
+        signature = np.zeros(n_features, dtype=np.float32)
+        features = rng.choice(n_features, n_attack_features, replace=False)
+        signature[features] = rng.uniform(0.3, 1.2, n_attack_features) * rng.choice([-1., 1.], n_attack_features)
+        signatures[key] = signature
+    return signatures
+
+
+# Correlated noise: moving average of white noise over autocorrelation_window rows, rescaled to a unit variance
+def generate_noise(rng: np.random.Generator, n_rows: int) -> np.ndarray:
+    white_noise = rng.standard_normal((n_rows + autocorrelation_window - 1, n_features), dtype=np.float32)
+    noise = np.zeros((n_rows, n_features), dtype=np.float32)
+    for shift in range(autocorrelation_window):
+        noise += white_noise[shift:shift + n_rows]
+    noise /= np.sqrt(autocorrelation_window)
+    return noise
+
+
+def generate_device_data(device_id: int, rows_per_key: int, seed: int = 0, signatures: Optional[Dict[str, np.ndarray]] = None) -> DeviceData:
+    if signatures is None:
+        signatures = get_attack_signatures(seed)
+    rng = np.random.default_rng([seed, device_id + 1])
+    scale = rng.lognormal(0., 1., n_features).astype(np.float32)
+    benign_mean = (rng.normal(0., 1., n_features) * scale).astype(np.float32)
+
+    device_data = {}
+    for key in get_synthetic_keys(device_id):
+        if key == 'benign':
+            mean = benign_mean
+        else:
+            # The signature of the attack is perturbed for each device, and its spread differs slightly from the benign traffic
+            signature = signatures[key] * rng.uniform(0.5, 1.5, n_features).astype(np.float32)
+            mean = benign_mean + signature * scale
+        key_scale = scale if key == 'benign' else scale * np.float32(rng.uniform(0.8, 1.3))
+        arr = generate_noise(rng, rows_per_key)
+        arr *= key_scale
+        arr += mean
+        device_data[key] = arr
+    return device_data
+
+
+# Same contract as data.read_all_data: a DeviceData per device, where the devices that are not in device_ids (if specified) are left empty
+def read_synthetic_data(n_devices: int, rows_per_key: int, seed: int = 0, device_ids: Optional[List[int]] = None) -> List[DeviceData]:
+    device_ids = set(range(n_devices) if device_ids is None else device_ids)
+    Ctp.enter_section('Generating synthetic data for {} devices ({} rows per key, seed {})'.format(len(device_ids), rows_per_key, seed),
+                      Color.YELLOW)
+    signatures = get_attack_signatures(seed)
+    all_data = []
+    for device_id in range(n_devices):
+        all_data.append(generate_device_data(device_id, rows_per_key, seed, signatures) if device_id in device_ids else {})
+    n_rows = sum(len(arr) for device_data in all_data for arr in device_data.values())
+    Ctp.print('{} rows ({:.1f} MB)'.format(n_rows, n_rows * n_features * 4 / 2 ** 20))
+    Ctp.exit_section()
+    return all_data
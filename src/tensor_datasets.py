@@ -0,0 +1,178 @@
+from typing import Optional, Union, List, Tuple, Iterator
+
+import numpy as np
+import torch
+# noinspection PyProtectedMember
+from torch.utils.data import Dataset
+
+from data import resample_indexes
+
+
+# Dataset whose rows are gathered on the fly from a single copy of the source rows: row i of the dataset is data[indexes[i]], so that
+# the upsampled rows are not physically duplicated. The other tensors (the targets for example) have one row per row of the dataset.
+class ResampledDataset(Dataset):
+    def __init__(self, data: torch.Tensor, indexes: torch.Tensor, *tensors: torch.Tensor) -> None:
+        if any(len(tensor) != len(indexes) for tensor in tensors):
+            raise ValueError('All the tensors should have one row per index')
+        self.data = data
+        self.indexes = indexes  # int32 to save memory, converted to int64 only for the rows that are gathered
+        self.tensors = tensors
+
+    def __getitem__(self, index: Union[int, slice, torch.Tensor]) -> tuple:
+        return (self.data[self.indexes[index].long()],) + tuple(tensor[index] for tensor in self.tensors)
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+
+# Accumulates the source rows and the index vectors of the blocks (one per device and traffic key) that form a ResampledDataset.
+# The source rows stay float32 numpy arrays (possibly memory-mapped) until the dataset is built, at which point each block is copied only
+# once, directly into its slice of a single preallocated tensor.
+class ResampledDatasetBuilder:
+    def __init__(self) -> None:
+        self.data_blocks = []
+        self.index_blocks = []
+        self.n_source_rows = 0
+
+    # Adds the rows of arr, resampled to n_samples rows if it is specified. Returns the number of rows added to the dataset.
+    def add(self, arr: np.ndarray, n_samples: Optional[int] = None) -> int:
+        if n_samples is None:
+            indexes = np.arange(len(arr), dtype=np.int32)
+        else:
+            indexes = resample_indexes(len(arr), n_samples)
+            if n_samples < len(arr):
+                # Only the rows that are selected are kept, so that downsampling does not keep a copy of the whole array
+                selected_rows, indexes = np.unique(indexes, return_inverse=True)
+                arr = arr[selected_rows]
+
+        self.data_blocks.append(arr)
+        self.index_blocks.append(indexes.astype(np.int32) + self.n_source_rows)
+        self.n_source_rows += len(arr)
+        return len(indexes)
+
+    def build(self, *tensors: torch.Tensor, cuda: bool = False) -> ResampledDataset:
+        data = concatenate_rows(self.data_blocks)
+        indexes = torch.from_numpy(np.concatenate(self.index_blocks))
+        if cuda:
+            data, indexes, tensors = data.cuda(), indexes.cuda(), tuple(tensor.cuda() for tensor in tensors)
+        return ResampledDataset(data, indexes, *tensors)
+
+
+# Concatenates blocks of rows into a single float32 tensor. The output is allocated once and each block is written (and cast if needed)
+# directly into its slice, instead of creating a tensor per block, casting it and concatenating the results. A single block that is
+# already a float32 C-contiguous array owning its memory is used as is, without any copy.
+def concatenate_rows(blocks: List[np.ndarray]) -> torch.Tensor:
+    if len(blocks) == 1:
+        block = blocks[0]
+        if block.dtype == np.float32 and block.flags['C_CONTIGUOUS'] and block.flags['WRITEABLE'] and block.flags['OWNDATA']:
+            return torch.from_numpy(block)
+
+    n_rows = sum(len(block) for block in blocks)
+    n_features = blocks[0].shape[1]
+    output = torch.empty((n_rows, n_features), dtype=torch.float32)
+    output_array = output.numpy()  # Shares its memory with the tensor
+    start = 0
+    for block in blocks:
+        np.copyto(output_array[start:start + len(block)], block, casting='same_kind')
+        start += len(block)
+    return output
+
+
+# Dataset in which each distinct row (along with its other tensors, e.g. its target) is stored only once, with the number of times it
+# appears in the original dataset. The items are (data, *tensors, count), so that the losses and the metrics can be weighted by these
+# multiplicities instead of computing the same forward pass on identical rows.
+class CompactDataset(Dataset):
+    def __init__(self, data: torch.Tensor, counts: torch.Tensor, *tensors: torch.Tensor) -> None:
+        self.data = data
+        self.counts = counts
+        self.tensors = tensors
+
+    def __getitem__(self, index: Union[int, slice, torch.Tensor]) -> tuple:
+        return (self.data[index],) + tuple(tensor[index] for tensor in self.tensors) + (self.counts[index],)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    # Number of rows of the original (expanded) dataset
+    def n_samples(self) -> int:
+        return int(self.counts.sum().item())
+
+
+# Merges the identical rows of a dataset, be they repeated by the resampling or duplicated in the captures themselves. Two rows are only
+# merged if all their tensors (the targets for example) are also identical. The rows of the result are sorted by their tensors first, so
+# that rows with the same segment id (see get_segments) stay contiguous and ordered by segment.
+def compact_dataset(dataset: ResampledDataset) -> CompactDataset:
+    _, source_row_ids = np.unique(dataset.data.cpu().numpy(), axis=0, return_inverse=True)
+    row_ids = source_row_ids.reshape(-1)[dataset.indexes.cpu().numpy()]
+    keys = np.concatenate([tensor.cpu().numpy().reshape(len(row_ids), -1).astype(np.float64) for tensor in dataset.tensors]
+                          + [row_ids.reshape(-1, 1).astype(np.float64)], axis=1)
+    _, first_indexes, counts = np.unique(keys, axis=0, return_index=True, return_counts=True)
+    items = dataset[torch.from_numpy(first_indexes).to(dataset.indexes.device)]
+    return CompactDataset(items[0], torch.from_numpy(counts).to(dataset.data.device), *items[1:])
+
+
+# Batch iterator over the tensor datasets above, replacing a DataLoader: each batch is gathered with a single indexing operation (a slice,
+# or the slice of a permutation drawn once per epoch when shuffling) instead of fetching the rows one by one and stacking them with the
+# collate function. Like a DataLoader, it has the dataset and batch_size attributes and its len is its number of batches.
+# Each epoch draws two numbers from the global generator: a seed when the iterator is created (in place of the base seed of a DataLoader's
+# iterator) and, when shuffling, the seed of a generator for the permutation. The batches are not meant to be the same as with a
+# DataLoader, whose draws depend on the version of torch (the sampler of torch 1.7 draws the permutation from the global generator
+# directly), but the draws only depend on the number of epochs, so that they can be replayed (see client_executor.skip_dataloader_draws).
+class TensorDataLoader:
+    def __init__(self, dataset: Union[ResampledDataset, CompactDataset], batch_size: int, shuffle: bool = False) -> None:
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self) -> int:
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    # The first seed is drawn when the iterator is created and the seed of the shuffling when the first batch is requested, which matters
+    # when iterating over several loaders at once (with zip for example)
+    def __iter__(self) -> Iterator[tuple]:
+        torch.empty((), dtype=torch.int64).random_()
+        return self.__iter_batches()
+
+    def __iter_batches(self) -> Iterator[tuple]:
+        n_rows = len(self.dataset)
+        permutation = None
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            permutation = torch.randperm(n_rows, generator=generator)
+
+        for start in range(0, n_rows, self.batch_size):
+            end = min(start + self.batch_size, n_rows)
+            yield self.dataset[permutation[start:end] if self.shuffle else slice(start, end)]
+
+
+# Returns the multiplicities of the rows of a dataloader's dataset if it is a CompactDataset, None otherwise
+def get_counts(dataloader) -> Optional[torch.Tensor]:
+    return dataloader.dataset.counts if isinstance(dataloader.dataset, CompactDataset) else None
+
+
+def is_compact(dataloader) -> bool:
+    return isinstance(dataloader.dataset, CompactDataset)
+
+
+# Number of rows of a dataloader's dataset, counting the multiplicities if it is a CompactDataset
+def get_n_samples(dataloader) -> int:
+    return dataloader.dataset.n_samples() if isinstance(dataloader.dataset, CompactDataset) else len(dataloader.dataset)
+
+
+# Separates the weights (the last element of the batches of a CompactDataset) from the other tensors of a batch
+def split_batch(batch: Union[tuple, list], weighted: bool) -> Tuple[tuple, Optional[torch.Tensor]]:
+    if weighted:
+        return tuple(batch[:-1]), batch[-1]
+    return tuple(batch), None
+
+
+# Segment ids of the rows of a dataset whose (first) tensor is the segment of each row, such as the test datasets of the autoencoders
+def get_segments(dataset: Union[ResampledDataset, CompactDataset]) -> torch.Tensor:
+    return dataset.tensors[0].long()
+
+
+# Slices of the rows of each segment, for segments whose rows are contiguous and ordered by segment id
+def get_segment_slices(segments: torch.Tensor, n_segments: int) -> List[slice]:
+    ends = torch.cumsum(torch.bincount(segments, minlength=n_segments), dim=0).tolist()
+    return [slice(start, end) for start, end in zip([0] + ends[:-1], ends)]
@@ -41,13 +41,15 @@ def select_experiment_function(experiment: str, federated: Optional[str]) -> Cal
     return fn
 
 
-# Computes the results of multiple random reruns of the same experiment
+# Computes the results of multiple random reruns of the same experiment, along with the training actually made in each run (the epochs and
+# the rounds, which can be fewer than specified when the training is stopped early)
 def compute_rerun_results(clients_train_val: FederationData, clients_test: FederationData, test_devices_data: ClientData,
                           experiment: str, federated: Optional[str], params: SimpleNamespace) \
-        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], Optional[List[List[float]]]]:
+        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], Optional[List[List[float]]], List[dict]]:
     local_results = []
     new_devices_results = []
     thresholds = []
+    trainings = []
 
     experiment_function = select_experiment_function(experiment, federated)
 
@@ -63,6 +65,7 @@ def compute_rerun_results(clients_train_val: FederationData, clients_test: Feder
         result = experiment_function(clients_train_val, clients_test, test_devices_data, params=params)
         local_results.append(result[0])
         new_devices_results.append(result[1])
+        trainings.append(result[-1])
         if experiment == 'autoencoder':
             threshold = result[2]
         else:
@@ -72,7 +75,7 @@ def compute_rerun_results(clients_train_val: FederationData, clients_test: Feder
             thresholds.append(threshold)
         Ctp.print("Elapsed time: {:.1f} seconds".format(time() - start_time))
         Ctp.exit_section()
-    return local_results, new_devices_results, thresholds
+    return local_results, new_devices_results, thresholds, trainings
 
 
 # This function is used to test the performance of a model with a given set of hyper-parameters on the test set
@@ -81,8 +84,12 @@ def test_hyperparameters(all_data: List[DeviceData], setup: str, experiment: str
     # Create the path in which we store the results
     base_path = 'test_results/' + setup + '_' + experiment + ('_' + federated if federated is not None else '') + '/run_'
 
+    if len(configurations_params) != len(configurations):
+        raise ValueError('{} configurations but {} sets of configuration hyper-parameters'
+                         .format(len(configurations), len(configurations_params)))
+
     params_dict = deepcopy(constant_params)
-    local_results, new_devices_results, thresholds = {}, {}, {}
+    local_results, new_devices_results, thresholds, trainings = {}, {}, {}, {}
 
     for j, (configuration, configuration_params) in enumerate(zip(configurations, configurations_params)):
         # Multiple configurations: we iterate over the possible configurations of the clients. Each configuration has its hyper-parameters
@@ -93,13 +100,15 @@ def test_hyperparameters(all_data: List[DeviceData], setup: str, experiment: str
         params_dict.update(configuration_params)  # Update the hyper-parameters with the configuration-specific hyper-parameters
         params = SimpleNamespace(**params_dict)
         Ctp.enter_section('Configuration [{}/{}]: '.format(j + 1, len(configurations)) + str(configuration), Color.NONE)
-        local_result, new_result, threshold = compute_rerun_results(clients_train_val, clients_test, test_devices_data, experiment, federated, params)
+        local_result, new_result, threshold, training = compute_rerun_results(clients_train_val, clients_test, test_devices_data,
+                                                                              experiment, federated, params)
         local_results[repr(configuration)], new_devices_results[repr(configuration)] = local_result, new_result
         thresholds[repr(configuration)] = threshold
+        trainings[repr(configuration)] = training
         Ctp.exit_section()
 
     if experiment != 'autoencoder':
         thresholds = None
     # We save the results in a json file
     results_path = create_new_numbered_dir(base_path)
-    save_results_test(results_path, local_results, new_devices_results, thresholds, constant_params, configurations_params)
+    save_results_test(results_path, local_results, new_devices_results, thresholds, constant_params, configurations_params, trainings)
@@ -0,0 +1,104 @@
+from typing import Optional, Callable, Dict
+
+import numpy as np
+import torch
+from context_printer import ContextPrinter as Ctp
+
+from data import ClientData, FederationData
+
+# A thinning function takes the rows of a split (ordered in time) and the number of rows to keep, and returns the sorted indexes of the kept
+# rows. The traffic is strongly autocorrelated, so that consecutive rows carry little new information and most of them can be dropped.
+ThinningFunction = Callable[[np.ndarray, int], np.ndarray]
+
+
+# Keeps evenly spaced rows, so that the whole time span of the split is still covered
+def stride_thinning(arr: np.ndarray, n_rows: int) -> np.ndarray:
+    return np.arange(n_rows, dtype=np.int64) * len(arr) // n_rows
+
+
+# Min-max normalization of the rows of a split, so that the distances used by the coreset selections are not dominated by the features
+# with the largest scales
+def get_normalized_rows(arr: np.ndarray) -> torch.Tensor:
+    data = torch.tensor(arr, dtype=torch.float32)
+    sub = data.min(dim=0)[0]
+    div = data.max(dim=0)[0] - sub
+    div[div == 0.] = 1.
+    return (data - sub) / div
+
+
+# Greedy k-center coreset: starting from the row closest to the mean, the row that is the farthest from the already selected rows is
+# selected until n_rows rows are selected. The selected rows cover the whole feature space, including its rare regions.
+def k_center_thinning(arr: np.ndarray, n_rows: int) -> np.ndarray:
+    data = get_normalized_rows(arr)
+    selected = torch.zeros(n_rows, dtype=torch.long)
+    selected[0] = torch.argmin(((data - data.mean(dim=0)) ** 2).sum(dim=1))
+    min_distances = ((data - data[selected[0]]) ** 2).sum(dim=1)
+    for i in range(1, n_rows):
+        selected[i] = torch.argmax(min_distances)
+        min_distances = torch.min(min_distances, ((data - data[selected[i]]) ** 2).sum(dim=1))
+    return np.sort(selected.numpy())
+
+
+# Kernel herding (with a linear kernel): the rows are greedily selected so that the mean of the selected rows stays as close as possible
+# to the mean of the whole split. The selected rows follow the distribution of the split rather than covering its support.
+def herding_thinning(arr: np.ndarray, n_rows: int) -> np.ndarray:
+    data = get_normalized_rows(arr)
+    mean = data.mean(dim=0)
+    w = mean.clone()
+    available = torch.ones(len(data), dtype=torch.bool)
+    selected = torch.zeros(n_rows, dtype=torch.long)
+    for i in range(n_rows):
+        scores = torch.mv(data, w)
+        scores[~available] = -float('inf')
+        selected[i] = torch.argmax(scores)
+        available[selected[i]] = False
+        w += mean - data[selected[i]]
+    return np.sort(selected.numpy())
+
+
+thinning_functions: Dict[str, ThinningFunction] = {'stride': stride_thinning,
+                                                   'k-center': k_center_thinning,
+                                                   'herding': herding_thinning}
+
+
+def get_thinned_n_rows(n_rows: int, ratio: float) -> int:
+    return min(n_rows, max(1, int(round(n_rows * ratio))))
+
+
+# The target number of samples of the resampling is thinned with the same ratio as the data, otherwise the resampling would upsample the
+# thinned rows back to the original size
+def thin_samples_per_device(samples_per_device: Optional[int], thinning: Optional[str], ratio: float) -> Optional[int]:
+    if thinning is None or samples_per_device is None:
+        return samples_per_device
+    return get_thinned_n_rows(samples_per_device, ratio)
+
+
+# Thins each split of the client's data independently. Since each key (benign and each attack) is thinned separately, the selection is
+# stratified: the proportions of the keys are kept, and rare attacks are never dropped entirely.
+def thin_client_data(client_data: ClientData, thinning: str, ratio: float) -> ClientData:
+    thinning_function = thinning_functions[thinning]
+    thinned_data = []
+    for device_data in client_data:
+        thinned_device_data = {}
+        for key, arr in device_data.items():
+            n_rows = get_thinned_n_rows(len(arr), ratio)
+            thinned_device_data[key] = arr if n_rows == len(arr) else arr[thinning_function(arr, n_rows)]
+        thinned_data.append(thinned_device_data)
+    return thinned_data
+
+
+def count_rows(client_data: ClientData) -> int:
+    return sum(len(arr) for device_data in client_data for arr in device_data.values())
+
+
+# Thins the training data of each client (if thinning is not None) and prints the compression ratio
+def thin_clients_data(clients_data: FederationData, thinning: Optional[str], ratio: float) -> FederationData:
+    if thinning is None:
+        return clients_data
+
+    thinned_clients_data = [thin_client_data(client_data, thinning, ratio) for client_data in clients_data]
+    n_rows = sum(count_rows(client_data) for client_data in clients_data)
+    n_thinned_rows = sum(count_rows(client_data) for client_data in thinned_clients_data)
+    Ctp.print('{} thinning: {} rows kept out of {} (compression ratio {:.1f}x)'
+              .format(thinning, n_thinned_rows, n_rows, n_rows / max(n_thinned_rows, 1)))
+    return thinned_clients_data
@@ -1,40 +1,47 @@
 from types import SimpleNamespace
-from typing import Dict, Tuple, List, Optional
+from typing import Tuple, List, Optional, Union
 
 import torch
 import torch.utils
 import torch.utils.data
 # noinspection PyProtectedMember
-from torch.utils.data import DataLoader, Dataset, TensorDataset
+from torch.utils.data import Dataset
 
-from data import mirai_attacks, gafgyt_attacks, split_client_data, ClientData, FederationData, resample_array, split_clients_data, \
+from dataset_cache import dataset_cache
+from data import mirai_attacks, gafgyt_attacks, split_client_data, ClientData, FederationData, split_clients_data, \
     get_benign_attack_samples_per_device
+from streaming_data import StreamingDataLoader, get_client_streaming_source, check_streaming_params
+from tensor_datasets import ResampledDatasetBuilder, compact_dataset, TensorDataLoader
+from thinning import thin_clients_data, thin_samples_per_device
 
+# Traffic keys of the segments of the test datasets, in the order of their segment ids
+test_keys = ['benign'] + ['mirai_' + attack for attack in mirai_attacks] + ['gafgyt_' + attack for attack in gafgyt_attacks]
 
-def get_benign_dataset(data: ClientData, benign_samples_per_device: Optional[int] = None, cuda: bool = False) -> Dataset:
-    data_list = []
+
+# The resampling of the datasets is virtual: they only store the source rows once along with the resampled indexes. If compact is set, the
+# identical rows are merged into a CompactDataset.
+def build_benign_dataset(data: ClientData, benign_samples_per_device: Optional[int] = None, cuda: bool = False, compact: bool = False) -> Dataset:
+    builder = ResampledDatasetBuilder()
     for device_data in data:
         for key, arr in device_data.items():  # This will iterate over the benign splits, gafgyt splits and mirai splits (if applicable)
-            if key == 'benign':
-                if benign_samples_per_device is not None:
-                    arr = resample_array(arr, benign_samples_per_device)
-
-            data_tensor = torch.tensor(arr).float()
-            if cuda:
-                data_tensor = data_tensor.cuda()
-            data_list.append(data_tensor)
-
-    dataset = TensorDataset(torch.cat(data_list, dim=0))
+            if key == 'benign' and benign_samples_per_device is not None:
+                builder.add(arr, benign_samples_per_device)
+            else:
+                builder.add(arr)
+
+    dataset = builder.build(cuda=cuda)
+    if compact:
+        dataset = compact_dataset(dataset)
     return dataset
 
 
-def get_test_datasets(test_data: ClientData, benign_samples_per_device: Optional[int] = None, attack_samples_per_device: Optional[int] = None,
-                      cuda: bool = False) -> Dict[str, Dataset]:
-    data_dict = {**{'benign': []},
-                 **{'mirai_' + attack: [] for attack in mirai_attacks},
-                 **{'gafgyt_' + attack: [] for attack in gafgyt_attacks}}
-
+# Creates a single test dataset with the rows of all the traffic keys. Its tensor is the segment id of each row, i.e. the index of its key in
+# test_keys. The rows of each segment are contiguous and the segments are ordered by id (also after the compaction, which sorts the rows
+# by segment first), so that the losses of each key are a slice of the losses of the dataset.
+def build_test_dataset(test_data: ClientData, benign_samples_per_device: Optional[int] = None, attack_samples_per_device: Optional[int] = None,
+                       cuda: bool = False, compact: bool = False) -> Dataset:
     resample = benign_samples_per_device is not None and attack_samples_per_device is not None
+    devices_n_samples = []
 
     for device_data in test_data:
         if resample:
@@ -48,56 +55,86 @@ def get_test_datasets(test_data: ClientData, benign_samples_per_device: Optional
         # With the above trick we always end up with exactly the same total number of attack samples,
         # whether the device has 5 attacks or 10. It does not work if the device has any other number of attacks,
         # but with N-BaIoT this is never the case
+        if resample:
+            devices_n_samples.append({key: (benign_samples_per_device if key == 'benign' else n_samples_attack) for key in device_data.keys()})
+        else:
+            devices_n_samples.append({key: None for key in device_data.keys()})
+
+    builder = ResampledDatasetBuilder()
+    segment_list = []
+    for segment_id, key in enumerate(test_keys):
+        for device_data, device_n_samples in zip(test_data, devices_n_samples):
+            if key in device_data:
+                n_samples = builder.add(device_data[key], device_n_samples[key])
+                segment_list.append(torch.full((n_samples,), segment_id, dtype=torch.uint8))
+
+    dataset = builder.build(torch.cat(segment_list), cuda=cuda)
+    if compact:
+        dataset = compact_dataset(dataset)
+    return dataset
+
 
-        for key, arr in device_data.items():
-            if resample:
-                if key == 'benign':
-                    arr = resample_array(arr, benign_samples_per_device)
-                else:
-                    arr = resample_array(arr, n_samples_attack)
+# Same as build_benign_dataset and build_test_dataset, but the datasets are only built once for all the runs (and configurations) that
+# use them
+def get_benign_dataset(data: ClientData, benign_samples_per_device: Optional[int] = None, cuda: bool = False, compact: bool = False) -> Dataset:
+    return dataset_cache.get(data, ('benign', benign_samples_per_device, cuda, compact),
+                             lambda: build_benign_dataset(data, benign_samples_per_device=benign_samples_per_device, cuda=cuda, compact=compact))
 
-            data_tensor = torch.tensor(arr).float()
-            if cuda:
-                data_tensor = data_tensor.cuda()
-            data_dict[key].append(data_tensor)
 
-    datasets_test = {key: TensorDataset(torch.cat(data_dict[key], dim=0)) for key in data_dict.keys() if len(data_dict[key]) > 0}
-    return datasets_test
+def get_test_dataset(test_data: ClientData, benign_samples_per_device: Optional[int] = None, attack_samples_per_device: Optional[int] = None,
+                     cuda: bool = False, compact: bool = False) -> Dataset:
+    return dataset_cache.get(test_data, ('test', benign_samples_per_device, attack_samples_per_device, cuda, compact),
+                             lambda: build_test_dataset(test_data, benign_samples_per_device=benign_samples_per_device,
+                                                        attack_samples_per_device=attack_samples_per_device, cuda=cuda, compact=compact))
 
 
-def get_train_dl(client_train_data: ClientData, train_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False) -> DataLoader:
-    dataset_train = get_benign_dataset(client_train_data, benign_samples_per_device=benign_samples_per_device, cuda=cuda)
-    train_dl = DataLoader(dataset_train, batch_size=train_bs, shuffle=True)
+def get_train_dl(client_train_data: ClientData, train_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False,
+                 compact: bool = False) -> TensorDataLoader:
+    dataset_train = get_benign_dataset(client_train_data, benign_samples_per_device=benign_samples_per_device, cuda=cuda, compact=compact)
+    train_dl = TensorDataLoader(dataset_train, batch_size=train_bs, shuffle=True)
     return train_dl
 
 
-def get_val_dl(client_val_data: ClientData, test_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False) -> DataLoader:
-    dataset_val = get_benign_dataset(client_val_data, benign_samples_per_device=benign_samples_per_device, cuda=cuda)
-    val_dl = DataLoader(dataset_val, batch_size=test_bs)
+def get_val_dl(client_val_data: ClientData, test_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False,
+               compact: bool = False) -> TensorDataLoader:
+    dataset_val = get_benign_dataset(client_val_data, benign_samples_per_device=benign_samples_per_device, cuda=cuda, compact=compact)
+    val_dl = TensorDataLoader(dataset_val, batch_size=test_bs)
     return val_dl
 
 
-def get_test_dls_dict(client_test_data: ClientData, test_bs: int, benign_samples_per_device: Optional[int] = None,
-                      attack_samples_per_device: Optional[int] = None, cuda: bool = False) -> Dict[str, DataLoader]:
-    datasets = get_test_datasets(client_test_data, benign_samples_per_device=benign_samples_per_device,
-                                 attack_samples_per_device=attack_samples_per_device, cuda=cuda)
-    test_dls = {key: DataLoader(dataset, batch_size=test_bs) for key, dataset in datasets.items()}
-    return test_dls
+def get_test_dl(client_test_data: ClientData, test_bs: int, benign_samples_per_device: Optional[int] = None,
+                attack_samples_per_device: Optional[int] = None, cuda: bool = False, compact: bool = False) -> TensorDataLoader:
+    dataset_test = get_test_dataset(client_test_data, benign_samples_per_device=benign_samples_per_device,
+                                    attack_samples_per_device=attack_samples_per_device, cuda=cuda, compact=compact)
+    test_dl = TensorDataLoader(dataset_test, batch_size=test_bs)
+    return test_dl
+
+
+def get_train_dls(train_data: FederationData, train_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False,
+                  compact: bool = False) -> List[TensorDataLoader]:
+    return [get_train_dl(client_train_data, train_bs, benign_samples_per_device=benign_samples_per_device, cuda=cuda, compact=compact)
+            for client_train_data in train_data]
 
 
-def get_train_dls(train_data: FederationData, train_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False) -> List[DataLoader]:
-    return [get_train_dl(client_train_data, train_bs, benign_samples_per_device=benign_samples_per_device, cuda=cuda)
+# Streaming counterpart of get_train_dls (see streaming_data.py): the training loops read the rows of the train splits chunk by chunk instead
+# of iterating over a dataset holding them. The whole splits are streamed, without resampling them to benign_samples_per_device.
+def get_streaming_train_dls(train_data: FederationData, train_bs: int, chunk_size: int, n_features: int = 115,
+                            cuda: bool = False) -> List[StreamingDataLoader]:
+    return [StreamingDataLoader(get_client_streaming_source(client_train_data, n_features), train_bs, chunk_size=chunk_size, shuffle=True,
+                                cuda=cuda)
             for client_train_data in train_data]
 
 
-def get_val_dls(val_data: FederationData, test_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False) -> List[DataLoader]:
-    return [get_val_dl(client_val_data, test_bs, benign_samples_per_device=benign_samples_per_device, cuda=cuda) for client_val_data in val_data]
+def get_val_dls(val_data: FederationData, test_bs: int, benign_samples_per_device: Optional[int] = None, cuda: bool = False,
+                compact: bool = False) -> List[TensorDataLoader]:
+    return [get_val_dl(client_val_data, test_bs, benign_samples_per_device=benign_samples_per_device, cuda=cuda, compact=compact)
+            for client_val_data in val_data]
 
 
-def get_test_dls_dicts(local_test_data: FederationData, test_bs: int, benign_samples_per_device: Optional[int] = None,
-                       attack_samples_per_device: Optional[int] = None, cuda: bool = False) -> List[Dict[str, DataLoader]]:
-    return [get_test_dls_dict(client_test_data, test_bs, benign_samples_per_device=benign_samples_per_device,
-                              attack_samples_per_device=attack_samples_per_device, cuda=cuda)
+def get_test_dls(local_test_data: FederationData, test_bs: int, benign_samples_per_device: Optional[int] = None,
+                 attack_samples_per_device: Optional[int] = None, cuda: bool = False, compact: bool = False) -> List[TensorDataLoader]:
+    return [get_test_dl(client_test_data, test_bs, benign_samples_per_device=benign_samples_per_device,
+                        attack_samples_per_device=attack_samples_per_device, cuda=cuda, compact=compact)
             for client_test_data in local_test_data]
 
 
@@ -113,7 +150,7 @@ def get_client_unsupervised_initial_splitting(client_data: ClientData, p_test: f
 
 
 def prepare_dataloaders(train_val_data: FederationData, local_test_data: FederationData, new_test_data: ClientData, params: SimpleNamespace)\
-        -> Tuple[List[DataLoader], List[DataLoader], List[Dict[str, DataLoader]], Dict[str, DataLoader]]:
+        -> Tuple[List[Union[TensorDataLoader, StreamingDataLoader]], List[TensorDataLoader], List[TensorDataLoader], TensorDataLoader]:
     # Split train data between actual train and the set that will be used to search the threshold
     train_data, threshold_data = split_clients_data(train_val_data, p_second_split=params.threshold_part, p_unused=0.0)
 
@@ -121,20 +158,29 @@ def prepare_dataloaders(train_val_data: FederationData, local_test_data: Federat
     p_threshold = params.p_train_val * params.threshold_part
 
     # Creating the dataloaders
-    benign_samples_per_device, _ = get_benign_attack_samples_per_device(p_split=p_train,
-                                                                        benign_prop=1., samples_per_device=params.samples_per_device)
-    train_dls = get_train_dls(train_data, params.train_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda)
+    if params.streaming_chunk_size is not None:
+        check_streaming_params(params)
+        train_dls = get_streaming_train_dls(train_data, params.train_bs, params.streaming_chunk_size, n_features=params.n_features,
+                                            cuda=params.cuda)
+    else:
+        benign_samples_per_device, _ = get_benign_attack_samples_per_device(p_split=p_train,
+                                                                            benign_prop=1., samples_per_device=params.samples_per_device)
+        train_data = thin_clients_data(train_data, params.thinning, params.thinning_ratio)
+        benign_samples_per_device = thin_samples_per_device(benign_samples_per_device, params.thinning, params.thinning_ratio)
+        train_dls = get_train_dls(train_data, params.train_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda,
+                                  compact=params.compact_datasets)
 
     benign_samples_per_device, _ = get_benign_attack_samples_per_device(p_split=p_threshold,
                                                                         benign_prop=1., samples_per_device=params.samples_per_device)
-    threshold_dls = get_val_dls(threshold_data, params.test_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda)
+    threshold_dls = get_val_dls(threshold_data, params.test_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda,
+                                compact=params.compact_datasets)
 
     benign_samples_per_device, attack_samples_per_device = get_benign_attack_samples_per_device(p_split=params.p_test, benign_prop=params.benign_prop,
                                                                                                 samples_per_device=params.samples_per_device)
-    local_test_dls_dicts = get_test_dls_dicts(local_test_data, params.test_bs, benign_samples_per_device=benign_samples_per_device,
-                                              attack_samples_per_device=attack_samples_per_device, cuda=params.cuda)
+    local_test_dls = get_test_dls(local_test_data, params.test_bs, benign_samples_per_device=benign_samples_per_device,
+                                  attack_samples_per_device=attack_samples_per_device, cuda=params.cuda, compact=params.compact_datasets)
 
-    new_test_dls_dict = get_test_dls_dict(new_test_data, params.test_bs, benign_samples_per_device=benign_samples_per_device,
-                                          attack_samples_per_device=attack_samples_per_device, cuda=params.cuda)
+    new_test_dl = get_test_dl(new_test_data, params.test_bs, benign_samples_per_device=benign_samples_per_device,
+                              attack_samples_per_device=attack_samples_per_device, cuda=params.cuda, compact=params.compact_datasets)
 
-    return train_dls, threshold_dls, local_test_dls_dicts, new_test_dls_dict
+    return train_dls, threshold_dls, local_test_dls, new_test_dl
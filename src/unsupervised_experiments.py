@@ -1,5 +1,5 @@
 from types import SimpleNamespace
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Optional
 
 import torch
 from context_printer import Color
@@ -9,27 +9,38 @@ from torch.utils.data import DataLoader
 
 from architectures import SimpleAutoencoder, NormalizingModel, Threshold
 from data import device_names, ClientData, FederationData, get_benign_attack_samples_per_device
-from federated_util import init_federated_models, model_aggregation, select_mimicked_client, model_poisoning
+from early_stopping import get_early_stopping
+from federated_util import init_federated_models, select_mimicked_client, model_poisoning, broadcast_global_model, model_aggregation
 from metrics import BinaryClassificationResult
 from ml import set_models_sub_divs, set_model_sub_div
 from print_util import print_federation_round, print_federation_epoch
+from streaming_aggregation import aggregate_models, check_streaming_aggregation, init_streaming_global_model, \
+    streaming_federated_round
+from tensor_datasets import get_n_samples
+from thinning import thin_clients_data, thin_samples_per_device
 from unsupervised_data import get_train_dl, get_val_dl, prepare_dataloaders
 from unsupervised_ml import multitrain_autoencoders, multitest_autoencoders, compute_thresholds, train_autoencoder, \
-    compute_reconstruction_losses, train_autoencoders_fedsgd
+    compute_mean_reconstruction_loss, train_autoencoders_fedsgd
 
 
-def local_autoencoder_train_val(train_data: ClientData, val_data: ClientData, params: SimpleNamespace) -> float:
+# The number of epochs made by the training is appended to trained_epochs if it is specified
+def local_autoencoder_train_val(train_data: ClientData, val_data: ClientData, params: SimpleNamespace,
+                                trained_epochs: Optional[List[int]] = None) -> float:
     p_train = params.p_train_val * (1. - params.val_part)
     p_val = params.p_train_val * params.val_part
 
     # Create the dataloaders
     benign_samples_per_device, _ = get_benign_attack_samples_per_device(p_split=p_train, benign_prop=1.,
                                                                         samples_per_device=params.samples_per_device)
-    train_dl = get_train_dl(train_data, params.train_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda)
+    train_data = thin_clients_data([train_data], params.thinning, params.thinning_ratio)[0]
+    benign_samples_per_device = thin_samples_per_device(benign_samples_per_device, params.thinning, params.thinning_ratio)
+    train_dl = get_train_dl(train_data, params.train_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda,
+                            compact=params.compact_datasets)
 
     benign_samples_per_device, _ = get_benign_attack_samples_per_device(p_split=p_val, benign_prop=1.,
                                                                         samples_per_device=params.samples_per_device)
-    val_dl = get_val_dl(val_data, params.test_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda)
+    val_dl = get_val_dl(val_data, params.test_bs, benign_samples_per_device=benign_samples_per_device, cuda=params.cuda,
+                        compact=params.compact_datasets)
 
     # Initialize the model and compute the normalization values with the client's local training data
     model = NormalizingModel(SimpleAutoencoder(activation_function=params.activation_fn, hidden_layers=params.hidden_layers),
@@ -40,23 +51,25 @@ def local_autoencoder_train_val(train_data: ClientData, val_data: ClientData, pa
     set_model_sub_div(params.normalization, model, train_dl)
 
     # Local training
-    Ctp.enter_section('Training for {} epochs with {} samples'.format(params.epochs, len(train_dl.dataset[:][0])), color=Color.GREEN)
-    train_autoencoder(model, params, train_dl)
+    Ctp.enter_section('Training for {} epochs with {} samples'.format(params.epochs, get_n_samples(train_dl)), color=Color.GREEN)
+    n_epochs = train_autoencoder(model, params, train_dl, val_loader=val_dl)
     Ctp.exit_section()
+    if trained_epochs is not None:
+        trained_epochs.append(n_epochs)
 
     # Local validation
-    Ctp.print("Validating with {} samples".format(len(val_dl.dataset[:][0])))
-    losses = compute_reconstruction_losses(model, val_dl)
-    loss = (sum(losses) / len(losses)).item()
+    Ctp.print("Validating with {} samples".format(get_n_samples(val_dl)))
+    loss = compute_mean_reconstruction_loss(model, val_dl)
     Ctp.print("Validation loss: {:.5f}".format(loss))
 
     return loss
 
 
+# The last element of the returned tuple records the training actually made: the number of epochs of each client
 def local_autoencoders_train_test(train_val_data: FederationData, local_test_data: FederationData, new_test_data: ClientData,
-                                  params: SimpleNamespace) -> Tuple[BinaryClassificationResult, BinaryClassificationResult, List[float]]:
+                                  params: SimpleNamespace) -> Tuple[BinaryClassificationResult, BinaryClassificationResult, List[float], dict]:
     # Prepare the dataloaders
-    train_dls, threshold_dls, local_test_dls_dicts, new_test_dls_dict = prepare_dataloaders(train_val_data, local_test_data, new_test_data, params)
+    train_dls, threshold_dls, local_test_dls, new_test_dl = prepare_dataloaders(train_val_data, local_test_data, new_test_data, params)
 
     # Initialize the models and compute the normalization values with each client's local training data
     n_clients = len(params.clients_devices)
@@ -69,47 +82,49 @@ def local_autoencoders_train_test(train_val_data: FederationData, local_test_dat
     set_models_sub_divs(params.normalization, models, train_dls, color=Color.RED)
 
     # Local training of the autoencoder
-    multitrain_autoencoders(trains=list(zip(['Training client {} on: '.format(i) + device_names(client_devices)
-                                             for i, client_devices in enumerate(params.clients_devices)], train_dls, models)),
-                            params=params, main_title='Training the clients', color=Color.GREEN)
+    n_epochs = multitrain_autoencoders(trains=list(zip(['Training client {} on: '.format(i) + device_names(params.devices, client_devices)
+                                                        for i, client_devices in enumerate(params.clients_devices)], train_dls, models)),
+                                       params=params, main_title='Training the clients', color=Color.GREEN)
 
     # Computation of the thresholds
-    thresholds = compute_thresholds(opts=list(zip(['Computing threshold for client {} on: '.format(i) + device_names(client_devices)
+    thresholds = compute_thresholds(opts=list(zip(['Computing threshold for client {} on: '.format(i)
+                                                   + device_names(params.devices, client_devices)
                                                    for i, client_devices in enumerate(params.clients_devices)], threshold_dls, models)),
                                     quantile=params.quantile,
                                     main_title='Computing the thresholds', color=Color.DARK_PURPLE)
 
     # Local testing of each autoencoder
-    local_result = multitest_autoencoders(tests=list(zip(['Testing client {} on: '.format(i) + device_names(client_devices)
+    local_result = multitest_autoencoders(tests=list(zip(['Testing client {} on: '.format(i) + device_names(params.devices, client_devices)
                                                           for i, client_devices in enumerate(params.clients_devices)],
-                                                         local_test_dls_dicts, models, thresholds)),
+                                                         local_test_dls, models, thresholds)),
                                           main_title='Testing the clients on their own devices', color=Color.BLUE)
 
     # New devices testing
     new_devices_result = multitest_autoencoders(
-        tests=list(zip(['Testing client {} on: '.format(i) + device_names(params.test_devices) for i in range(n_clients)],
-                       [new_test_dls_dict for _ in range(n_clients)], models, thresholds)),
-        main_title='Testing the clients on the new devices: ' + device_names(params.test_devices), color=Color.DARK_CYAN)
+        tests=list(zip(['Testing client {} on: '.format(i) + device_names(params.devices, params.test_devices) for i in range(n_clients)],
+                       [new_test_dl for _ in range(n_clients)], models, thresholds)),
+        main_title='Testing the clients on the new devices: ' + device_names(params.devices, params.test_devices), color=Color.DARK_CYAN)
 
-    return local_result, new_devices_result, [threshold.threshold.item() for threshold in thresholds]
+    return local_result, new_devices_result, [threshold.threshold.item() for threshold in thresholds], {'epochs': n_epochs}
 
 
 def federated_thresholds(models: List[torch.nn.Module], threshold_dls: List[DataLoader], global_threshold: torch.nn.Module,
                          params: SimpleNamespace, global_thresholds: List[float]) -> None:
     # Computation of the thresholds
-    thresholds = compute_thresholds(opts=list(zip(['Computing threshold for client {} on: '.format(i) + device_names(client_devices)
+    thresholds = compute_thresholds(opts=list(zip(['Computing threshold for client {} on: '.format(i)
+                                                   + device_names(params.devices, client_devices)
                                                    for i, client_devices in enumerate(params.clients_devices)], threshold_dls, models)),
                                     quantile=params.quantile,
                                     main_title='Computing the thresholds', color=Color.DARK_PURPLE)
 
     # Aggregation of the thresholds
-    global_threshold, thresholds = model_aggregation(global_threshold, thresholds, params, verbose=True)
+    global_threshold, thresholds = aggregate_models(global_threshold, thresholds, params, verbose=True)
     Ctp.print('Global threshold: {:.6f}'.format(global_threshold.threshold.item()))
     global_thresholds.append(global_threshold.threshold.item())
 
 
 def federated_testing(global_model: torch.nn.Module, global_threshold: torch.nn.Module,
-                      local_test_dls_dicts: List[Dict[str, DataLoader]], new_test_dls_dict: Dict[str, DataLoader],
+                      local_test_dls: List[DataLoader], new_test_dl: DataLoader,
                       params: SimpleNamespace, local_results: List[BinaryClassificationResult],
                       new_devices_results: List[BinaryClassificationResult]) -> None:
 
@@ -117,68 +132,119 @@ def federated_testing(global_model: torch.nn.Module, global_threshold: torch.nn.
     tests = []
     for client_id, client_devices in enumerate(params.clients_devices):
         if client_id not in params.malicious_clients:
-            tests.append(('Testing global model on: ' + device_names(client_devices), local_test_dls_dicts[client_id], global_model,
-                          global_threshold))
+            tests.append(('Testing global model on: ' + device_names(params.devices, client_devices), local_test_dls[client_id],
+                          global_model, global_threshold))
 
     local_results.append(multitest_autoencoders(tests=tests,
                                                 main_title='Testing the global model on data from all clients', color=Color.BLUE))
 
     # Global model testing on new devices
-    new_devices_results.append(multitest_autoencoders(tests=list(zip(['Testing global model on: ' + device_names(params.test_devices)],
-                                                                     [new_test_dls_dict], [global_model], [global_threshold])),
-                                                      main_title='Testing the global model on the new devices: ' + device_names(
-                                                          params.test_devices),
+    new_test_devices = device_names(params.devices, params.test_devices)
+    new_devices_results.append(multitest_autoencoders(tests=list(zip(['Testing global model on: ' + new_test_devices],
+                                                                     [new_test_dl], [global_model], [global_threshold])),
+                                                      main_title='Testing the global model on the new devices: ' + new_test_devices,
                                                       color=Color.DARK_CYAN))
 
 
+# Federated validation loss of the global model: the mean reconstruction loss on the threshold set (held-out benign data) of each client,
+# averaged over the clients weighted by their numbers of samples
+def federated_validation_loss(global_model: torch.nn.Module, threshold_dls: List[DataLoader]) -> float:
+    n_samples = [get_n_samples(dataloader) for dataloader in threshold_dls]
+    losses = [compute_mean_reconstruction_loss(global_model, dataloader) for dataloader in threshold_dls]
+    return sum(loss * client_n_samples for loss, client_n_samples in zip(losses, n_samples)) / sum(n_samples)
+
+
+# The federation stops early if params.federated_early_stopping is specified and the federated validation loss of the global model stops
+# decreasing. If it restores the best weights and the best round is not the last one, the global model of the best round is distributed
+# back to the clients and the thresholds and the results are computed again with it: they are appended after those of the rounds made, so
+# that the last results returned are those of the restored model. The last element of the returned tuple records the training actually
+# made: the number of rounds, the round with the best validation loss, the round restored (None if none) and the number of epochs of each
+# client in each round.
 def fedavg_autoencoders_train_test(train_val_data: FederationData, local_test_data: FederationData,
                                    new_test_data: ClientData, params: SimpleNamespace)\
-        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], List[float]]:
+        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], List[float], dict]:
     # Preparation of the dataloaders
-    train_dls, threshold_dls, local_test_dls_dicts, new_test_dls_dict = prepare_dataloaders(train_val_data, local_test_data, new_test_data, params)
-
-    # Initialization of the models
-    global_model, models = init_federated_models(train_dls, params, architecture=SimpleAutoencoder)
+    train_dls, threshold_dls, local_test_dls, new_test_dl = prepare_dataloaders(train_val_data, local_test_data, new_test_data, params)
+
+    # Initialization of the models. With the streaming aggregation, the models of the clients only exist while they are trained.
+    if params.streaming_aggregation:
+        check_streaming_aggregation(params)
+        global_model, models = init_streaming_global_model(train_dls, params, architecture=SimpleAutoencoder), None
+    else:
+        global_model, models = init_federated_models(train_dls, params, architecture=SimpleAutoencoder)
     global_threshold = Threshold(torch.tensor(0.))
 
+    # The thresholds of the clients are computed with their models after the aggregation, i.e. with the global model (the list of the
+    # models of the clients is updated in place by the rounds)
+    clients_models = models if models is not None else [global_model] * len(threshold_dls)
+
     # Initialization of the results
     local_results, new_devices_results, global_thresholds = [], [], []
 
     # Selection of a client to mimic in case we use the mimic attack
     mimicked_client_id = select_mimicked_client(params)
 
+    client_titles = ['Training client {} on: '.format(i) + device_names(params.devices, client_devices)
+                     for i, client_devices in enumerate(params.clients_devices)]
+    early_stopping = get_early_stopping(params.federated_early_stopping)
+    rounds_epochs = []
     for federation_round in range(params.federation_rounds):
         print_federation_round(federation_round, params.federation_rounds)
 
         # Local training of each client
-        multitrain_autoencoders(trains=list(zip(['Training client {} on: '.format(i) + device_names(client_devices)
-                                                 for i, client_devices in enumerate(params.clients_devices)],
-                                                train_dls, models)),
-                                params=params, lr_factor=(params.gamma_round ** federation_round),
-                                main_title='Training the clients', color=Color.GREEN)
-
-        # Model poisoning attacks
-        models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=True)
-
-        # Aggregation
-        global_model, models = model_aggregation(global_model, models, params, verbose=True)
+        lr_factor = params.gamma_round ** federation_round
+        if params.streaming_aggregation:
+            # Each model is aggregated as soon as it is trained. The global model is not distributed back to the clients: the next round
+            # copies it again.
+            clients_epochs = streaming_federated_round(global_model, list(zip(client_titles, train_dls)), params, train_autoencoder,
+                                                       lr_factor=lr_factor, main_title='Training the clients', color=Color.GREEN)
+        else:
+            clients_epochs = multitrain_autoencoders(trains=list(zip(client_titles, train_dls, models)), params=params, lr_factor=lr_factor,
+                                                     main_title='Training the clients', color=Color.GREEN)
+
+            # Model poisoning attacks
+            models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=True)
+
+            # Aggregation
+            global_model, models = model_aggregation(global_model, models, params, verbose=True)
 
         # Compute and aggregate thresholds
-        federated_thresholds(models, threshold_dls, global_threshold, params, global_thresholds)
+        federated_thresholds(clients_models, threshold_dls, global_threshold, params, global_thresholds)
 
         # Testing
-        federated_testing(global_model, global_threshold, local_test_dls_dicts, new_test_dls_dict, params, local_results, new_devices_results)
+        federated_testing(global_model, global_threshold, local_test_dls, new_test_dl, params, local_results, new_devices_results)
+        rounds_epochs.append(clients_epochs)
 
+        stop = early_stopping is not None and early_stopping.step(federated_validation_loss(global_model, threshold_dls), global_model)
+        Ctp.exit_section()
+        if stop:
+            break
+
+    # If the best round is not the last one, its global model is distributed back to the clients and tested again
+    restored_round = None
+    if early_stopping is not None and early_stopping.best_step != len(rounds_epochs) and early_stopping.restore(global_model):
+        restored_round = early_stopping.best_step
+        Ctp.enter_section('Restored global model of round {}'.format(restored_round), Color.DARK_GRAY)
+        if models is not None:
+            broadcast_global_model(global_model, models)
+        federated_thresholds(clients_models, threshold_dls, global_threshold, params, global_thresholds)
+        federated_testing(global_model, global_threshold, local_test_dls, new_test_dl, params, local_results, new_devices_results)
         Ctp.exit_section()
 
-    return local_results, new_devices_results, global_thresholds
+    training = {'rounds': len(rounds_epochs), 'best_round': early_stopping.best_step if early_stopping is not None else None,
+                'restored_round': restored_round, 'epochs': rounds_epochs}
+    return local_results, new_devices_results, global_thresholds, training
 
 
+# The last element of the returned tuple records the training actually made: the number of epochs
 def fedsgd_autoencoders_train_test(train_val_data: FederationData, local_test_data: FederationData,
                                    new_test_data: ClientData, params: SimpleNamespace)\
-        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], List[float]]:
+        -> Tuple[List[BinaryClassificationResult], List[BinaryClassificationResult], List[float], dict]:
+    if params.streaming_aggregation:
+        raise ValueError('The streaming aggregation is only available with FedAvg: the FedSGD steps aggregate all the clients at once')
+
     # Preparation of the dataloaders
-    train_dls, threshold_dls, local_test_dls_dicts, new_test_dls_dict = prepare_dataloaders(train_val_data, local_test_data, new_test_data, params)
+    train_dls, threshold_dls, local_test_dls, new_test_dl = prepare_dataloaders(train_val_data, local_test_data, new_test_data, params)
 
     # Initialization of the models
     global_model, models = init_federated_models(train_dls, params, architecture=SimpleAutoencoder)
@@ -201,7 +267,7 @@ def fedsgd_autoencoders_train_test(train_val_data: FederationData, local_test_da
             federated_thresholds(models, threshold_dls, global_threshold, params, global_thresholds)
 
             # Testing
-            federated_testing(global_model, global_threshold, local_test_dls_dicts, new_test_dls_dict, params, local_results, new_devices_results)
+            federated_testing(global_model, global_threshold, local_test_dls, new_test_dl, params, local_results, new_devices_results)
         Ctp.exit_section()
 
-    return local_results, new_devices_results, global_thresholds
+    return local_results, new_devices_results, global_thresholds, {'epochs': params.epochs}
@@ -1,5 +1,5 @@
 from types import SimpleNamespace
-from typing import List, Dict, Tuple, Union, Optional
+from typing import List, Tuple, Union, Optional
 
 import torch
 import torch.nn as nn
@@ -8,24 +8,51 @@ from context_printer import ContextPrinter as Ctp
 # noinspection PyProtectedMember
 from torch.utils.data import DataLoader
 
-from architectures import Threshold
+from architectures import Threshold, NormalizingModel
+from batched_training import multitrain_batched
+from client_executor import client_executor, print_client_outputs
+from early_stopping import get_early_stopping
+from execution import execution_mode
 from federated_util import model_poisoning, model_aggregation
-from metrics import BinaryClassificationResult
-from print_util import print_autoencoder_loss_stats, print_rates, print_autoencoder_loss_header
-
-
-def optimize(model: nn.Module, data: torch.Tensor, optimizer: torch.optim.Optimizer, criterion: torch.nn.Module) -> torch.Tensor:
-    output = model(data)
-    # Since the normalization is made by the model itself, the output is computed on the normalized x
-    # so we need to compute the loss with respect to the normalized x
-    loss = criterion(output, model.normalize(data))
-    optimizer.zero_grad()
-    loss.mean().backward()
-    optimizer.step()
+from flat_util import FlatModels, can_use_flat_fedsgd, flat_model_poisoning, flat_model_aggregation
+from metrics import BinaryClassificationResult, weighted_mean, weighted_std, weighted_quantile
+from normalized_data import normalized_data_cache
+from print_util import ClientPrinter, print_autoencoder_loss_header, print_loss_stats, compute_loss_stats, print_rates
+from tensor_datasets import is_compact, split_batch, get_counts, get_n_samples, get_segments, get_segment_slices
+from unsupervised_data import test_keys
+
+
+# If weight is specified, each row counts as many times as its weight in the loss. If optimizer is None, the gradients are only
+# accumulated into the gradients of the parameters (which are then zeroed and used by the caller, see flat_util.FlatModels).
+# If normalized is True, the data is already normalized (see normalized_data.py). The forward pass and the loss are computed in the
+# execution mode of execution.py.
+def optimize(model: NormalizingModel, data: torch.Tensor, optimizer: Optional[torch.optim.Optimizer], criterion: torch.nn.Module,
+             weight: Optional[torch.Tensor] = None, normalized: bool = False) -> torch.Tensor:
+    with execution_mode.autocast(data.device):
+        # Since the normalization is made by the model itself, the output is computed on the normalized x
+        # so we need to compute the loss with respect to the normalized x
+        x = data if normalized else model.normalize(data)
+        output = execution_mode.inner_model(model)(x)
+        loss = criterion(output, x)
+    if optimizer is not None:
+        optimizer.zero_grad()
+    if weight is None:
+        loss.mean().backward()
+    else:
+        weight = weight.float()
+        ((loss.mean(dim=1) * weight).sum() / weight.sum()).backward()
+    if optimizer is not None:
+        optimizer.step()
     return loss
 
 
-def train_autoencoder(model: nn.Module, params: SimpleNamespace, train_loader, lr_factor: float = 1.0) -> None:
+# Returns the number of epochs actually made, which is less than params.epochs if the training is stopped early (see early_stopping.py).
+# The validation loader is only used by the early stopping, when it monitors the validation loss. The output goes through the printer if
+# specified (see print_util.ClientPrinter).
+def train_autoencoder(model: nn.Module, params: SimpleNamespace, train_loader, lr_factor: float = 1.0, val_loader=None,
+                      printer: Optional[ClientPrinter] = None) -> int:
+    printer = printer or ClientPrinter()
+    early_stopping = get_early_stopping(params.early_stopping)
     criterion = nn.MSELoss(reduction='none')
     optimizer = params.optimizer(model.parameters(), **params.optimizer_params)
     for param_group in optimizer.param_groups:
@@ -37,21 +64,43 @@ def train_autoencoder(model: nn.Module, params: SimpleNamespace, train_loader, l
     num_elements = len(train_loader.dataset)
     num_batches = len(train_loader)
     batch_size = train_loader.batch_size
-    print_autoencoder_loss_header(first_column='Epoch', print_lr=True)
+    weighted = is_compact(train_loader)
+    train_loader, normalized = normalized_data_cache.get_dataloader(model, train_loader)
+    printer(print_autoencoder_loss_header, first_column='Epoch', print_lr=True)
 
+    n_epochs = 0
     for epoch in range(params.epochs):
+        n_epochs += 1
         losses = torch.zeros(num_elements)
-        for i, (data,) in enumerate(train_loader):
+        weights = torch.zeros(num_elements, dtype=torch.long) if weighted else None
+        for i, batch in enumerate(train_loader):
+            (data,), weight = split_batch(batch, weighted)
             start = i * batch_size
             end = start + batch_size
             if i == num_batches - 1:
                 end = num_elements
-            loss = optimize(model, data, optimizer, criterion)
+            loss = optimize(model, data, optimizer, criterion, weight, normalized)
             losses[start:end] = loss.mean(dim=1)
+            if weighted:
+                weights[start:end] = weight
 
-        print_autoencoder_loss_stats('[{}/{}]'.format(epoch + 1, params.epochs), losses, lr=optimizer.param_groups[0]['lr'])
+        printer(print_loss_stats, '[{}/{}]'.format(epoch + 1, params.epochs), compute_loss_stats(losses, weights),
+                lr=optimizer.param_groups[0]['lr'])
         scheduler.step()
 
+        if early_stopping is not None:
+            if early_stopping.monitor == 'val' and val_loader is not None:
+                monitored_loss = compute_mean_reconstruction_loss(model, val_loader)
+                model.train()
+            else:
+                monitored_loss = (weighted_mean(losses, weights) if weighted else losses.mean()).item()
+            if early_stopping.step(monitored_loss, model, printer):
+                break
+
+    if early_stopping is not None:
+        early_stopping.restore(model)
+    return n_epochs
+
 
 def train_autoencoders_fedsgd(global_model: nn.Module, models: List[nn.Module], dls: List[DataLoader], params: SimpleNamespace,
                               lr_factor: float = 1.0, mimicked_client_id: Optional[int] = None)\
@@ -62,33 +111,55 @@ def train_autoencoders_fedsgd(global_model: nn.Module, models: List[nn.Module],
     for model in models:
         model.train()
 
+    weighted = [is_compact(dl) for dl in dls]
+    dls, normalized = zip(*[normalized_data_cache.get_dataloader(model, dl) for model, dl in zip(models, dls)])
+    # With a plain SGD, the steps, the attacks and the aggregation are made on the rows of flat buffers of parameters
+    flat_models = FlatModels(global_model, models) if can_use_flat_fedsgd(params) else None
     for data_tuple in zip(*dls):
-        for model, (data,) in zip(models, data_tuple):
-            optimizer = params.optimizer(model.parameters(), lr=lr, weight_decay=params.optimizer_params['weight_decay'])
-            optimize(model, data, optimizer, criterion)
-
-        # Model poisoning attacks
-        models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=False)
-
-        # Aggregation
-        global_model, models = model_aggregation(global_model, models, params, verbose=False)
+        if flat_models is not None:
+            flat_models.zero_grad()
+        for model, batch, client_weighted, client_normalized in zip(models, data_tuple, weighted, normalized):
+            (data,), weight = split_batch(batch, client_weighted)
+            if flat_models is not None:
+                optimize(model, data, None, criterion, weight, client_normalized)
+            else:
+                optimizer = params.optimizer(model.parameters(), lr=lr, weight_decay=params.optimizer_params['weight_decay'])
+                optimize(model, data, optimizer, criterion, weight, client_normalized)
+
+        if flat_models is not None:
+            flat_models.sgd_step(lr, params.optimizer_params['weight_decay'])
+            flat_model_poisoning(flat_models, params, mimicked_client_id=mimicked_client_id)
+            flat_model_aggregation(flat_models, params)
+        else:
+            # Model poisoning attacks
+            models = model_poisoning(global_model, models, params, mimicked_client_id=mimicked_client_id, verbose=False)
+
+            # Aggregation
+            global_model, models = model_aggregation(global_model, models, params, verbose=False)
 
     return global_model, models
 
 
-def compute_reconstruction_losses(model: nn.Module, dataloader) -> torch.Tensor:
+def compute_reconstruction_losses(model: NormalizingModel, dataloader) -> torch.Tensor:
     with torch.no_grad():
         criterion = nn.MSELoss(reduction='none')
         model.eval()
+        dataloader, normalized = normalized_data_cache.get_dataloader(model, dataloader)
         num_elements = len(dataloader.dataset)
         num_batches = len(dataloader)
         batch_size = dataloader.batch_size
 
         losses = torch.zeros(num_elements)
+        inner_model = execution_mode.inner_model(model)
 
-        for i, (x,) in enumerate(dataloader):
-            output = model(x)
-            loss = criterion(output, model.normalize(x))
+        # With a CompactDataset, the losses are those of the distinct rows (the dataloader is not shuffled, so their multiplicities are
+        # the counts of the dataset). The other elements of the batches (segment ids, counts) are not needed here.
+        for i, batch in enumerate(dataloader):
+            # The input is normalized once, and used both as the input of the autoencoder and as the target of the loss
+            with execution_mode.autocast(batch[0].device):
+                x = batch[0] if normalized else model.normalize(batch[0])
+                output = inner_model(x)
+                loss = criterion(output, x)
 
             start = i * batch_size
             end = start + batch_size
@@ -100,36 +171,100 @@ def compute_reconstruction_losses(model: nn.Module, dataloader) -> torch.Tensor:
         return losses
 
 
-def test_autoencoder(model: nn.Module, threshold: nn.Module, dataloaders: Dict[str, DataLoader]) -> BinaryClassificationResult:
-    print_autoencoder_loss_header(print_positives=True)
+# Mean reconstruction loss over a dataloader, counting the multiplicities of the rows of a CompactDataset
+def compute_mean_reconstruction_loss(model: NormalizingModel, dataloader) -> float:
+    losses = compute_reconstruction_losses(model, dataloader)
+    weights = get_counts(dataloader)
+    return (sum(losses) / len(losses)).item() if weights is None else weighted_mean(losses, weights).item()
+
+
+# The dataloader is over a test dataset whose rows are segmented by traffic key (see unsupervised_data.build_test_dataset). The losses of
+# all the keys are computed in a single pass, the positives and the samples of each key are counted with bincount, and the statistics of
+# each key are computed on its slice of the losses. The output goes through the printer if specified (see print_util.ClientPrinter).
+def test_autoencoder(model: nn.Module, threshold: nn.Module, dataloader: DataLoader,
+                     printer: Optional[ClientPrinter] = None) -> BinaryClassificationResult:
+    printer = printer or ClientPrinter()
+    printer(print_autoencoder_loss_header, print_positives=True)
+    losses = compute_reconstruction_losses(model, dataloader)
+    weights = get_counts(dataloader)
+    segments = get_segments(dataloader.dataset)
+    predictions = torch.gt(losses, threshold.threshold)
+
+    if weights is None:
+        positives = torch.bincount(segments[predictions], minlength=len(test_keys)).tolist()
+        n_samples = torch.bincount(segments, minlength=len(test_keys)).tolist()
+    else:
+        positives = torch.bincount(segments, weights=(predictions.long() * weights).double(), minlength=len(test_keys)).long().tolist()
+        n_samples = torch.bincount(segments, weights=weights.double(), minlength=len(test_keys)).long().tolist()
+
     result = BinaryClassificationResult()
-    for key, dataloader in dataloaders.items():
-        losses = compute_reconstruction_losses(model, dataloader)
-        predictions = torch.gt(losses, threshold.threshold).int()
-        current_results = count_scores(predictions, is_attack=(key != 'benign'))
+    for key, rows, key_positives, key_n_samples in zip(test_keys, get_segment_slices(segments, len(test_keys)), positives, n_samples):
+        if key_n_samples == 0:
+            continue
+        current_results = count_scores(key_positives, key_n_samples, is_attack=(key != 'benign'))
         title = ' '.join(key.split('_')).title()  # Transforms for example the key "mirai_ack" into the title "Mirai Ack"
-        print_autoencoder_loss_stats(title, losses, positives=current_results.tp + current_results.fp, n_samples=current_results.n_samples())
+        printer(print_loss_stats, title, compute_loss_stats(losses[rows], weights[rows] if weights is not None else None),
+                positives=key_positives, n_samples=key_n_samples)
         result += current_results
 
     return result
 
 
+# Tasks of the client executor, with the model and the dataloader as first arguments. They return their output along with their result, to
+# be printed by the main process (see print_util.ClientPrinter).
+def train_autoencoder_task(model: nn.Module, dataloader: DataLoader, params: SimpleNamespace,
+                           lr_factor: float) -> Tuple[int, ClientPrinter]:
+    printer = ClientPrinter(deferred=True)
+    return train_autoencoder(model, params, dataloader, lr_factor, printer=printer), printer
+
+
+def threshold_task(model: NormalizingModel, dataloader: DataLoader, quantile: Optional[float]) -> Tuple[float, ClientPrinter]:
+    printer = ClientPrinter(deferred=True)
+    return compute_threshold(model, dataloader, quantile, printer), printer
+
+
+def test_autoencoder_task(model: nn.Module, dataloader: DataLoader,
+                          threshold: nn.Module) -> Tuple[BinaryClassificationResult, ClientPrinter]:
+    printer = ClientPrinter(deferred=True)
+    return test_autoencoder(model, threshold, dataloader, printer), printer
+
+
 # this function will train each model on its associated dataloader, and will print the title for it
+# Returns the number of epochs made by each model. The batched training and the deterministic workers of the client executor need to know
+# the number of epochs in advance, so they are not used when the training can be stopped early.
 def multitrain_autoencoders(trains: List[Tuple[str, DataLoader, nn.Module]], params: SimpleNamespace, lr_factor: float = 1.0,
-                            main_title: str = 'Multitrain autoencoders', color: Union[str, Color] = Color.NONE) -> None:
+                            main_title: str = 'Multitrain autoencoders', color: Union[str, Color] = Color.NONE) -> List[int]:
     Ctp.enter_section(main_title, color)
-    for i, (title, dataloader, model) in enumerate(trains):
-        Ctp.enter_section('[{}/{}] '.format(i + 1, len(trains)) + title + ' ({} samples)'.format(len(dataloader.dataset[:][0])),
-                          color=Color.NONE, header='      ')
-        train_autoencoder(model, params, dataloader, lr_factor)
-        Ctp.exit_section()
+    fixed_epochs = params.early_stopping is None
+    if params.batched_clients and len(trains) > 1 and fixed_epochs:
+        multitrain_batched(trains, params, autoencoder=True, lr_factor=lr_factor)
+        n_epochs = [params.epochs] * len(trains)
+    elif client_executor.is_active([dataloader for _, dataloader, _ in trains]) and (fixed_epochs or not client_executor.deterministic):
+        n_epochs, printers = zip(*client_executor.map(train_autoencoder_task, [model for _, _, model in trains],
+                                                      [dataloader for _, dataloader, _ in trains], clients_args=[(params, lr_factor)] * len(trains),
+                                                      n_passes=params.epochs, update_models=True))
+        n_epochs = list(n_epochs)
+        print_client_outputs(trains, printers)
+    else:
+        n_epochs = []
+        for i, (title, dataloader, model) in enumerate(trains):
+            Ctp.enter_section('[{}/{}] '.format(i + 1, len(trains)) + title + ' ({} samples)'.format(get_n_samples(dataloader)),
+                              color=Color.NONE, header='      ')
+            n_epochs.append(train_autoencoder(model, params, dataloader, lr_factor))
+            Ctp.exit_section()
     Ctp.exit_section()
+    return n_epochs
 
 
 # Compute a single threshold value. If no quantile is indicated, it's the average reconstruction loss + its standard deviation, otherwise
-# it's the quantile of the loss.
-def compute_threshold_value(losses: torch.Tensor, quantile: Optional[float] = None) -> torch.Tensor:
-    if quantile is None:
+# it's the quantile of the loss. If weights are specified, each loss counts as many times as its weight.
+def compute_threshold_value(losses: torch.Tensor, quantile: Optional[float] = None, weights: Optional[torch.Tensor] = None) -> torch.Tensor:
+    if weights is not None:
+        if quantile is None:
+            threshold_value = weighted_mean(losses, weights) + weighted_std(losses, weights)
+        else:
+            threshold_value = weighted_quantile(losses, weights, quantile)
+    elif quantile is None:
         threshold_value = losses.mean() + losses.std()
     else:
         threshold_value = losses.quantile(quantile)
@@ -137,6 +272,17 @@ def compute_threshold_value(losses: torch.Tensor, quantile: Optional[float] = No
     return threshold_value
 
 
+# Computes the threshold of a model on its benign opt dataloader, printing the statistics of the losses through the printer
+def compute_threshold(model: NormalizingModel, dataloader: DataLoader, quantile: Optional[float], printer: ClientPrinter) -> float:
+    printer(print_autoencoder_loss_header)
+    losses = compute_reconstruction_losses(model, dataloader)
+    weights = get_counts(dataloader)
+    printer(print_loss_stats, 'Benign (opt)', compute_loss_stats(losses, weights))
+    threshold_value = compute_threshold_value(losses, quantile, weights=weights).item()
+    printer(Ctp.print, 'The threshold is {:.4f}'.format(threshold_value))
+    return threshold_value
+
+
 # opts should be a list of tuples (title, dataloader_benign_opt, model)
 # this function will test each model on its associated dataloader, and will find the correct threshold for them
 def compute_thresholds(opts: List[Tuple[str, DataLoader, nn.Module]], quantile: Optional[float] = None,
@@ -144,26 +290,24 @@ def compute_thresholds(opts: List[Tuple[str, DataLoader, nn.Module]], quantile:
 
     Ctp.enter_section(main_title, color)
 
-    thresholds = []
-    for i, (title, dataloader, model) in enumerate(opts):
-        Ctp.enter_section('[{}/{}] '.format(i + 1, len(opts)) + title + ' ({} samples)'.format(len(dataloader.dataset[:][0])),
-                          color=Color.NONE, header='      ')
-        print_autoencoder_loss_header()
-        losses = compute_reconstruction_losses(model, dataloader)
-        print_autoencoder_loss_stats('Benign (opt)', losses)
-        threshold_value = compute_threshold_value(losses, quantile)
-        threshold = Threshold(threshold_value)
-        thresholds.append(threshold)
-        Ctp.print('The threshold is {:.4f}'.format(threshold.threshold.item()))
-        Ctp.exit_section()
+    if client_executor.is_active([dataloader for _, dataloader, _ in opts]):
+        threshold_values, printers = zip(*client_executor.map(threshold_task, [model for _, _, model in opts],
+                                                              [dataloader for _, dataloader, _ in opts], clients_args=[(quantile,)] * len(opts)))
+        print_client_outputs(opts, printers)
+    else:
+        threshold_values = []
+        for i, (title, dataloader, model) in enumerate(opts):
+            Ctp.enter_section('[{}/{}] '.format(i + 1, len(opts)) + title + ' ({} samples)'.format(get_n_samples(dataloader)),
+                              color=Color.NONE, header='      ')
+            threshold_values.append(compute_threshold(model, dataloader, quantile, ClientPrinter()))
+            Ctp.exit_section()
 
     Ctp.exit_section()
-    return thresholds
+    return [Threshold(torch.tensor(threshold_value)) for threshold_value in threshold_values]
 
 
-def count_scores(predictions: torch.Tensor, is_attack: bool) -> BinaryClassificationResult:
-    positive_predictions = predictions.sum().item()
-    negative_predictions = len(predictions) - positive_predictions
+def count_scores(positive_predictions: int, n_samples: int, is_attack: bool) -> BinaryClassificationResult:
+    negative_predictions = n_samples - positive_predictions
     results = BinaryClassificationResult()
     if is_attack:
         results.add_tp(positive_predictions)
@@ -175,18 +319,30 @@ def count_scores(predictions: torch.Tensor, is_attack: bool) -> BinaryClassifica
 
 
 # this function will test each model on its associated dataloader, and will print the title for it
-def multitest_autoencoders(tests: List[Tuple[str, Dict[str, DataLoader], nn.Module, nn.Module]], main_title: str = 'Multitest autoencoders',
+def multitest_autoencoders(tests: List[Tuple[str, DataLoader, nn.Module, nn.Module]], main_title: str = 'Multitest autoencoders',
                            color: Union[str, Color] = Color.NONE) -> BinaryClassificationResult:
     Ctp.enter_section(main_title, color)
 
     result = BinaryClassificationResult()
-    for i, (title, dataloaders, model, threshold) in enumerate(tests):
-        n_samples = sum([len(dataloader.dataset[:][0]) for dataloader in dataloaders.values()])
-        Ctp.enter_section('[{}/{}] '.format(i + 1, len(tests)) + title + ' ({} samples)'.format(n_samples), color=Color.NONE, header='      ')
-        current_result = test_autoencoder(model, threshold, dataloaders)
-        result += current_result
-        Ctp.exit_section()
-        print_rates(current_result)
+    if client_executor.is_active([dataloader for _, dataloader, _, _ in tests]):
+        current_results, printers = zip(*client_executor.map(test_autoencoder_task, [model for _, _, model, _ in tests],
+                                                             [dataloader for _, dataloader, _, _ in tests],
+                                                             clients_args=[(threshold,) for _, _, _, threshold in tests]))
+        for i, ((title, dataloader, _, _), current_result, printer) in enumerate(zip(tests, current_results, printers)):
+            Ctp.enter_section('[{}/{}] '.format(i + 1, len(tests)) + title + ' ({} samples)'.format(get_n_samples(dataloader)),
+                              color=Color.NONE, header='      ')
+            printer.replay()
+            result += current_result
+            Ctp.exit_section()
+            print_rates(current_result)
+    else:
+        for i, (title, dataloader, model, threshold) in enumerate(tests):
+            Ctp.enter_section('[{}/{}] '.format(i + 1, len(tests)) + title + ' ({} samples)'.format(get_n_samples(dataloader)),
+                              color=Color.NONE, header='      ')
+            current_result = test_autoencoder(model, threshold, dataloader)
+            result += current_result
+            Ctp.exit_section()
+            print_rates(current_result)
 
     Ctp.exit_section()
     Ctp.print('Average result')
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from context_printer import ContextPrinter as Ctp
+
+from data import get_configuration_data, get_initial_splitting
+from federated_util import federated_averaging
+from supervised_data import get_client_supervised_initial_splitting
+from supervised_experiments import fedavg_classifiers_train_test
+from synthetic_data import get_synthetic_devices, read_synthetic_data
+from unsupervised_data import get_client_unsupervised_initial_splitting
+from unsupervised_experiments import fedavg_autoencoders_train_test
+
+Ctp.deactivate()
+
+n_devices = 4
+configuration = {'clients_devices': [[1], [2], [3]], 'test_devices': [0]}
+
+
+def get_params(restore_best_weights: bool, **experiment_params) -> SimpleNamespace:
+    # With a huge min_delta, only the first round counts as an improvement: the federation stops after the second round, whose global
+    # model is not the best one. The benign and attack rows are balanced so that the results of the classifiers depend on their training.
+    return SimpleNamespace(n_features=115, normalization='min-max', test_bs=4096, p_test=0.2, p_unused=0.01, p_train_val=0.79,
+                           val_part=0.2, cuda=False, benign_prop=0.5, samples_per_device=2000, compact_datasets=False, thinning=None,
+                           thinning_ratio=0.1, batched_clients=False, streaming_chunk_size=None, verbose=False, early_stopping=None,
+                           federated_early_stopping={'patience': 1, 'min_delta': 1e9, 'restore_best_weights': restore_best_weights},
+                           n_malicious=0, malicious_clients=set(), data_poisoning=None, p_poison=None, model_update_factor=1.0,
+                           model_poisoning=None, aggregation_function=federated_averaging, resampling=None, streaming_aggregation=False,
+                           devices=get_synthetic_devices(n_devices), federation_rounds=5, gamma_round=0.75, activation_fn=torch.nn.ELU,
+                           optimizer=torch.optim.SGD, lr_scheduler=torch.optim.lr_scheduler.StepLR, epochs=1, train_bs=64,
+                           **configuration, **experiment_params)
+
+
+def run(experiment_function, splitting_function, params: SimpleNamespace) -> tuple:
+    torch.manual_seed(0)
+    np.random.seed(0)
+    all_data = read_synthetic_data(n_devices, 500)
+    clients_devices_data, test_devices_data = get_configuration_data(all_data, configuration['clients_devices'],
+                                                                     configuration['test_devices'])
+    clients_train_val, clients_test = get_initial_splitting(splitting_function, clients_devices_data, p_test=params.p_test,
+                                                            p_unused=params.p_unused)
+    return experiment_function(clients_train_val, clients_test, test_devices_data, params)
+
+
+def test_fedavg_autoencoders_restores_best_round() -> None:
+    autoencoder_params = {'threshold_part': 0.5, 'quantile': 0.95, 'hidden_layers': [29], 'optimizer_params': {'lr': 1.0, 'weight_decay': 0.},
+                          'lr_scheduler_params': {'step_size': 20, 'gamma': 0.5}}
+    last = run(fedavg_autoencoders_train_test, get_client_unsupervised_initial_splitting, get_params(False, **autoencoder_params))
+    restored = run(fedavg_autoencoders_train_test, get_client_unsupervised_initial_splitting, get_params(True, **autoencoder_params))
+
+    assert last[-1]['rounds'] == restored[-1]['rounds'] == 2
+    assert last[-1]['best_round'] == restored[-1]['best_round'] == 1
+    assert last[-1]['restored_round'] is None and restored[-1]['restored_round'] == 1
+
+    # Without the restoration the last results are those of the second round, with it the best round is tested again at the end
+    local_results, new_devices_results, thresholds = last[:3]
+    restored_local_results, restored_new_devices_results, restored_thresholds = restored[:3]
+    assert len(local_results) == len(thresholds) == 2 and len(restored_local_results) == len(restored_thresholds) == 3
+    assert restored_thresholds[-1] == thresholds[0] != thresholds[-1]
+    assert restored_local_results[-1].to_json() == local_results[0].to_json()
+    assert restored_new_devices_results[-1].to_json() == new_devices_results[0].to_json()
+    assert restored_local_results[-1].to_json() != local_results[-1].to_json()
+
+
+def test_fedavg_classifiers_restores_best_round() -> None:
+    classifier_params = {'hidden_layers': [115], 'optimizer_params': {'lr': 0.5, 'weight_decay': 0.},
+                         'lr_scheduler_params': {'step_size': 1, 'gamma': 0.5}}
+    last = run(fedavg_classifiers_train_test, get_client_supervised_initial_splitting, get_params(False, **classifier_params))
+    restored = run(fedavg_classifiers_train_test, get_client_supervised_initial_splitting, get_params(True, **classifier_params))
+
+    assert last[-1]['best_round'] == restored[-1]['best_round'] == 1
+    assert last[-1]['restored_round'] is None and restored[-1]['restored_round'] == 1
+
+    local_results, new_devices_results = last[:2]
+    restored_local_results, restored_new_devices_results = restored[:2]
+    assert len(local_results) == 2 and len(restored_local_results) == 3
+    assert restored_local_results[-1].to_json() == local_results[0].to_json()
+    assert restored_new_devices_results[-1].to_json() == new_devices_results[0].to_json()
+    assert restored_local_results[-1].to_json() != local_results[-1].to_json()
@@ -0,0 +1,67 @@
+import gc
+from types import SimpleNamespace
+
+import pytest
+import torch
+from context_printer import ContextPrinter as Ctp
+
+from architectures import NormalizingModel, SimpleAutoencoder
+from federated_util import federated_averaging, new_global_model, flatten_model
+from streaming_aggregation import streaming_federated_round
+from supervised_experiments import fedavg_classifiers_train_test, fedsgd_classifiers_train_test
+from supervised_data import get_client_supervised_initial_splitting
+from tensor_datasets import ResampledDataset, TensorDataLoader
+from test_federated_early_stopping import get_params, run
+from unsupervised_experiments import fedsgd_autoencoders_train_test
+
+Ctp.deactivate()
+
+
+def count_normalizing_models() -> int:
+    gc.collect()
+    return sum(1 for obj in gc.get_objects() if type(obj) is NormalizingModel)
+
+
+def test_streaming_round_keeps_a_single_client_model() -> None:
+    params = SimpleNamespace(activation_fn=torch.nn.ELU, hidden_layers=[29], n_features=115, cuda=False,
+                             aggregation_function=federated_averaging, malicious_clients=set(), model_update_factor=1.)
+    global_model = new_global_model(params, SimpleAutoencoder)
+    initial_row = flatten_model(global_model)
+    dataloader = TensorDataLoader(ResampledDataset(torch.zeros(10, 115), torch.arange(10, dtype=torch.int32)), batch_size=5)
+    n_models_before = count_normalizing_models()
+    n_models_alive = []
+
+    # Each client shifts all the parameters of its model by its id
+    def train_function(model: NormalizingModel, _: SimpleNamespace, __: TensorDataLoader, ___: float) -> int:
+        n_models_alive.append(count_normalizing_models() - n_models_before)
+        with torch.no_grad():
+            for value in model.state_dict().values():
+                value.add_(len(n_models_alive) - 1)
+        return 1
+
+    n_clients = 20
+    n_epochs = streaming_federated_round(global_model, [('Client {}'.format(i), dataloader) for i in range(n_clients)], params,
+                                         train_function)
+
+    assert n_epochs == [1] * n_clients
+    assert n_models_alive == [1] * n_clients  # Only the model of the client being trained, whatever the number of clients
+    assert torch.allclose(flatten_model(global_model), initial_row + (n_clients - 1) / 2)
+
+
+def test_streaming_fedavg_matches_stacked_aggregation() -> None:
+    classifier_params = {'hidden_layers': [115], 'optimizer_params': {'lr': 0.5, 'weight_decay': 0.},
+                         'lr_scheduler_params': {'step_size': 1, 'gamma': 0.5}}
+    stacked_params = get_params(False, **classifier_params)
+    streaming_params = get_params(False, **classifier_params)
+    streaming_params.streaming_aggregation = True
+
+    stacked = run(fedavg_classifiers_train_test, get_client_supervised_initial_splitting, stacked_params)
+    streaming = run(fedavg_classifiers_train_test, get_client_supervised_initial_splitting, streaming_params)
+    assert [result.to_json() for result in streaming[0]] == [result.to_json() for result in stacked[0]]
+    assert [result.to_json() for result in streaming[1]] == [result.to_json() for result in stacked[1]]
+
+
+@pytest.mark.parametrize('fedsgd_function', [fedsgd_autoencoders_train_test, fedsgd_classifiers_train_test])
+def test_fedsgd_rejects_streaming_aggregation(fedsgd_function) -> None:
+    with pytest.raises(ValueError):
+        fedsgd_function(None, None, None, SimpleNamespace(streaming_aggregation=True))
@@ -0,0 +1,53 @@
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+from context_printer import ContextPrinter as Ctp
+
+from ml import get_sub_div, get_online_sub_div
+from streaming_data import StreamingDataLoader, get_client_streaming_source
+from supervised_data import get_target_tensor
+from synthetic_data import generate_device_data
+
+Ctp.deactivate()
+
+client_data = [{key: arr for key, arr in generate_device_data(device_id, 250).items() if key in ('benign', 'mirai_ack', 'gafgyt_tcp')}
+               for device_id in range(2)]
+all_rows = np.concatenate([arr for device_data in client_data for arr in device_data.values()])
+
+
+def get_loader(shuffle: bool, target_function=None) -> StreamingDataLoader:
+    return StreamingDataLoader(get_client_streaming_source(client_data), batch_size=64, chunk_size=100, shuffle=shuffle,
+                               target_function=target_function)
+
+
+@pytest.mark.parametrize('normalization', ['min-max', '0-mean 1-var', 'none'])
+def test_online_sub_div_matches_in_memory(normalization: str) -> None:
+    sub, div = get_sub_div(torch.from_numpy(all_rows), normalization)
+    online_sub, online_div = get_online_sub_div(get_loader(shuffle=False).iter_data_chunks(), normalization)
+    assert torch.allclose(online_sub, sub, rtol=1e-5, atol=1e-5) and torch.allclose(online_div, div, rtol=1e-5, atol=1e-5)
+
+
+def test_streaming_epoch_covers_all_rows_in_full_batches() -> None:
+    loader = get_loader(shuffle=True, target_function=partial(get_target_tensor, multiclass=False))
+    batches = list(loader)
+    assert len(batches) == len(loader) and all(len(data) == loader.batch_size for data, _ in batches[:-1])
+
+    data = torch.cat([data for data, _ in batches]).numpy()
+    target = torch.cat([target for _, target in batches]).numpy().reshape(-1)
+    # Every row appears once, with the target of its traffic key
+    order = np.lexsort(data.T)
+    assert np.array_equal(data[order], all_rows[np.lexsort(all_rows.T)])
+    benign_rows = np.concatenate([device_data['benign'] for device_data in client_data])
+    assert np.array_equal(np.sort(data[target == 0.], axis=0), np.sort(benign_rows, axis=0))
+
+
+def test_streaming_shuffle_follows_global_generator() -> None:
+    loader = get_loader(shuffle=True)
+    torch.manual_seed(0)
+    first_epoch = torch.cat([data for data, in loader])
+    second_epoch = torch.cat([data for data, in loader])
+    torch.manual_seed(0)
+    assert torch.equal(torch.cat([data for data, in loader]), first_epoch)
+    assert not torch.equal(first_epoch, second_epoch)